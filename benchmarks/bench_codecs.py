@@ -0,0 +1,59 @@
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from broker.codecs import codecs
+
+#####################################
+# Payload codec benchmark
+#
+# Encode/decode throughput of every installed codec for the
+# {"id", "payload": {"command", "data"}} envelopes sent by publish_mqtt.
+#
+# python3 benchmarks/bench_codecs.py
+#####################################
+
+ITERATIONS = 100000
+
+ENVELOPES = {
+    "small": {"id": 12, "payload": {"command": "get_state", "data": None}},
+    "typical": {
+        "id": "a2f4",
+        "payload": {
+            "command": "set_state",
+            "data": {"zone": 3, "armed": True, "temperature": 21.5, "sensors": ["door", "window", "pir"]},
+        },
+    },
+    "large": {
+        "id": None,
+        "payload": {
+            "command": "history",
+            "data": [{"ts": 1582624000 + i, "value": i * 0.5, "label": "sensor_%d" % i} for i in range(100)],
+        },
+    },
+}
+
+
+def bench(function, argument, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function(argument)
+    return iterations / (time.perf_counter() - start)
+
+
+def main():
+    print("%-8s %-8s %6s %14s %14s" % ("envelope", "codec", "bytes", "encode/s", "decode/s"))
+    for envelope_name, envelope in ENVELOPES.items():
+        iterations = ITERATIONS if envelope_name != "large" else ITERATIONS // 50
+        for name, codec in codecs.items():
+            payload = codec.encode(envelope)
+            assert codec.decode(payload) == envelope
+            encode_rate = bench(codec.encode, envelope, iterations)
+            decode_rate = bench(codec.decode, payload, iterations)
+            print("%-8s %-8s %6d %14.0f %14.0f" % (envelope_name, name, len(payload), encode_rate, decode_rate))
+
+
+if __name__ == "__main__":
+    main()
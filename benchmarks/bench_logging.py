@@ -0,0 +1,121 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Log file must be set before log is imported
+os.environ["FILE_LOG"] = os.path.join(tempfile.mkdtemp(), "bench.log")
+
+import log
+
+#####################################
+# Logging benchmark
+#
+# Latency of Logger.d calls made concurrently by many service threads,
+# in synchronous mode and in asynchronous (queue + writer thread) mode.
+# Console output is sent to /dev/null.
+#
+# Also measures the cost of a debug call suppressed by the log level, with
+# the message built by the caller and with lazy %-style arguments.
+#
+# python3 benchmarks/bench_logging.py
+#####################################
+
+THREADS = 32
+CALLS_PER_THREAD = 2000
+
+
+def percentile(values, ratio):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * ratio))]
+
+
+def run_threads():
+    latencies = []
+    lock = threading.Lock()
+    start_barrier = threading.Barrier(THREADS)
+
+    def service(index):
+        logger = log.Logger("service_%d" % index)
+        local = []
+        start_barrier.wait()
+        for call in range(CALLS_PER_THREAD):
+            start = time.perf_counter()
+            logger.d("mqtt message received on topic/%d" % call)
+            local.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=service, args=(i,)) for i in range(THREADS)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, time.perf_counter() - start
+
+
+def report(name, latencies, elapsed):
+    print("%-6s mean %7.2f us  p50 %7.2f us  p99 %8.2f us  max %9.2f us  (%d calls in %.2f s)" % (
+        name,
+        sum(latencies) * 1e6 / len(latencies),
+        percentile(latencies, 0.5) * 1e6,
+        percentile(latencies, 0.99) * 1e6,
+        max(latencies) * 1e6,
+        len(latencies),
+        elapsed,
+    ))
+
+
+SUPPRESSED_CALLS = 1000000
+
+
+def bench_suppressed():
+    logger = log.Logger("suppressed")
+    topic = "test/test_topic"
+    payload = b'{"command": "set_state", "data": {"zone": 3, "armed": true}}'
+    log.CURRENT_LEVEL = log.LEVEL_INFO
+
+    start = time.perf_counter()
+    for _ in range(SUPPRESSED_CALLS):
+        logger.d(topic + " " + str(payload))
+    eager = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(SUPPRESSED_CALLS):
+        logger.d("%s %s", topic, payload)
+    lazy = time.perf_counter() - start
+
+    log.CURRENT_LEVEL = log.LEVEL_DEBUG
+    print("suppressed debug call : eager %.0f ns, lazy %.0f ns" % (
+        eager * 1e9 / SUPPRESSED_CALLS, lazy * 1e9 / SUPPRESSED_CALLS))
+
+
+def main():
+    log.CURRENT_LEVEL = log.LEVEL_DEBUG
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        sync_result = run_threads()
+
+        log.enable_async_logging(maxsize=THREADS * CALLS_PER_THREAD)
+        async_result = run_threads()
+        log.flush_logging()
+        stats = log.logging_stats()
+        log.shutdown_logging()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    print("%d threads x %d debug calls" % (THREADS, CALLS_PER_THREAD))
+    report("sync", *sync_result)
+    report("async", *async_result)
+    print("async writer : %s" % stats)
+    bench_suppressed()
+
+
+if __name__ == "__main__":
+    main()
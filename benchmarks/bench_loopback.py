@@ -0,0 +1,89 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import log
+from config import MQTT_HOST, MQTT_PORT
+from broker.mqtt import MqttClient
+from broker.dispatch import topic_handler
+
+#####################################
+# Loopback benchmark
+#
+# Ping-pong latency between two clients of the same process, through the
+# local broker (MQTT_HOST / MQTT_PORT) and through the loopback bus, with
+# subscribers decoding their own copy or sharing the published object.
+# Messages still go to the broker with loopback : on a single CPU, the broker
+# competes with the clients and the CPU time of the process is the fairer figure.
+#
+# python3 benchmarks/bench_loopback.py
+#####################################
+
+ROUNDS = 2000
+MODES = ("", "decode", "share")
+PAYLOAD = {"command": "set_state", "data": {"zone": 3, "values": list(range(20))}}
+
+
+class Ponger(MqttClient):
+
+    def __init__(self, logger, mode):
+        MqttClient.__init__(self, logger, MQTT_HOST, MQTT_PORT, [], loop_start=True, loopback=mode)
+
+    @topic_handler("bench/loopback/ping")
+    def ping(self, parsed_json, topic):
+        self.publish_json_mqtt(parsed_json, "bench/loopback/pong")
+
+
+class Pinger(MqttClient):
+
+    def __init__(self, logger, mode):
+        self.pong = threading.Event()
+        MqttClient.__init__(self, logger, MQTT_HOST, MQTT_PORT, [], loop_start=True, loopback=mode)
+
+    @topic_handler("bench/loopback/pong")
+    def on_pong(self, parsed_json, topic):
+        self.pong.set()
+
+    def round_trip(self):
+        self.pong.clear()
+        self.publish_json_mqtt(PAYLOAD, "bench/loopback/ping")
+        self.pong.wait(5)
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def main():
+    log.CURRENT_LEVEL = log.LEVEL_ERROR
+    logger = log.Logger("bench_loopback")
+    for mode in MODES:
+        ponger = Ponger(logger, mode)
+        pinger = Pinger(logger, mode)
+        # SUBACKs are received before measuring
+        ponger.subscribed_event.wait(5)
+        pinger.subscribed_event.wait(5)
+        for _ in range(100):
+            pinger.round_trip()
+
+        latencies = []
+        cpu_start = time.process_time()
+        for _ in range(ROUNDS):
+            start = time.perf_counter()
+            pinger.round_trip()
+            latencies.append(time.perf_counter() - start)
+        cpu = (time.process_time() - cpu_start) / ROUNDS
+        latencies.sort()
+        print("%-8s : p50 %7.1f us, p99 %7.1f us, max %8.1f us, cpu %6.1f us / round trip" % (
+            mode or "broker", percentile(latencies, 0.5) * 1e6, percentile(latencies, 0.99) * 1e6,
+            latencies[-1] * 1e6, cpu * 1e6))
+
+        pinger.disconnect_mqtt()
+        ponger.disconnect_mqtt()
+
+
+if __name__ == "__main__":
+    main()
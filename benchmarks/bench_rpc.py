@@ -0,0 +1,79 @@
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import log
+from config import MQTT_HOST, MQTT_PORT
+from broker.mqtt import MqttClient
+from broker.rpc import rpc_handler
+
+#####################################
+# RPC benchmark
+#
+# Round-trip latency of sequential calls, and calls per second with
+# IN_FLIGHT calls waiting at once, between two clients of the local broker
+# (MQTT_HOST / MQTT_PORT).
+#
+# python3 benchmarks/bench_rpc.py
+#####################################
+
+CALLS = 2000
+IN_FLIGHT = (1, 10, 100)
+
+
+class EchoServer(MqttClient):
+
+    def __init__(self, logger):
+        MqttClient.__init__(self, logger, MQTT_HOST, MQTT_PORT, [], loop_start=True)
+
+    @rpc_handler("bench/rpc/echo")
+    def echo(self, payload, topic):
+        return payload
+
+
+class Caller(MqttClient):
+
+    def __init__(self, logger):
+        MqttClient.__init__(self, logger, MQTT_HOST, MQTT_PORT, [], loop_start=True)
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def main():
+    log.CURRENT_LEVEL = log.LEVEL_ERROR
+    logger = log.Logger("bench_rpc")
+    server = EchoServer(logger)
+    caller = Caller(logger)
+    payload = {"command": "get_state", "data": {"zone": 3}}
+
+    # Subscribes the reply topic before measuring
+    caller.call("bench/rpc/echo", payload)
+
+    latencies = []
+    for _ in range(CALLS):
+        start = time.perf_counter()
+        caller.call("bench/rpc/echo", payload)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    print("sequential : p50 %.3f ms, p99 %.3f ms, max %.3f ms" % (
+        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000, latencies[-1] * 1000))
+
+    for in_flight in IN_FLIGHT:
+        start = time.perf_counter()
+        for _ in range(CALLS // in_flight):
+            futures = [caller.call_async("bench/rpc/echo", payload) for _ in range(in_flight)]
+            for future in futures:
+                future.result()
+        duration = time.perf_counter() - start
+        print("%4d in flight : %8.0f calls/s" % (in_flight, (CALLS // in_flight) * in_flight / duration))
+
+    caller.disconnect_mqtt()
+    server.disconnect_mqtt()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from broker.codecs import codecs
+from broker.schema import Schema, Field, SchemaError
+
+#####################################
+# Schema benchmark
+#
+# Messages per second decoded from the {"command", "data"} payloads read by
+# parse_mqtt : json.loads and dict lookups as done today (with and without
+# checking the fields by hand), against a compiled schema, for valid and
+# malformed payloads.
+#
+# python3 benchmarks/bench_schema.py
+#####################################
+
+ITERATIONS = 200000
+
+State = Schema("State", {
+    "zone": int,
+    "armed": bool,
+    "temperature": float,
+    "sensors": Field(list, items=str),
+    "label": Field(str, required=False),
+})
+SetState = Schema("SetState", {"command": str, "data": State})
+
+VALID = json.dumps({
+    "command": "set_state",
+    "data": {"zone": 3, "armed": True, "temperature": 21.5, "sensors": ["door", "window", "pir"]},
+}).encode("utf-8")
+MALFORMED = json.dumps({"command": "set_state", "data": {"zone": "3", "armed": True}}).encode("utf-8")
+
+
+def lookups(payload):
+    """
+    parse_mqtt : fields are read, not checked
+    """
+    parsed_json = json.loads(payload.decode("utf-8"))
+    try:
+        command = parsed_json["command"]
+    except:
+        command = None
+    try:
+        data = parsed_json["data"]
+    except:
+        data = None
+    return command, data
+
+
+def checked_lookups(payload):
+    """
+    Fields checked by hand, as a handler has to
+    """
+    command, data = lookups(payload)
+    if type(command) is not str or type(data) is not dict:
+        raise ValueError("malformed")
+    zone = data.get("zone")
+    armed = data.get("armed")
+    temperature = data.get("temperature")
+    sensors = data.get("sensors")
+    label = data.get("label")
+    if type(zone) is not int or type(armed) is not bool or type(temperature) not in (float, int):
+        raise ValueError("malformed")
+    if type(sensors) is not list or any(type(sensor) is not str for sensor in sensors):
+        raise ValueError("malformed")
+    if label is not None and type(label) is not str:
+        raise ValueError("malformed")
+    return command, zone, armed, temperature, sensors, label
+
+
+def bench(function, payload, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        try:
+            function(payload)
+        except (ValueError, SchemaError):
+            pass
+    return iterations / (time.perf_counter() - start)
+
+
+def main():
+    candidates = [("json.loads + lookups", lookups), ("json.loads + checks", checked_lookups)]
+    for name, codec in codecs.items():
+        if codec.marker is None:
+            candidates.append(("schema, " + name, lambda payload, codec=codec: SetState.decode(payload, codec)))
+
+    print("%-22s %14s %14s" % ("decoder", "valid/s", "malformed/s"))
+    for name, function in candidates:
+        print("%-22s %14.0f %14.0f" % (name, bench(function, VALID, ITERATIONS), bench(function, MALFORMED, ITERATIONS)))
+
+    payload = json.loads(VALID.decode("utf-8"))
+    print("%-22s %14.0f" % ("schema load only", bench(SetState.load, payload, ITERATIONS)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import base64
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import log
+from broker.mqtt import MqttClient
+from stub_broker import StubBroker
+
+#####################################
+# Shared payload benchmark
+#
+# Latency of blobs sent from a client to a subscriber touching every page of
+# them, through the stand-in broker : base64 in a JSON message, as done today,
+# against a shared memory handle (publish_shared / open_shared).
+#
+# python3 benchmarks/bench_shared_payload.py
+#####################################
+
+SIZES = (64 * 1024, 1024 * 1024, 4 * 1024 * 1024)
+BLOBS = 50
+
+
+class Receiver(MqttClient):
+
+    def __init__(self, logger, port):
+        self.received = threading.Event()
+        MqttClient.__init__(self, logger, "127.0.0.1", port, ["bench/blob/#"], loop_start=True)
+        self.add_topic_handler("bench/blob/json", self.on_json)
+        self.add_topic_handler("bench/blob/shared", self.on_shared)
+
+    def on_json(self, parsed_json, topic):
+        data = base64.b64decode(parsed_json["data"])
+        self.checksum = sum(data[::4096])
+        self.received.set()
+
+    def on_shared(self, parsed_json, topic):
+        with self.open_shared(parsed_json) as payload:
+            self.checksum = sum(payload.data[::4096])
+        self.received.set()
+
+
+def bench(receiver, send, blobs):
+    latencies = []
+    for _ in range(blobs):
+        receiver.received.clear()
+        start = time.perf_counter()
+        send()
+        receiver.received.wait(10)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return latencies[len(latencies) // 2]
+
+
+def main():
+    log.CURRENT_LEVEL = log.LEVEL_ERROR
+    logger = log.Logger("bench_shared_payload")
+    broker = StubBroker()
+    port = broker.start()
+    receiver = Receiver(logger, port)
+    sender = MqttClient(logger, "127.0.0.1", port, [], loop_start=True)
+    receiver.subscribed_event.wait(5)
+
+    print("%-10s %16s %16s" % ("size", "json+base64 p50", "shared p50"))
+    for size in SIZES:
+        data = os.urandom(size)
+        json_p50 = bench(receiver, lambda: sender.publish_json_mqtt(
+            {"data": base64.b64encode(data).decode("ascii")}, "bench/blob/json"), BLOBS)
+        shared_p50 = bench(receiver, lambda: sender.publish_shared("bench/blob/shared", data, consumers=1), BLOBS)
+        print("%-10s %13.2f ms %13.2f ms" % ("%d kB" % (size // 1024), json_p50 * 1e3, shared_p50 * 1e3))
+    print(sender.shared_stats())
+
+    sender.disconnect_mqtt()
+    receiver.disconnect_mqtt()
+    broker.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.append(ROOT_DIR)
+
+import log
+from broker.mqtt import MqttClient
+from broker.dispatch import topic_handler
+from stub_broker import StubBroker
+from synthetic_service import BENCH_TOPIC
+
+#####################################
+# End-to-end benchmark suite
+#
+# Starts the stand-in broker (stub_broker.py), generates a services.conf of
+# synthetic services (synthetic_service.py, found through an entry point of a
+# generated dist-info), launches the Core (main.py -d) on it and measures :
+#   startup  : time to READY=1 (sd_notify socket) and to every service's first message
+#   latency  : p50/p90/p99 of sequential ping/pong round trips through a service
+#   throughput : round trips per second with WINDOW pings in flight
+#   memory   : RSS/PSS of every service process and of the Core
+#   restart  : time from a service crash to its new instance's first message
+# Results are printed as JSON (and written to --output), to be compared across releases.
+#
+# python3 benchmarks/bench_suite.py --services 8 --mode process --output results.json
+#####################################
+
+SERVICES = 4
+ROUNDS = 2000
+MESSAGES = 20000
+WINDOW = 100
+PAYLOAD_SIZE = 100
+RESTARTS = 3
+TIMEOUT = 60
+
+ENTRY_POINT_GROUP = "microservices.services"
+
+
+class BenchDriver(MqttClient):
+    """
+    Client of the benchmark, sending pings to the synthetic services and timing their replies
+    """
+
+    def __init__(self, logger, port):
+        self.condition = threading.Condition()
+        # service name => [(instance, perf_counter when announced)]
+        self.hellos = {}
+        # seq => perf_counter when sent
+        self.in_flight = {}
+        self.latencies = []
+        self.stats = {}
+        MqttClient.__init__(self, logger, "127.0.0.1", port, [], loop_start=True)
+        self.subscribed_event.wait(TIMEOUT)
+
+    @topic_handler(BENCH_TOPIC + "/+/hello")
+    def on_hello(self, parsed_json, topic):
+        with self.condition:
+            self.hellos.setdefault(topic.split("/")[1], []).append((parsed_json["instance"], time.perf_counter()))
+            self.condition.notify_all()
+
+    @topic_handler(BENCH_TOPIC + "/+/pong")
+    def on_pong(self, parsed_json, topic):
+        now = time.perf_counter()
+        with self.condition:
+            sent = self.in_flight.pop(parsed_json["seq"], None)
+            if sent is not None:
+                self.latencies.append(now - sent)
+            self.condition.notify_all()
+
+    @topic_handler(BENCH_TOPIC + "/+/stats/reply")
+    def on_stats(self, parsed_json, topic):
+        with self.condition:
+            self.stats[topic.split("/")[1]] = parsed_json
+            self.condition.notify_all()
+
+    def wait_for(self, predicate, timeout=TIMEOUT):
+        with self.condition:
+            if not self.condition.wait_for(predicate, timeout):
+                raise Exception("Benchmark timed out")
+
+    def ping(self, service, seq, data):
+        with self.condition:
+            self.in_flight[seq] = time.perf_counter()
+        self.publish_json_mqtt({"seq": seq, "data": data}, BENCH_TOPIC + "/" + service + "/ping")
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def latency_summary(latencies):
+    latencies = sorted(latencies)
+    return {
+        "count": len(latencies),
+        "p50_ms": percentile(latencies, 0.5) * 1e3,
+        "p90_ms": percentile(latencies, 0.9) * 1e3,
+        "p99_ms": percentile(latencies, 0.99) * 1e3,
+        "max_ms": latencies[-1] * 1e3,
+    }
+
+
+def generate_workdir(workdir, names, mode):
+    """
+    Write services.conf, VERSION and the synthetic service classes with their entry points
+    """
+    with open(os.path.join(workdir, "services.conf"), "w") as services_conf:
+        for name in names:
+            services_conf.write("%s,False,mode=%s\n" % (name, mode))
+    shutil.copy(os.path.join(ROOT_DIR, "VERSION"), workdir)
+
+    with open(os.path.join(workdir, "bench_services.py"), "w") as module:
+        module.write("from synthetic_service import SyntheticService\n")
+        for name in names:
+            module.write("\n\nclass %s(SyntheticService):\n    pass\n" % name.capitalize())
+
+    dist_info = os.path.join(workdir, "bench_services-1.0.dist-info")
+    os.mkdir(dist_info)
+    with open(os.path.join(dist_info, "METADATA"), "w") as metadata:
+        metadata.write("Metadata-Version: 2.1\nName: bench-services\nVersion: 1.0\n")
+    with open(os.path.join(dist_info, "entry_points.txt"), "w") as entry_points:
+        entry_points.write("[%s]\n" % ENTRY_POINT_GROUP)
+        for name in names:
+            entry_points.write("%s = bench_services:%s\n" % (name, name.capitalize()))
+
+
+def process_memory(pid):
+    """
+    Returns the RSS of a process, in kB
+    """
+    try:
+        with open("/proc/%d/status" % pid) as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def wait_ready(notify_socket, timeout):
+    """
+    Wait for READY=1 from the Core on its sd_notify socket
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        notify_socket.settimeout(max(0.01, deadline - time.time()))
+        try:
+            if b"READY=1" in notify_socket.recv(4096):
+                return
+        except socket.timeout:
+            break
+    raise Exception("The Core didn't send READY=1")
+
+
+def measure_latency(driver, names, rounds, data):
+    driver.latencies = []
+    for seq in range(rounds):
+        driver.ping(names[seq % len(names)], seq, data)
+        driver.wait_for(lambda: not driver.in_flight)
+    return latency_summary(driver.latencies)
+
+
+def measure_throughput(driver, names, messages, window, data):
+    driver.latencies = []
+    start = time.perf_counter()
+    for seq in range(messages):
+        driver.wait_for(lambda: len(driver.in_flight) < window)
+        driver.ping(names[seq % len(names)], seq, data)
+    driver.wait_for(lambda: not driver.in_flight)
+    elapsed = time.perf_counter() - start
+    result = {"round_trips": messages, "window": window, "seconds": elapsed,
+              "round_trips_per_second": messages / elapsed,
+              # A ping and its pong go through the broker
+              "messages_per_second": 2 * messages / elapsed}
+    result.update(latency_summary(driver.latencies))
+    return result
+
+
+def measure_memory(driver, names, core_pid, mode):
+    driver.stats = {}
+    for name in names:
+        driver.publish_json_mqtt({}, BENCH_TOPIC + "/" + name + "/stats")
+    driver.wait_for(lambda: len(driver.stats) == len(names))
+    memory = {"core_rss_kb": process_memory(core_pid), "services": dict(driver.stats)}
+    if mode == "process":
+        sizes = [stats["pss_kb"] or stats["rss_kb"] for stats in driver.stats.values()]
+        memory["per_service_kb"] = sum(sizes) / len(sizes)
+    else:
+        # Services share the Core process
+        memory["per_service_kb"] = None
+    return memory
+
+
+def measure_restarts(driver, names, restarts):
+    latencies = {}
+    for name in names[:restarts]:
+        announced = len(driver.hellos[name])
+        start = time.perf_counter()
+        driver.publish_json_mqtt({}, BENCH_TOPIC + "/" + name + "/crash")
+        driver.wait_for(lambda: len(driver.hellos[name]) > announced)
+        latencies[name] = driver.hellos[name][-1][1] - start
+    return {"seconds": latencies, "max_seconds": max(latencies.values()) if latencies else None}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the Core and its services")
+    parser.add_argument("--services", type=int, default=SERVICES, help="Number of synthetic services")
+    parser.add_argument("--mode", default="thread", choices=["thread", "process"],
+                        help="How the Core hosts the services (memory per service needs process)")
+    parser.add_argument("--rounds", type=int, default=ROUNDS, help="Sequential round trips for latency")
+    parser.add_argument("--messages", type=int, default=MESSAGES, help="Round trips for throughput")
+    parser.add_argument("--window", type=int, default=WINDOW, help="Round trips in flight for throughput")
+    parser.add_argument("--payload", type=int, default=PAYLOAD_SIZE, help="Bytes of data in each ping")
+    parser.add_argument("--restarts", type=int, default=RESTARTS, help="Services crashed to time their restart")
+    parser.add_argument("--output", help="Also write the JSON results to this file")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated directory (Core log included)")
+    args = parser.parse_args()
+
+    log.CURRENT_LEVEL = log.LEVEL_ERROR
+    logger = log.Logger("bench_suite")
+    names = ["bench%d" % index for index in range(args.services)]
+    data = "x" * args.payload
+
+    broker = StubBroker()
+    port = broker.start()
+    workdir = tempfile.mkdtemp(prefix="bench_suite_")
+    generate_workdir(workdir, names, args.mode)
+    notify_path = os.path.join(workdir, "notify.sock")
+    notify_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    notify_socket.bind(notify_path)
+
+    env = dict(os.environ)
+    env.update({
+        "MQTT_HOST": "127.0.0.1",
+        "MQTT_PORT": str(port),
+        "NOTIFY_SOCKET": notify_path,
+        "FILE_LOG": os.path.join(workdir, "core.log"),
+        "METRICS_PERIOD": "0",
+        "PYTHONPATH": os.pathsep.join([workdir, BENCHMARKS_DIR] + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else [])),
+    })
+
+    driver = BenchDriver(logger, port)
+    core = None
+    try:
+        start = time.perf_counter()
+        core = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT_DIR, "main.py"), "-d", "-l", str(log.LEVEL_WARNING)],
+            cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        wait_ready(notify_socket, TIMEOUT)
+        ready = time.perf_counter() - start
+        driver.wait_for(lambda: all(name in driver.hellos for name in names))
+        services_ready = time.perf_counter() - start
+
+        results = {
+            "version": open(os.path.join(ROOT_DIR, "VERSION")).read().strip(),
+            "time": time.time(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "parameters": {"services": args.services, "mode": args.mode, "payload": args.payload},
+            "startup": {"ready_seconds": ready, "services_ready_seconds": services_ready},
+            "latency": measure_latency(driver, names, args.rounds, data),
+            "throughput": measure_throughput(driver, names, args.messages, args.window, data),
+            "memory": measure_memory(driver, names, core.pid, args.mode),
+            "restart": measure_restarts(driver, names, args.restarts),
+            "broker": broker.stats(),
+        }
+    finally:
+        if core is not None:
+            core.send_signal(signal.SIGTERM)
+            try:
+                core.wait(10)
+            except subprocess.TimeoutExpired:
+                core.kill()
+        driver.disconnect_mqtt()
+        broker.stop()
+        notify_socket.close()
+        if args.keep:
+            print("Generated files kept in " + workdir, file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
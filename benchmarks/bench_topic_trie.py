@@ -0,0 +1,83 @@
+import os
+import sys
+import time
+import random
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from broker.topic_trie import TopicTrie, topic_matches
+
+#####################################
+# Topic dispatch microbenchmark
+#
+# Compares the trie used by TopicDispatcher with a linear scan of every
+# filter, for 10k filters mixing exact topics and '+'/'#' wildcards.
+#
+# python3 benchmarks/bench_topic_trie.py
+#####################################
+
+FILTER_COUNT = 10000
+TOPIC_COUNT = 500
+
+
+def make_filters(count):
+    filters = []
+    for i in range(count):
+        kind = i % 4
+        if kind == 0:
+            filters.append("site/%d/sensor/%d/temperature" % (i % 100, i))
+        elif kind == 1:
+            filters.append("site/%d/sensor/+/humidity" % i)
+        elif kind == 2:
+            filters.append("site/+/alarm/%d" % i)
+        else:
+            filters.append("device/%d/#" % i)
+    return filters
+
+
+def make_topics(count):
+    topics = []
+    for i in range(count):
+        kind = i % 4
+        n = random.randint(0, FILTER_COUNT)
+        if kind == 0:
+            topics.append("site/%d/sensor/%d/temperature" % (n % 100, n))
+        elif kind == 1:
+            topics.append("site/%d/sensor/3/humidity" % n)
+        elif kind == 2:
+            topics.append("site/7/alarm/%d" % n)
+        else:
+            topics.append("device/%d/status/battery" % n)
+    return topics
+
+
+def bench(name, function, topics):
+    start = time.perf_counter()
+    matched = 0
+    for topic in topics:
+        matched += len(function(topic))
+    elapsed = time.perf_counter() - start
+    print("%-8s %10.2f us/message  (%d matches)" % (name, elapsed * 1e6 / len(topics), matched))
+    return matched
+
+
+def main():
+    random.seed(1)
+    filters = make_filters(FILTER_COUNT)
+    topics = make_topics(TOPIC_COUNT)
+
+    trie = TopicTrie()
+    for topic_filter in filters:
+        trie.add(topic_filter, topic_filter)
+
+    def linear(topic):
+        return [f for f in filters if topic_matches(f, topic)]
+
+    print("%d filters, %d topics" % (FILTER_COUNT, TOPIC_COUNT))
+    expected = bench("linear", linear, topics)
+    got = bench("trie", trie.match, topics)
+    assert expected == got
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+import asyncio
+import os
+import struct
+import sys
+import threading
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from broker.topic_trie import TopicTrie, topic_matches
+
+#####################################
+# Stand-in MQTT broker
+#
+# Minimal MQTT 3.1.1 broker running on an asyncio loop in a thread, so that
+# benchmarks don't need mosquitto : CONNECT, PUBLISH (QoS 0, 1 and 2 from
+# clients, always delivered with QoS 0), retained messages, SUBSCRIBE,
+# UNSUBSCRIBE, PINGREQ and DISCONNECT. No authentication, sessions, wills
+# or keep-alive checks.
+#
+# Used by bench_suite.py, or run alone for the other benchmarks :
+# python3 benchmarks/stub_broker.py [port]
+#####################################
+
+CONNECT = 0x10
+PUBLISH = 0x30
+PUBACK = 0x40
+PUBREC = 0x50
+PUBREL = 0x60
+PUBCOMP = 0x70
+SUBSCRIBE = 0x80
+SUBACK = 0x90
+UNSUBSCRIBE = 0xA0
+UNSUBACK = 0xB0
+PINGREQ = 0xC0
+PINGRESP = 0xD0
+DISCONNECT = 0xE0
+
+
+def packet(command, body=b""):
+    """
+    Returns an MQTT packet : fixed header with the remaining length, then body
+    """
+    header = bytearray([command])
+    length = len(body)
+    while True:
+        digit = length % 128
+        length //= 128
+        header.append(digit | 0x80 if length else digit)
+        if not length:
+            return bytes(header) + body
+
+
+def publish_packet(topic, payload, retain=False):
+    topic = topic.encode("utf-8")
+    return packet(PUBLISH | (1 if retain else 0), struct.pack("!H", len(topic)) + topic + payload)
+
+
+class Session(object):
+    """
+    Connection of a client, with its subscriptions
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.subscriptions = set()
+
+
+class StubBroker(object):
+
+    def __init__(self, port=0, host="127.0.0.1"):
+        """
+        :param port: Port to listen on, 0 for a free port (see start)
+        """
+        self.host = host
+        self.port = port
+        self.routes = TopicTrie()
+        self.retained = {}
+        self.sessions = set()
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.started = threading.Event()
+        self.received = 0
+        self.delivered = 0
+
+    def start(self):
+        """
+        Start listening, in a thread
+        :return: Port listened on
+        """
+        self.thread = threading.Thread(target=self.run, name="stub_broker", daemon=True)
+        self.thread.start()
+        self.started.wait()
+        return self.port
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.server = self.loop.run_until_complete(asyncio.start_server(self.serve, self.host, self.port))
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.started.set()
+        self.loop.run_forever()
+        # Stopped : let the connections end
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.close()
+
+    def stop(self):
+        def close():
+            self.server.close()
+            for session in list(self.sessions):
+                session.writer.close()
+            self.loop.stop()
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(close)
+            self.thread.join(5)
+
+    async def read_packet(self, reader):
+        command = (await reader.readexactly(1))[0]
+        multiplier = 1
+        length = 0
+        while True:
+            digit = (await reader.readexactly(1))[0]
+            length += (digit & 0x7F) * multiplier
+            multiplier *= 128
+            if not digit & 0x80:
+                break
+        body = await reader.readexactly(length) if length else b""
+        return command, body
+
+    async def serve(self, reader, writer):
+        session = Session(writer)
+        self.sessions.add(session)
+        try:
+            while True:
+                command, body = await self.read_packet(reader)
+                kind = command & 0xF0
+                if kind == CONNECT:
+                    # Session present 0, connection accepted
+                    writer.write(packet(0x20, b"\x00\x00"))
+                elif kind == PUBLISH:
+                    self.on_publish(session, command, body)
+                elif kind == PUBREL:
+                    writer.write(packet(PUBCOMP, body[:2]))
+                elif kind == SUBSCRIBE:
+                    self.on_subscribe(session, body)
+                elif kind == UNSUBSCRIBE:
+                    position = 2
+                    while position < len(body):
+                        length = struct.unpack("!H", body[position:position + 2])[0]
+                        topic_filter = body[position + 2:position + 2 + length].decode("utf-8")
+                        position += 2 + length
+                        if topic_filter in session.subscriptions:
+                            session.subscriptions.discard(topic_filter)
+                            self.routes.remove(topic_filter, session)
+                    writer.write(packet(UNSUBACK, body[:2]))
+                elif kind == PINGREQ:
+                    writer.write(packet(PINGRESP))
+                elif kind == DISCONNECT:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            # Cancelled by stop
+            pass
+        finally:
+            self.sessions.discard(session)
+            for topic_filter in session.subscriptions:
+                self.routes.remove(topic_filter, session)
+            writer.close()
+
+    def on_publish(self, session, command, body):
+        qos = (command >> 1) & 3
+        length = struct.unpack("!H", body[:2])[0]
+        topic = body[2:2 + length].decode("utf-8")
+        position = 2 + length
+        if qos:
+            packet_id = body[position:position + 2]
+            position += 2
+            session.writer.write(packet(PUBACK if qos == 1 else PUBREC, packet_id))
+        payload = body[position:]
+        if command & 1:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        self.received += 1
+        data = publish_packet(topic, payload)
+        subscribers = self.routes.match(topic)
+        for subscriber in set(subscribers) if len(subscribers) > 1 else subscribers:
+            subscriber.writer.write(data)
+            self.delivered += 1
+
+    def on_subscribe(self, session, body):
+        granted = bytearray()
+        topic_filters = []
+        position = 2
+        while position < len(body):
+            length = struct.unpack("!H", body[position:position + 2])[0]
+            topic_filter = body[position + 2:position + 2 + length].decode("utf-8")
+            granted.append(min(body[position + 2 + length], 2))
+            position += 3 + length
+            if topic_filter not in session.subscriptions:
+                session.subscriptions.add(topic_filter)
+                self.routes.add(topic_filter, session)
+            topic_filters.append(topic_filter)
+        session.writer.write(packet(SUBACK, body[:2] + bytes(granted)))
+        for topic, payload in self.retained.items():
+            if any(topic_matches(topic_filter, topic) for topic_filter in topic_filters):
+                session.writer.write(publish_packet(topic, payload, retain=True))
+
+    def stats(self):
+        return {"clients": len(self.sessions), "received": self.received, "delivered": self.delivered,
+                "retained": len(self.retained)}
+
+
+def main():
+    broker = StubBroker(int(sys.argv[1]) if len(sys.argv) > 1 else 1883)
+    print("Listening on %s:%d" % (broker.host, broker.start()))
+    try:
+        broker.thread.join()
+    except KeyboardInterrupt:
+        broker.stop()
+
+
+if __name__ == "__main__":
+    main()
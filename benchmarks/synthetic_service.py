@@ -0,0 +1,85 @@
+import os
+import sys
+import threading
+import time
+from random import getrandbits
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import *
+from services.service_base import ServiceBase
+from broker.mqtt import MqttClient
+
+#####################################
+# Synthetic service
+#
+# Service launched by the Core in bench_suite.py. bench_suite.py generates a
+# subclass per service (Bench0, Bench1...) found through an entry point, the
+# service is named after its class and answers on bench/<name>/... :
+#   ping  => echoes the message on bench/<name>/pong
+#   stats => replies its pid and memory on bench/<name>/stats
+#   crash => run() raises, so that the Core restarts the service
+# and announces every new instance on bench/<name>/hello.
+#####################################
+
+BENCH_TOPIC = "bench"
+
+
+def memory_usage():
+    """
+    Returns the resident and proportional set sizes of the process, in kB (PSS is None
+    if the kernel doesn't provide it)
+    """
+    usage = {"rss_kb": None, "pss_kb": None}
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    usage["rss_kb"] = int(line.split()[1])
+        with open("/proc/self/smaps_rollup") as smaps:
+            for line in smaps:
+                if line.startswith("Pss:"):
+                    usage["pss_kb"] = int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return usage
+
+
+class SyntheticService(MqttClient, ServiceBase):
+
+    def __init__(self, mandatory):
+        ServiceBase.__init__(self, mandatory)
+        self.name = type(self).__name__.lower()
+        self.instance = "%08x" % getrandbits(32)
+        self.crash = threading.Event()
+        self.echoed = 0
+        prefix = BENCH_TOPIC + "/" + self.name + "/"
+        MqttClient.__init__(
+            self,
+            self.logger,
+            MQTT_HOST,
+            MQTT_PORT,
+            [prefix + "ping", prefix + "stats", prefix + "crash"],
+            loop_start=True,
+        )
+        self.add_topic_handler(prefix + "ping", self.on_ping)
+        self.add_topic_handler(prefix + "stats", self.on_stats)
+        self.add_topic_handler(prefix + "crash", self.on_crash)
+
+    def on_ping(self, parsed_json, topic):
+        self.echoed += 1
+        self.publish_json_mqtt(parsed_json, BENCH_TOPIC + "/" + self.name + "/pong")
+
+    def on_stats(self, parsed_json, topic):
+        stats = {"instance": self.instance, "pid": os.getpid(), "echoed": self.echoed}
+        stats.update(memory_usage())
+        self.publish_json_mqtt(stats, BENCH_TOPIC + "/" + self.name + "/stats/reply")
+
+    def on_crash(self, parsed_json, topic):
+        self.crash.set()
+
+    def run(self):
+        self.publish_json_mqtt({"instance": self.instance, "pid": os.getpid(), "time": time.time()},
+                               BENCH_TOPIC + "/" + self.name + "/hello")
+        self.crash.wait()
+        raise Exception("Crash requested by the benchmark")
@@ -0,0 +1,154 @@
+from config import *
+from broker.topic_trie import TopicTrie
+import threading
+import time
+import sys
+
+# Reserved key of the batch envelope, only written by make_batch : a message of a service
+# with a "batch" key of its own isn't taken for a batch
+BATCH_KEY = "__batch__"
+
+
+def make_batch(messages):
+    """
+    Returns the envelope carrying several messages in a single publish
+    """
+    return {BATCH_KEY: messages}
+
+
+def unpack_batch(parsed_json):
+    """
+    Returns the messages of a batch envelope made by make_batch, or None if parsed_json isn't a batch
+    """
+    if type(parsed_json) is dict and len(parsed_json) == 1:
+        messages = parsed_json.get(BATCH_KEY)
+        if type(messages) is list:
+            return messages
+    return None
+
+
+class BatchPublisher(object):
+    """
+    Collects messages per topic and publishes them as one batch envelope, when the topic
+    has max_count messages waiting or window seconds after its first waiting message.
+
+    On coalesced topics (state topics) only the latest message is kept : it replaces the
+    previous one and is published alone at the end of the window.
+    """
+
+    def __init__(self, logger, send, window=0.05, max_count=100, coalesce_topics=()):
+        """
+        :param logger: Logger of the owning client
+        :param send: Callable taking (topic, obj), publishing obj on topic
+        :param window: Maximum time a message waits before being published, in seconds
+        :param max_count: Number of waiting messages triggering a publish
+        :param coalesce_topics: Topic filters on which only the latest message is published
+        """
+        self.logger = logger
+        self.send = send
+        self.window = window
+        self.max_count = max(1, max_count)
+        self.coalesce_topics = TopicTrie()
+        for topic_filter in coalesce_topics:
+            self.coalesce_topics.add(topic_filter, True)
+
+        self.buffers = {}
+        self.deadlines = {}
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.running = True
+
+        self.batches_sent = 0
+        self.messages_batched = 0
+        self.messages_coalesced = 0
+
+        self.thread = threading.Thread(target=self.run, name="batch_publisher", daemon=True)
+        self.thread.start()
+
+    def add(self, topic, obj):
+        """
+        Queue obj for topic
+        :return:
+        """
+        full = False
+        with self.lock:
+            buffer = self.buffers.get(topic)
+            if buffer is None:
+                buffer = []
+                self.buffers[topic] = buffer
+                self.deadlines[topic] = time.time() + self.window
+                self.wakeup.notify()
+            if buffer and self.coalesce_topics.match(topic):
+                buffer[-1] = obj
+                self.messages_coalesced += 1
+            else:
+                buffer.append(obj)
+            full = len(buffer) >= self.max_count
+        if full:
+            self.flush([topic])
+
+    def take(self, topic):
+        del self.deadlines[topic]
+        return self.buffers.pop(topic)
+
+    def publish(self, topic, messages):
+        try:
+            if len(messages) == 1:
+                self.send(topic, messages[0])
+            else:
+                self.send(topic, make_batch(messages))
+            self.batches_sent += 1
+            self.messages_batched += len(messages)
+        except Exception as e:
+            import traceback
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            exceptionStr = (
+                    os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+                    + ", line "
+                    + str(exc_tb.tb_lineno)
+                    + " : "
+                    + str(e) +
+                    "".join(traceback.format_tb(e.__traceback__))
+            )
+            self.logger.e(exceptionStr)
+
+    def flush(self, topics=None):
+        """
+        Publish waiting messages now, of the given topics or of every topic
+        """
+        # Publishes are serialized so that batches of a topic can't overtake each other
+        with self.send_lock:
+            with self.lock:
+                if topics is None:
+                    topics = list(self.buffers)
+                ready = [(topic, self.take(topic)) for topic in topics if topic in self.buffers]
+            for topic, messages in ready:
+                self.publish(topic, messages)
+
+    def run(self):
+        while self.running:
+            with self.lock:
+                now = time.time()
+                expired = [topic for topic, deadline in self.deadlines.items() if deadline <= now]
+                if not expired:
+                    if self.deadlines:
+                        self.wakeup.wait(min(self.deadlines.values()) - now)
+                    else:
+                        self.wakeup.wait()
+                    continue
+            self.flush(expired)
+
+    def stats(self):
+        return {
+            "batches_sent": self.batches_sent,
+            "messages_batched": self.messages_batched,
+            "messages_coalesced": self.messages_coalesced,
+            "waiting": sum(len(buffer) for buffer in self.buffers.values()),
+        }
+
+    def stop(self):
+        self.flush()
+        with self.lock:
+            self.running = False
+            self.wakeup.notify()
@@ -0,0 +1,160 @@
+from broker.topic_trie import TopicTrie
+import json
+
+"""
+    Payload codecs used by MqttClient to encode published objects and decode received ones.
+
+    JSON payloads are sent as is, so that any MQTT client can read them. Binary codecs
+    prefix the payload with a marker byte (MQTT 3.1.1 has no content-type property) that
+    can never start a JSON document, so a receiver picks the right decoder whatever codec
+    the sender was configured with.
+
+    orjson, msgpack and cbor2 are optional : their codec is only registered if the
+    package is installed.
+"""
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+MARKER_MSGPACK = 0x01
+MARKER_CBOR = 0x02
+
+
+class JsonCodec(object):
+    """
+    Standard library json, the default and fallback codec
+    """
+    name = "json"
+    marker = None
+
+    def encode(self, obj):
+        return json.dumps(obj).encode("utf-8")
+
+    def decode(self, payload):
+        return json.loads(payload.decode("utf-8"))
+
+
+class OrjsonCodec(object):
+    """
+    Same wire format as JsonCodec, several times faster
+    """
+    name = "orjson"
+    marker = None
+
+    def encode(self, obj):
+        return orjson.dumps(obj)
+
+    def decode(self, payload):
+        return orjson.loads(payload)
+
+
+class MsgpackCodec(object):
+    name = "msgpack"
+    marker = MARKER_MSGPACK
+
+    def encode(self, obj):
+        return bytes((MARKER_MSGPACK,)) + msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, payload):
+        return msgpack.unpackb(payload[1:], raw=False)
+
+
+class CborCodec(object):
+    name = "cbor"
+    marker = MARKER_CBOR
+
+    def encode(self, obj):
+        return bytes((MARKER_CBOR,)) + cbor2.dumps(obj)
+
+    def decode(self, payload):
+        return cbor2.loads(payload[1:])
+
+
+codecs = {}
+codecs_by_marker = {}
+
+
+def register_codec(codec):
+    """
+    Make a codec available by its name. A codec with a marker byte is also used to
+    decode every payload starting with it.
+    """
+    codecs[codec.name] = codec
+    if codec.marker is not None:
+        codecs_by_marker[codec.marker] = codec
+
+
+def get_codec(name):
+    """
+    Returns the codec registered under name
+    Raises ValueError if it is unknown, or if its package isn't installed.
+    """
+    try:
+        return codecs[name]
+    except KeyError:
+        raise ValueError("Codec " + str(name) + " is not available, registered codecs : " + ", ".join(codecs))
+
+
+register_codec(JsonCodec())
+if orjson is not None:
+    register_codec(OrjsonCodec())
+if msgpack is not None:
+    register_codec(MsgpackCodec())
+if cbor2 is not None:
+    register_codec(CborCodec())
+
+
+class CodecTable(object):
+    """
+    Codec selection of one client : a default codec and optional codecs per topic filter
+    """
+
+    def __init__(self, codec="json", topic_codecs=None):
+        """
+        :param codec: Name of the codec used to publish
+        :param topic_codecs: dict of topic filter => codec name, overriding codec for matching topics
+        """
+        self.codec = get_codec(codec)
+        # Unmarked payloads are JSON : decoded with the default codec if it is a JSON one
+        self.json_codec = self.codec if self.codec.marker is None else codecs["json"]
+        self.topic_codecs = None
+        if topic_codecs:
+            self.topic_codecs = TopicTrie()
+            for topic_filter, name in topic_codecs.items():
+                self.topic_codecs.add(topic_filter, get_codec(name))
+
+    def codec_for(self, topic):
+        if self.topic_codecs is not None:
+            matched = self.topic_codecs.match(topic)
+            if matched:
+                return matched[0]
+        return self.codec
+
+    def encode(self, topic, obj):
+        """
+        Encode obj with the codec chosen for topic
+        :return: bytes
+        """
+        return self.codec_for(topic).encode(obj)
+
+    def decode(self, payload):
+        """
+        Decode a received payload, using its marker byte to find the codec
+        """
+        if payload:
+            codec = codecs_by_marker.get(payload[0])
+            if codec is not None:
+                return codec.decode(payload)
+        return self.json_codec.decode(payload)
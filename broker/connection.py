@@ -0,0 +1,259 @@
+from config import *
+from metrics import metrics, metric_key
+import paho.mqtt.client as mqtt
+import random
+import socket
+import threading
+import time
+import sys
+
+LINK_UP = "up"
+# Connected to another broker than the first of the list
+LINK_DEGRADED = "degraded"
+LINK_DOWN = "down"
+
+# A broker must accept a TCP connection within PROBE_TIMEOUT and answer CONNECT within
+# CONNECT_TIMEOUT, otherwise the next one is tried
+PROBE_TIMEOUT = 1.0
+CONNECT_TIMEOUT = 3.0
+# Delay before trying the brokers again once all of them failed : RECONNECT_DELAY_MIN * 2^n
+# (+/- RECONNECT_JITTER) up to RECONNECT_DELAY_MAX
+RECONNECT_DELAY_MIN = 0.5
+RECONNECT_DELAY_MAX = 30
+RECONNECT_JITTER = 0.2
+# While connected to a fallback broker, the first broker is probed this often to go back to it
+FAILBACK_PERIOD = 30
+KEEPALIVE = 10
+
+
+def parse_brokers(brokers):
+    """
+    Returns [(host, port)] from "host:port,host:port" or from a list of "host:port" / (host, port)
+    """
+    if isinstance(brokers, str):
+        brokers = [broker for broker in brokers.split(",") if broker.strip()]
+    endpoints = []
+    for broker in brokers:
+        if isinstance(broker, str):
+            host, _, port = broker.strip().rpartition(":")
+            broker = (host, int(port)) if host else (port, 1883)
+        endpoints.append((broker[0], int(broker[1])))
+    return endpoints
+
+
+def probe(endpoint, timeout=PROBE_TIMEOUT):
+    """
+    Returns True if endpoint accepts TCP connections
+    """
+    try:
+        socket.create_connection(endpoint, timeout).close()
+        return True
+    except (OSError, ValueError):
+        return False
+
+
+def set_nodelay(client):
+    """
+    Disable Nagle's algorithm on the socket of a connected paho client : small publishes
+    (requests, replies) must not wait for it
+    """
+    client.socket().setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class ConnectionManager(object):
+    """
+    Keeps a paho client connected to one of several brokers, from its own network thread.
+
+    Brokers are tried in order, each one being probed before paho connects to it. When the
+    link is lost the current broker is tried first, then the others. Once every broker failed,
+    attempts are spaced with an exponential backoff. While connected to a fallback broker the
+    first one is probed regularly, and used again as soon as it is back.
+    """
+
+    def __init__(self, logger, client, endpoints, on_connect, on_disconnect=None, on_link_state=None,
+                 name="", keepalive=KEEPALIVE):
+        """
+        :param logger: Logger of the owning client
+        :param client: paho client, its on_connect/on_disconnect callbacks are taken over
+        :param endpoints: [(host, port)], by order of preference
+        :param on_connect: Paho on_connect callback, called once connected
+        :param on_disconnect: Paho on_disconnect callback
+        :param on_link_state: Called with (state, (host, port)) when the link goes up, degraded or down
+        :param name: Service name used in metrics
+        """
+        if not endpoints:
+            raise ValueError("No broker to connect to")
+        self.logger = logger
+        self.client = client
+        self.endpoints = endpoints
+        self.user_on_connect = on_connect
+        self.user_on_disconnect = on_disconnect
+        self.on_link_state = on_link_state
+        self.keepalive = keepalive
+
+        self.current = 0
+        self.connected = False
+        self.state = LINK_DOWN
+        self.running = True
+        self.down_since = time.time()
+        self.reconnects = 0
+        self.failovers = 0
+        self.downtime = 0.0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+
+        self.metric_keys = {
+            "link_up": metric_key("mqtt_link_up", service=name),
+            "reconnects": metric_key("mqtt_reconnects_total", service=name),
+            "failovers": metric_key("mqtt_failovers_total", service=name),
+            "connect_failures": metric_key("mqtt_connect_failures_total", service=name),
+            "downtime": metric_key("mqtt_downtime_seconds", service=name),
+        }
+
+        client.on_connect = self.handle_connect
+        client.on_disconnect = self.handle_disconnect
+        self.thread = threading.Thread(target=self.run, name="mqtt_connection", daemon=True)
+        self.thread.start()
+
+    def handle_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            self.logger.w("Broker %s:%d refused the connection (%s)", self.endpoints[self.current][0],
+                          self.endpoints[self.current][1], rc)
+            return
+        self.connected = True
+        self.user_on_connect(client, userdata, flags, rc)
+
+    def handle_disconnect(self, client, userdata, rc):
+        self.connected = False
+        if self.user_on_disconnect is not None:
+            self.user_on_disconnect(client, userdata, rc)
+
+    def set_state(self, state):
+        if state == self.state:
+            return
+        self.state = state
+        metrics.set_gauge(self.metric_keys["link_up"], 0 if state == LINK_DOWN else 1)
+        self.logger.i("Broker link is %s (%s:%d)", state, self.endpoints[self.current][0],
+                      self.endpoints[self.current][1])
+        if self.on_link_state is not None:
+            try:
+                self.on_link_state(state, self.endpoints[self.current])
+            except Exception as e:
+                import traceback
+                exc_type, exc_obj, exc_tb = sys.exc_info()
+                exceptionStr = (
+                        os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+                        + ", line "
+                        + str(exc_tb.tb_lineno)
+                        + " : "
+                        + str(e) +
+                        "".join(traceback.format_tb(e.__traceback__))
+                )
+                self.logger.e(exceptionStr)
+
+    def connect(self, index):
+        """
+        Connect to endpoint index and wait for CONNACK
+        :return: True if connected
+        """
+        endpoint = self.endpoints[index]
+        if not probe(endpoint):
+            return False
+        self.current = index
+        try:
+            self.client.connect(endpoint[0], endpoint[1], self.keepalive)
+        except (OSError, ValueError):
+            return False
+        deadline = time.time() + CONNECT_TIMEOUT
+        while self.running and not self.connected and time.time() < deadline:
+            if self.client.loop(0.1) != mqtt.MQTT_ERR_SUCCESS:
+                break
+        if not self.connected:
+            self.client.disconnect()
+            self.client.loop(0)
+        return self.connected
+
+    def connect_any(self):
+        """
+        Try the current broker, then the others in order
+        :return: True if connected
+        """
+        count = len(self.endpoints)
+        for index in [(self.current + offset) % count for offset in range(count)]:
+            if not self.running:
+                return False
+            previous = self.current
+            if self.connect(index):
+                if index != previous:
+                    self.failovers += 1
+                    metrics.inc(self.metric_keys["failovers"])
+                return True
+            metrics.inc(self.metric_keys["connect_failures"])
+            self.logger.w("Broker %s:%d is unreachable", self.endpoints[index][0], self.endpoints[index][1])
+        return False
+
+    def backoff(self, attempt):
+        delay = min(RECONNECT_DELAY_MAX, RECONNECT_DELAY_MIN * 2 ** attempt)
+        return delay * random.uniform(1 - RECONNECT_JITTER, 1 + RECONNECT_JITTER)
+
+    def run(self):
+        attempt = 0
+        first = True
+        while self.running:
+            if not self.connect_any():
+                with self.lock:
+                    self.wakeup.wait(self.backoff(attempt))
+                attempt += 1
+                continue
+
+            attempt = 0
+            downtime = time.time() - self.down_since
+            if not first:
+                # Downtime of the first connection is the startup, not an outage
+                self.reconnects += 1
+                self.downtime += downtime
+                metrics.inc(self.metric_keys["reconnects"])
+                metrics.observe(self.metric_keys["downtime"], downtime)
+                self.logger.i("Reconnected after %.2f s", downtime)
+            first = False
+            self.set_state(LINK_UP if self.current == 0 else LINK_DEGRADED)
+
+            next_failback = time.time() + FAILBACK_PERIOD
+            failback = False
+            while self.running and self.connected:
+                if self.client.loop(0.2) != mqtt.MQTT_ERR_SUCCESS:
+                    break
+                if self.current != 0 and time.time() >= next_failback:
+                    next_failback = time.time() + FAILBACK_PERIOD
+                    if probe(self.endpoints[0]):
+                        self.logger.i("First broker is back, leaving fallback broker")
+                        self.client.disconnect()
+                        self.client.loop(0)
+                        failback = True
+
+            self.connected = False
+            self.down_since = time.time()
+            if self.running:
+                self.set_state(LINK_DOWN)
+            if failback:
+                self.current = 0
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "broker": "%s:%d" % self.endpoints[self.current],
+            "reconnects": self.reconnects,
+            "failovers": self.failovers,
+            "downtime": self.downtime + (time.time() - self.down_since if self.state == LINK_DOWN else 0),
+        }
+
+    def stop(self):
+        """
+        Disconnect and stop the network thread
+        """
+        with self.lock:
+            self.running = False
+            self.wakeup.notify()
+        if self.connected:
+            self.client.disconnect()
+        self.thread.join(CONNECT_TIMEOUT + PROBE_TIMEOUT)
@@ -0,0 +1,161 @@
+from broker.topic_trie import TopicTrie
+from broker.schema import SchemaError
+import os
+import sys
+
+# Returned by TopicDispatcher.argument for a message rejected by the schema of a handler
+REJECTED = object()
+
+
+def topic_handler(*topic_filters, schema=None):
+    """
+    Decorator declaring a service method as the handler of one or more topic filters.
+    The method is called with (parsed_json, topic) for every message matching one of them,
+    and the filters are subscribed automatically by MqttClient.
+    With a Schema, the method is called with the Message built from parsed_json instead,
+    and messages not matching the schema are rejected.
+
+        @topic_handler("sensors/+/temperature", "alarms/#")
+        def on_sensor(self, parsed_json, topic):
+            ...
+    """
+    def decorator(method):
+        filters = list(getattr(method, "topic_filters", []))
+        filters.extend(topic_filters)
+        method.topic_filters = filters
+        if schema is not None:
+            method.message_schema = schema
+        return method
+    return decorator
+
+
+class TopicDispatcher(object):
+    """
+    Per-client dispatch table routing messages to handlers by topic filter
+    """
+
+    def __init__(self, logger=None):
+        """
+        :param logger: Logger of the owning client, errors of the handlers are logged to it
+        """
+        self.logger = logger
+        self.handlers = TopicTrie()
+        self.topic_filters = []
+        # handler => Schema of its messages
+        self.schemas = {}
+        # Called with (topic, SchemaError) when a message is rejected by a schema
+        self.on_rejected = None
+        self.rejected = 0
+        # Called with (topic, exception) when a handler raises
+        self.on_error = None
+        self.errors = 0
+
+    @classmethod
+    def from_instance(cls, instance):
+        """
+        Build a dispatcher from the methods of instance decorated with topic_handler
+        """
+        dispatcher = cls(getattr(instance, "logger", None))
+        seen = set()
+        for klass in type(instance).__mro__:
+            for name, attribute in vars(klass).items():
+                if name in seen:
+                    continue
+                seen.add(name)
+                for topic_filter in getattr(attribute, "topic_filters", []):
+                    dispatcher.add(topic_filter, getattr(instance, name), getattr(attribute, "message_schema", None))
+        return dispatcher
+
+    def add(self, topic_filter, handler, schema=None):
+        """
+        Register handler on topic_filter
+        :param topic_filter: Subscription filter, may contain '+' and '#'
+        :param handler: Callable taking (parsed_json, topic), or (message, topic) with a schema
+        :param schema: Schema of the messages given to handler
+        :return:
+        """
+        if schema is not None:
+            self.schemas[handler] = schema
+        self.handlers.add(topic_filter, handler)
+        if topic_filter not in self.topic_filters:
+            self.topic_filters.append(topic_filter)
+
+    def remove(self, topic_filter, handler):
+        """
+        Unregister handler from topic_filter
+        :return: True if handler was registered
+        """
+        removed = self.handlers.remove(topic_filter, handler)
+        if removed and not self.handlers.get(topic_filter):
+            self.topic_filters.remove(topic_filter)
+        return removed
+
+    def match(self, topic):
+        """
+        Returns the handlers matching topic. A handler declared on overlapping filters
+        is only returned once.
+        """
+        handlers = []
+        for handler in self.handlers.match(topic):
+            if handler not in handlers:
+                handlers.append(handler)
+        return handlers
+
+    def dispatch(self, parsed_json, topic):
+        """
+        Call every handler matching topic. An exception raised by a handler is logged and
+        doesn't prevent the other handlers from being called.
+        :return: False if no handler matched, so the caller can fall back to parse_mqtt
+        """
+        handlers = self.match(topic)
+        messages = {} if self.schemas else None
+        for handler in handlers:
+            try:
+                message = self.argument(handler, parsed_json, topic, messages)
+                if message is not REJECTED:
+                    handler(message, topic)
+            except Exception as e:
+                self.error(topic, e)
+        return len(handlers) > 0
+
+    def argument(self, handler, parsed_json, topic, messages):
+        """
+        Returns what handler must be called with : parsed_json, or the Message of its schema.
+        REJECTED if parsed_json doesn't match the schema.
+        :param messages: dict caching messages by schema for one parsed_json, None if there is no schema
+        """
+        schema = self.schemas.get(handler) if messages is not None else None
+        if schema is None:
+            return parsed_json
+        # A message is loaded once per schema, whatever the number of handlers using it
+        message = messages.get(schema)
+        if message is None:
+            try:
+                message = schema.load(parsed_json)
+            except SchemaError as e:
+                self.reject(topic, e)
+                message = REJECTED
+            messages[schema] = message
+        return message
+
+    def error(self, topic, e):
+        self.errors += 1
+        if self.logger is not None:
+            import traceback
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            exceptionStr = (
+                    os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+                    + ", line "
+                    + str(exc_tb.tb_lineno)
+                    + " : "
+                    + str(e) +
+                    "".join(traceback.format_tb(e.__traceback__))
+            )
+            self.logger.e(exceptionStr)
+        if self.on_error is not None:
+            self.on_error(topic, e)
+
+    def reject(self, topic, error):
+        self.rejected += 1
+        if self.on_rejected is not None:
+            self.on_rejected(topic, error)
@@ -0,0 +1,153 @@
+from config import *
+from collections import deque
+import threading
+import time
+import sys
+
+OVERFLOW_BLOCK = "block"
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+OVERFLOW_DROP_NEWEST = "drop_newest"
+OVERFLOW_POLICIES = [OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST]
+
+
+class LatencyStat(object):
+    """
+    Count, mean and max of a duration, in seconds
+    """
+    __slots__ = ("count", "total", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "max": self.max,
+        }
+
+
+class InboundQueue(object):
+    """
+    Bounded queue between paho's network thread and the message handler, emptied by a pool
+    of worker threads. With more than one worker, messages may be handled out of order.
+    """
+
+    def __init__(self, logger, handler, maxsize, workers=1, policy=OVERFLOW_BLOCK):
+        """
+        Create the queue and start its workers
+        :param logger: Logger of the owning client
+        :param handler: Callable taking one queued item
+        :param maxsize: Maximum number of queued items
+        :param workers: Number of worker threads calling handler
+        :param policy: What to do when the queue is full :
+                       block (network thread waits), drop_oldest or drop_newest
+        """
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy : " + str(policy))
+        self.logger = logger
+        self.handler = handler
+        self.maxsize = max(1, maxsize)
+        self.policy = policy
+        self.items = deque()
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.running = True
+
+        self.max_depth = 0
+        self.dropped = 0
+        self.blocked = 0
+        self.wait_latency = LatencyStat()
+        self.handler_latency = LatencyStat()
+
+        self.workers = []
+        for index in range(max(1, workers)):
+            worker = threading.Thread(target=self.work, name="inbound_" + str(index), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def put(self, item):
+        """
+        Queue an item, applying the overflow policy if the queue is full
+        :return: False if the item was dropped
+        """
+        with self.lock:
+            if len(self.items) >= self.maxsize:
+                if self.policy == OVERFLOW_DROP_NEWEST:
+                    self.dropped += 1
+                    return False
+                elif self.policy == OVERFLOW_DROP_OLDEST:
+                    self.items.popleft()
+                    self.dropped += 1
+                else:
+                    self.blocked += 1
+                    while len(self.items) >= self.maxsize and self.running:
+                        self.not_full.wait()
+            self.items.append((time.time(), item))
+            if len(self.items) > self.max_depth:
+                self.max_depth = len(self.items)
+            self.not_empty.notify()
+        return True
+
+    def work(self):
+        while True:
+            with self.lock:
+                while not self.items and self.running:
+                    self.not_empty.wait()
+                if not self.running:
+                    return
+                queued_at, item = self.items.popleft()
+                self.not_full.notify()
+
+            start = time.time()
+            try:
+                self.handler(item)
+            except Exception as e:
+                import traceback
+                exc_type, exc_obj, exc_tb = sys.exc_info()
+                exceptionStr = (
+                        os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+                        + ", line "
+                        + str(exc_tb.tb_lineno)
+                        + " : "
+                        + str(e) +
+                        "".join(traceback.format_tb(e.__traceback__))
+                )
+                self.logger.e(exceptionStr)
+            end = time.time()
+
+            with self.lock:
+                self.wait_latency.add(start - queued_at)
+                self.handler_latency.add(end - start)
+
+    def stats(self):
+        """
+        Returns queue depth, drop counts and latencies (seconds) to size the queue under load
+        """
+        with self.lock:
+            return {
+                "depth": len(self.items),
+                "max_depth": self.max_depth,
+                "maxsize": self.maxsize,
+                "workers": len(self.workers),
+                "policy": self.policy,
+                "dropped": self.dropped,
+                "blocked": self.blocked,
+                "queue_wait": self.wait_latency.as_dict(),
+                "handler": self.handler_latency.as_dict(),
+            }
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
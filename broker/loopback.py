@@ -0,0 +1,153 @@
+from config import *
+from broker.topic_trie import TopicTrie
+from collections import OrderedDict
+from random import getrandbits
+import threading
+import time
+
+# Subscribers decode their own copy of the encoded payload, as if it came from the broker
+LOOPBACK_DECODE = "decode"
+# Subscribers receive the published object itself : no copy, handlers must not modify it
+LOOPBACK_SHARE = "share"
+LOOPBACK_MODES = [LOOPBACK_DECODE, LOOPBACK_SHARE]
+
+# Reserved envelope key holding the id of a message delivered by the bus ("<bus id>/<seq>"). The
+# copy sent back by the broker to the clients it was delivered to is dropped. Clients with loopback
+# remove the key before the message reaches handlers, others receive it like any other key.
+LOOPBACK_KEY = "__loopback__"
+# Size of the inbound queue given to loopback clients which don't have one
+LOOPBACK_QUEUE_SIZE = 10000
+# Seconds and number of messages the bus waits for the broker copies of the messages it delivered
+# (a spooled or rate limited publish may come back late, or never)
+LOOPBACK_ECHO_TIMEOUT = 600
+LOOPBACK_ECHO_MAX = 100000
+
+
+class LoopbackMessage(object):
+    """
+    Message delivered by the bus, handled by MqttClient.handle_message like a paho MQTTMessage
+    """
+    __slots__ = ("topic", "payload", "obj", "qos", "retain")
+
+    def __init__(self, topic, payload, obj=None, qos=0, retain=False):
+        """
+        :param payload: Encoded payload
+        :param obj: Decoded payload, None to decode payload
+        """
+        self.topic = topic
+        self.payload = payload
+        self.obj = obj
+        self.qos = qos
+        self.retain = retain
+
+
+class LoopbackBus(object):
+    """
+    Process-wide bus delivering messages between the clients of a process without the broker.
+
+    Clients with loopback enabled register their subscriptions here. When one of them publishes
+    an object on a topic other local clients subscribe to, the object is queued right away to
+    those subscribers, marked with a message id, and still published to the broker for subscribers
+    of other processes. The copy the broker sends back to the clients the message was delivered
+    to is dropped.
+    """
+
+    def __init__(self):
+        self.id = "%d-%08x" % (os.getpid(), getrandbits(32))
+        self.prefix = self.id + "/"
+        self.seq = 0
+        self.routes = TopicTrie()
+        self.lock = threading.Lock()
+        # message id => [deadline, clients the message was delivered to, whose broker copy is expected]
+        self.pending = OrderedDict()
+        self.delivered = 0
+        self.echoes = 0
+
+    def update(self, client, to_subscribe, to_unsubscribe):
+        """
+        Change the subscriptions of client on the bus
+        :param to_subscribe: [(topic, qos)]
+        :param to_unsubscribe: [topic]
+        """
+        with self.lock:
+            for topic, qos in to_subscribe:
+                if client not in self.routes.get(topic):
+                    self.routes.add(topic, client)
+            for topic in to_unsubscribe:
+                self.routes.remove(topic, client)
+
+    def subscribers(self, topic):
+        """
+        Returns the clients subscribed to topic, once each
+        """
+        with self.lock:
+            members = self.routes.match(topic)
+        if len(members) > 1:
+            members = list(dict.fromkeys(members))
+        return members
+
+    def message_id(self):
+        """
+        Returns a new id to mark a message with (LOOPBACK_KEY)
+        """
+        with self.lock:
+            self.seq += 1
+            return self.prefix + str(self.seq)
+
+    def owns(self, message_id):
+        """
+        Returns True if message_id was given by this bus
+        """
+        return type(message_id) is str and message_id.startswith(self.prefix)
+
+    def deliver(self, members, topic, obj, payload, qos=0, retain=False):
+        """
+        Queue a published message to local subscribers, decoded or shared as each of them asked
+        :param members: Result of subscribers(topic)
+        :param obj: Published object, carrying LOOPBACK_KEY
+        :param payload: obj encoded by the publisher
+        """
+        if not members:
+            return
+        message_id = obj[LOOPBACK_KEY]
+        now = time.time()
+        with self.lock:
+            self.pending[message_id] = [now + LOOPBACK_ECHO_TIMEOUT, set(members)]
+            while self.pending:
+                oldest = next(iter(self.pending.values()))
+                if oldest[0] > now and len(self.pending) <= LOOPBACK_ECHO_MAX:
+                    break
+                self.pending.popitem(last=False)
+        shared = None
+        for member in members:
+            if member.loopback == LOOPBACK_SHARE:
+                if shared is None:
+                    # Handlers don't see the message id
+                    shared = dict(obj)
+                    del shared[LOOPBACK_KEY]
+                member.on_loopback(LoopbackMessage(topic, payload, shared, qos, retain))
+            else:
+                member.on_loopback(LoopbackMessage(topic, payload, None, qos, retain))
+        self.delivered += len(members)
+
+    def is_echo(self, member, message_id):
+        """
+        Returns True if a message received from the broker by member was already delivered to it by this bus
+        :param message_id: LOOPBACK_KEY of the message
+        """
+        with self.lock:
+            entry = self.pending.get(message_id)
+            if entry is None or member not in entry[1]:
+                return False
+            entry[1].discard(member)
+            if not entry[1]:
+                del self.pending[message_id]
+            self.echoes += 1
+            return True
+
+    def stats(self):
+        return {"id": self.id, "subscriptions": len(self.routes), "delivered": self.delivered, "echoes": self.echoes,
+                "pending_echoes": len(self.pending)}
+
+
+loopback_bus = LoopbackBus()
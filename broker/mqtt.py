@@ -1,9 +1,28 @@
 import paho.mqtt.client as mqtt
 from config import *
-import json
+from broker.pool import get_shared_pool
+from broker.dispatch import TopicDispatcher
+from broker.codecs import CodecTable
+from broker.batching import BatchPublisher, unpack_batch
+from broker.inbound_queue import InboundQueue, OVERFLOW_BLOCK
+from metrics import metrics, metric_key
+from tracing import tracer, TRACE_KEY
+from broker.rpc import PendingCalls, make_request, make_reply, reply_topic
+from broker.spool import DiskSpool, SpoolDrainer, SPOOL_DROP_OLDEST
+from broker.connection import ConnectionManager, parse_brokers, set_nodelay
+from broker.subscriptions import SubscriptionSet, SubackWaiter, batches, SUBACK_FAILURE
+from broker.loopback import loopback_bus, LoopbackMessage, LOOPBACK_KEY, LOOPBACK_MODES, LOOPBACK_QUEUE_SIZE
+from broker.state_cache import StateCache, StateView
+from broker.rate_limit import RateLimiter, RATE_BLOCK, service_limits, get_global_budget
+from concurrent.futures import Future
+from random import getrandbits
 import threading
+import time
 import sys
 
+# Threads calling on_message (paho network loops, pool and connection manager threads)
+network_threads = set()
+
 
 class MqttClient:
     """
@@ -18,51 +37,255 @@ class MqttClient:
         topic_list,
         loop_start=False,
         topic_list_unsubscribe=[],
+        pool=None,
+        inbound_queue_size=0,
+        inbound_workers=1,
+        overflow_policy=OVERFLOW_BLOCK,
+        codec="json",
+        topic_codecs=None,
+        batch_window=0.05,
+        batch_max=100,
+        coalesce_topics=(),
+        spool_dir=None,
+        spool_max_bytes=MQTT_SPOOL_MAX_BYTES,
+        spool_rate=MQTT_SPOOL_RATE,
+        spool_policy=SPOOL_DROP_OLDEST,
+        brokers=None,
+        loopback=None,
+        state_deltas=False,
+        state_snapshot_period=STATE_SNAPSHOT_PERIOD,
+        rate_limit=0,
+        rate_burst=None,
+        rate_policy=RATE_BLOCK,
+        topic_rate_limits=None,
+        shared_segment_size=MQTT_SHARED_SEGMENT_SIZE,
+        shared_lease=MQTT_SHARED_LEASE,
     ):
         """
         Create an Mqtt client
         :param mqtt_host: Address of mqtt server
         :param mqtt_port: Port to connect to server
-        :param topic_list: List of topics to subscribe to
+        :param topic_list: Topics to subscribe to : topic filters (QoS 0), (topic, qos) pairs or a SubscriptionSet
         :param loop_start: If true, loop_start will be called on mqtt client. This will
                            launch a thread waiting for mqtt messages on subscribed topics.
+        :param pool: MqttConnectionPool to share a broker connection with other clients.
+                     If None, the process-wide pool is used when MQTT_POOL_SIZE > 0,
+                     otherwise the client opens its own connection. Can't be used with brokers.
+        :param inbound_queue_size: If > 0, received messages are queued (up to this size) and
+                                   handled by worker threads instead of paho's network thread
+        :param inbound_workers: Number of worker threads emptying the inbound queue
+        :param overflow_policy: block, drop_oldest or drop_newest when the inbound queue is full
+        :param codec: Payload codec used to publish : json (default), orjson, msgpack or cbor
+        :param topic_codecs: dict of topic filter => codec name, overriding codec for matching topics
+        :param batch_window: Maximum time a message given to publish_mqtt_batched waits, in seconds
+        :param batch_max: Number of waiting messages on a topic triggering a batch publish
+        :param coalesce_topics: Topic filters on which batched publishes only send the latest message
+        :param spool_dir: Directory where publishes are kept while the broker is unreachable. By default
+                          MQTT_SPOOL_DIR/<class name> if MQTT_SPOOL_DIR is set, otherwise there is no spool.
+                          With a spool, the client doesn't need the broker to be up to be created.
+        :param spool_max_bytes: Maximum size of the spool files
+        :param spool_rate: Maximum spooled messages published per second after reconnection, 0 for no limit
+        :param spool_policy: drop_oldest or drop_newest when the spool is full
+        :param brokers: Brokers to fail over between, "host:port,host:port" or a list, by order of preference.
+                        Replaces mqtt_host/mqtt_port, MQTT_BROKERS by default. The connection is then
+                        kept by a ConnectionManager thread, whatever loop_start is. Not available with a pool.
+        :param loopback: decode or share to exchange messages with the other loopback clients of the process
+                         without the broker, "" to disable. MQTT_LOOPBACK by default. Received messages then
+                         go through the inbound queue (created with one worker if inbound_queue_size is 0).
+        :param state_deltas: publish_state sends the changes of a state instead of the full state
+        :param state_snapshot_period: With state_deltas, maximum seconds between a change and the next full state
+        :param rate_limit: Maximum publishes per second of the client, 0 for no limit
+        :param rate_burst: Publishes allowed at once, rate_limit by default
+        :param rate_policy: block, drop or coalesce (only the latest message of a topic waits) a publish over a limit
+        :param topic_rate_limits: dict topic filter => publishes per second or (rate, burst, policy) on matching topics.
+                                  The rate options of the service in services.conf replace the rate arguments.
+        :param shared_segment_size: Bytes of the shared memory segments written by publish_shared
+        :param shared_lease: Seconds a payload given to publish_shared stays readable if its consumers don't release it
         """
         self.logger = logger
+        self.codecs = CodecTable(codec, topic_codecs)
         self.command = None
         self.data = None
-        self.topic_list = topic_list
+        # Handlers declared with @topic_handler are subscribed with the other topics
+        self.dispatcher = TopicDispatcher.from_instance(self)
+        self.subscriptions = SubscriptionSet(topic_list)
+        for topic in self.dispatcher.topic_filters:
+            if topic not in self.subscriptions:
+                self.subscriptions.add(topic)
+        # Subscriptions sent to the broker (or to the pool), only differences are sent
+        self.broker_subscriptions = SubscriptionSet()
+        self.subscriptions_lock = threading.RLock()
+        self.suback_waiter = SubackWaiter()
+        # Subscriptions registered on the loopback bus
+        self.loopback_subscriptions = SubscriptionSet()
         self.topic_list_unsubscribe = topic_list_unsubscribe
         self.loop_start = loop_start
-
-        self.clientMqtt = mqtt.Client()
-        self.clientMqtt.on_message = self.on_message
-        self.clientMqtt.on_connect = self.on_connect
-        self.clientMqtt.connect(mqtt_host, mqtt_port)
         self.mqtt_connect_event = threading.Event()
+        # Seconds from the creation of the client to the broker connection and to the first SUBACK
+        self.startup_timings = {}
+        self.subscribed_event = threading.Event()
+        self.init_time = time.time()
+
+        service = type(self).__name__
+        self.service_name = service
+        self.metric_keys = {
+            "received": metric_key("mqtt_messages_received_total", service=service),
+            "processed": metric_key("mqtt_messages_processed_total", service=service),
+            "errors": metric_key("mqtt_message_errors_total", service=service),
+            "handle": metric_key("mqtt_handle_seconds", service=service),
+            "published": metric_key("mqtt_messages_published_total", service=service),
+            "published_bytes": metric_key("mqtt_published_bytes_total", service=service),
+            "spooled": metric_key("mqtt_messages_spooled_total", service=service),
+            "loopback": metric_key("mqtt_loopback_messages_total", service=service),
+            "rejected": metric_key("mqtt_messages_rejected_total", service=service),
+        }
+        self.dispatcher.on_rejected = self.on_rejected_message
+        self.dispatcher.on_error = self.on_handler_error
+
+        # Limits set in services.conf for the service replace those of its code
+        configured = service_limits.get(service, {})
+        rate = configured.get("rate_limit", rate_limit)
+        topic_rate_limits = configured.get("topic_rate_limits", topic_rate_limits)
+        self.rate_limiter = None
+        budget = get_global_budget()
+        if rate > 0 or topic_rate_limits or budget is not None:
+            self.rate_limiter = RateLimiter(
+                self.logger, self.send_raw, service, rate, configured.get("rate_burst", rate_burst),
+                configured.get("rate_policy", rate_policy), topic_rate_limits, budget
+            )
+
+        if loopback is None:
+            loopback = MQTT_LOOPBACK
+        if loopback and loopback not in LOOPBACK_MODES:
+            raise ValueError("Unknown loopback mode : " + str(loopback))
+        self.loopback = loopback
+        if loopback and inbound_queue_size <= 0:
+            # Local and broker messages are handled one at a time, in order, as without loopback
+            inbound_queue_size = LOOPBACK_QUEUE_SIZE
+            inbound_workers = 1
+
+        # Reply topic and pending calls, created by the first call
+        self.rpc_calls = None
+        self.rpc_reply_topic = None
+        self.rpc_lock = threading.Lock()
+
+        # Created by the first publish_state / subscribe_state
+        self.state_lock = threading.Lock()
+        self.state_cache = None
+        self.state_deltas = state_deltas
+        self.state_snapshot_period = state_snapshot_period
+        self.state_view = None
+
+        # Created by the first publish_shared
+        self.shared_lock = threading.Lock()
+        self.shared_store = None
+        self.shared_segment_size = shared_segment_size
+        self.shared_lease = shared_lease
+
+        # Created on first batched publish
+        self.batch_publisher = None
+        self.batch_window = batch_window
+        self.batch_max = batch_max
+        self.coalesce_topics = coalesce_topics
+
+        # Created before connecting, messages may arrive as soon as topics are subscribed
+        self.inbound_queue = None
+        if inbound_queue_size > 0:
+            self.inbound_queue = InboundQueue(
+                self.logger, self.handle_message, inbound_queue_size, inbound_workers, overflow_policy
+            )
+
+        if pool is None:
+            pool = get_shared_pool(mqtt_host, mqtt_port)
+        self.pool = pool
+
+        # Publishes go to the spool while disconnected, and while it is being drained to keep their order
+        self.connected = False
+        self.connection_manager = None
+        self.spool = None
+        self.spool_drainer = None
+        if spool_dir is None and MQTT_SPOOL_DIR:
+            spool_dir = os.path.join(MQTT_SPOOL_DIR, self.service_name)
+        if spool_dir:
+            self.spool = DiskSpool(spool_dir, max_bytes=spool_max_bytes, policy=spool_policy)
+            self.spool_drainer = SpoolDrainer(self.logger, self.spool, self.publish_spooled, self.is_connected,
+                                              spool_rate)
+
+        if brokers is None and MQTT_BROKERS:
+            brokers = MQTT_BROKERS
+        if self.pool is not None and brokers:
+            raise ValueError("Broker failover (brokers, MQTT_BROKERS) can't be used with a connection pool "
+                             "(pool, MQTT_POOL_SIZE)")
+
+        if self.pool is not None:
+            # Shared connection: the pool owns the paho client and its network thread.
+            # With a spool, the broker doesn't need to be up.
+            self.connection = self.pool.acquire(self, retry=self.spool is not None)
+            self.clientMqtt = self.connection.clientMqtt
+            self.sync_subscriptions()
+        else:
+            self.connection = None
+            if self.loopback:
+                # Broker subscriptions are sent on connection, local ones now
+                self.sync_subscriptions()
+            self.clientMqtt = mqtt.Client()
+            self.clientMqtt.on_message = self.on_message
+            self.clientMqtt.on_connect = self.on_connect
+            self.clientMqtt.on_subscribe = self.on_subscribe
+            self.clientMqtt.on_disconnect = self.on_disconnect
+            if brokers:
+                self.connection_manager = ConnectionManager(
+                    self.logger, self.clientMqtt, parse_brokers(brokers), self.on_connect, self.on_disconnect,
+                    self.on_link_state, self.service_name
+                )
+            elif self.spool is not None:
+                # Connection is made (and retried) by the network loop
+                self.clientMqtt.connect_async(mqtt_host, mqtt_port)
+            else:
+                self.clientMqtt.connect(mqtt_host, mqtt_port)
+        self.startup_timings["connect"] = time.time() - self.init_time
 
         self.logger.v("MQTT client init")
 
         if self.loop_start:
-            self.clientMqtt.loop_start()
-            self.mqtt_connect_event.wait()
+            if self.connection is None and self.connection_manager is None:
+                self.clientMqtt.loop_start()
+            if self.spool is None:
+                self.mqtt_connect_event.wait()
+
+    @property
+    def topic_list(self):
+        """
+        Subscribed topic filters
+        """
+        return list(self.subscriptions)
 
     def on_connect(self, client, userdata, flags, rc):
         """
         Called by paho mqtt client librairie when client is connected to mosquitto
-        Subscribe to topic_list after connection (subscribe should be done after connection)
+        Subscribe to subscriptions after connection (subscribe should be done after connection)
         :param client:
         :param userdata:
         :param flags:
         :param rc:
         :return:
         """
+        if rc != 0:
+            self.logger.w("Connection refused by broker (%s)", rc)
+            return
         try:
-            for topic in self.topic_list:
-                self.clientMqtt.subscribe(topic)
-                self.logger.d("subscribe on " + topic)
-            for topic in self.topic_list_unsubscribe:
-                self.clientMqtt.unsubscribe(topic)
-                self.logger.d("unsubscribe on " + topic)
+            set_nodelay(client)
+            self.connected = True
+            if self.spool_drainer is not None:
+                self.spool_drainer.wake()
+            with self.subscriptions_lock:
+                if not flags.get("session present"):
+                    # Clean session : the broker forgot every subscription
+                    self.broker_subscriptions.clear()
+                self.sync_subscriptions()
+            if self.topic_list_unsubscribe:
+                self.clientMqtt.unsubscribe(list(self.topic_list_unsubscribe))
+                self.logger.d("unsubscribe on %s", self.topic_list_unsubscribe)
             self.mqtt_connect_event.set()
         except Exception as e:
             import traceback
@@ -77,25 +300,167 @@ class MqttClient:
             )
             self.logger.e(exceptionStr)
 
+    def on_subscribe(self, client, userdata, mid, granted_qos):
+        """
+        Called when the broker acknowledges a subscription. mid is None when the pool
+        acknowledges topics already subscribed by another client.
+        """
+        if mid is not None:
+            self.suback_waiter.acknowledge(mid, granted_qos)
+        if not self.subscribed_event.is_set():
+            self.startup_timings["subscribe"] = time.time() - self.init_time
+            self.subscribed_event.set()
+
+    def on_disconnect(self, client, userdata, rc):
+        self.connected = False
+        if rc != 0:
+            self.logger.w("Disconnected from broker (%s)", rc)
+
+    # overrided by children
+    def on_link_state(self, state, broker):
+        """
+        Called when the broker link goes up, degraded (connected to a fallback broker) or down,
+        with brokers given to the constructor or MQTT_BROKERS only
+        :param state: LINK_UP, LINK_DEGRADED or LINK_DOWN
+        :param broker: (host, port)
+        """
+        pass
+
+    def is_connected(self):
+        if self.connection is not None:
+            return self.connection.connected
+        return self.connected
+
     # The callback for when a PUBLISH message is received from the server.
     def on_message(self, client, user_data, msg):
         """
-        Called when an MQTT message is received
+        Called when an MQTT message is received, from paho's network thread.
+        Message is queued if the client has an inbound queue, handled right away otherwise.
         :param client:
         :param user_data:
         :param msg:
         :return:
         """
+        metrics.inc(self.metric_keys["received"])
+        network_threads.add(threading.get_ident())
+        if self.inbound_queue is not None:
+            self.inbound_queue.put(msg)
+        else:
+            self.handle_message(msg)
+
+    def on_loopback(self, msg):
+        """
+        Called by the loopback bus, from the publisher's thread
+        :param msg: LoopbackMessage
+        """
+        metrics.inc(self.metric_keys["loopback"])
+        self.inbound_queue.put(msg)
+
+    def handle_message(self, msg):
+        """
+        Decode a received message and route it to the handlers declared for its topic,
+        or to parse_mqtt if none matches
+        :param msg: paho MQTTMessage or LoopbackMessage
+        :return:
+        """
         self.logger.d("mqtt message received")
-        self.logger.d(msg.topic + " " + str(msg.payload))
+        self.logger.d("%s %s", msg.topic, msg.payload)
+
+        start = time.perf_counter()
+        received = time.time()
+        try:
+            if type(msg) is LoopbackMessage and msg.obj is not None:
+                parsed_json = msg.obj
+            else:
+                parsed_json = self.codecs.decode(msg.payload)
+        except Exception as e:
+            # Undecodable payloads must not reach parse_mqtt, nor stop paho's network thread
+            metrics.observe(self.metric_keys["handle"], time.perf_counter() - start)
+            self.on_rejected_message(msg.topic, "payload can't be decoded (" + str(e) + ")")
+            return
+        decoded = time.time()
+
+        try:
+            if self.loopback and type(parsed_json) is dict and LOOPBACK_KEY in parsed_json:
+                # Retained messages sent on subscription are never copies of a message delivered by the bus
+                if (type(msg) is not LoopbackMessage and not msg.retain
+                        and loopback_bus.is_echo(self, parsed_json[LOOPBACK_KEY])):
+                    # Already delivered by the loopback bus
+                    return
+                del parsed_json[LOOPBACK_KEY]
+
+            # Batches are unpacked so that handlers see one message at a time
+            messages = unpack_batch(parsed_json)
+            if messages is None:
+                messages = [parsed_json]
+            for parsed_json in messages:
+                self.dispatch_message(parsed_json, msg.topic, received, decoded)
+        except Exception as e:
+            # Exceptions of handlers are caught by the dispatcher, these come from parse_mqtt
+            metrics.inc(self.metric_keys["errors"])
+            import traceback
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            exceptionStr = (
+                    os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+                    + ", line "
+                    + str(exc_tb.tb_lineno)
+                    + " : "
+                    + str(e) +
+                    "".join(traceback.format_tb(e.__traceback__))
+            )
+            self.logger.e(exceptionStr)
+            return
+        finally:
+            metrics.observe(self.metric_keys["handle"], time.perf_counter() - start)
+        metrics.inc(self.metric_keys["processed"])
+
+    def dispatch_message(self, parsed_json, topic, received, decoded):
+        """
+        Call the handlers of a decoded message, or parse_mqtt. If the message is traced,
+        publishes made by the handlers carry its trace.
+        :param received: Time the message was received at
+        :param decoded: Time its payload was decoded at
+        """
+        span = tracer.start_span("mqtt.message", tracer.extract(parsed_json), received,
+                                 {"service": self.service_name, "topic": topic})
+        if span is None:
+            if not self.dispatcher.dispatch(parsed_json, topic):
+                self.parse_mqtt(parsed_json, topic)
+            return
+
+        tracer.record_span("mqtt.decode", span, received, decoded)
+        handler_span = tracer.start_span("mqtt.handler", span)
+        token = tracer.activate(handler_span)
+        try:
+            if not self.dispatcher.dispatch(parsed_json, topic):
+                self.parse_mqtt(parsed_json, topic)
+        finally:
+            tracer.finish(handler_span, token)
+            tracer.finish(span)
+
+    def add_topic_handler(self, topic_filter, handler, schema=None):
+        """
+        Register a handler on a topic filter at runtime. The topic must be subscribed.
+        :param topic_filter: Subscription filter, may contain '+' and '#'
+        :param handler: Callable taking (parsed_json, topic), or (message, topic) with a schema
+        :param schema: Schema of the messages given to handler
+        :return:
+        """
+        self.dispatcher.add(topic_filter, handler, schema)
 
-        parsed_json = json.loads(msg.payload.decode("utf-8"))
-        self.parse_mqtt(parsed_json, msg.topic)
+    def remove_topic_handler(self, topic_filter, handler):
+        """
+        Unregister a handler added with add_topic_handler or @topic_handler
+        :return: True if handler was registered
+        """
+        return self.dispatcher.remove(topic_filter, handler)
 
     # overrided by children
     def parse_mqtt(self, parsed_json, topic):
         """
-        Parse MQTT message received in on_message and save data in  attribute
+        Parse MQTT message received in on_message and save data in  attribute.
+        Messages without topic handler only : attributes are shared by every message, declare
+        handlers with a Schema (the Command schema for these messages) to get them as arguments.
         :param parsed_json:
         :param topic:
         :return:
@@ -138,10 +503,14 @@ class MqttClient:
             if id == "":
                 id = None
             dict_to_send = {"id": id, "payload": payload}
-            self.logger.d(topic + " " + str(dict_to_send))
-            self.clientMqtt.publish(
-                topic, (json.dumps(dict_to_send)).encode("utf-8")
-            )  # publish
+            span = tracer.start_span("mqtt.publish", attributes={"service": self.service_name, "topic": topic})
+            if span is not None:
+                # Handlers of this message continue the trace
+                dict_to_send[TRACE_KEY] = span.context()
+            self.logger.d("%s %s", topic, dict_to_send)
+            self.publish_object(topic, dict_to_send)
+            if span is not None:
+                tracer.finish(span)
         except Exception as e:
             import traceback
             exc_type, exc_obj, exc_tb = sys.exc_info()
@@ -163,10 +532,510 @@ class MqttClient:
         :return:
         """
         self.logger.d("mqtt message sent")
-        self.logger.d(topic + " " + str(parsed_json))
-        self.clientMqtt.publish(
-            topic, (json.dumps(parsed_json)).encode("utf-8")
-        )  # publish
+        self.logger.d("%s %s", topic, parsed_json)
+        span = tracer.start_span("mqtt.publish", attributes={"service": self.service_name, "topic": topic})
+        self.publish_object(topic, parsed_json)
+        if span is not None:
+            tracer.finish(span)
+
+    def publish_object(self, topic, obj, qos=0, retain=False):
+        """
+        Encode and publish obj. With loopback, subscribers of the process get it first from the bus.
+        :param topic:
+        :param obj: Object to encode
+        :param qos:
+        :param retain:
+        :return: See publish_raw
+        """
+        obj, payload = self.encode_object(topic, obj)
+        return self.publish_encoded(topic, obj, payload, qos, retain)
+
+    def encode_object(self, topic, obj):
+        """
+        Encode obj, marked for the loopback bus if clients of the process subscribe to topic
+        :return: (obj, payload) to give to publish_encoded
+        """
+        if self.loopback and type(obj) is dict and loopback_bus.subscribers(topic):
+            obj = dict(obj)
+            obj[LOOPBACK_KEY] = loopback_bus.message_id()
+        return obj, self.codecs.encode(topic, obj)
+
+    def publish_encoded(self, topic, obj, payload, qos=0, retain=False):
+        """
+        Publish an object encoded by encode_object
+        :return: See publish_raw
+        """
+        if self.loopback and type(obj) is dict and loopback_bus.owns(obj.get(LOOPBACK_KEY)):
+            # Local subscribers only get what the rate limits let through. A coalesced message isn't
+            # delivered by the bus : its broker copy isn't an echo and reaches them once published.
+            if self.rate_limiter is not None and not self.rate_limiter.acquire(topic, payload, qos, retain):
+                return None
+            loopback_bus.deliver(loopback_bus.subscribers(topic), topic, obj, payload, qos, retain)
+            return self.send_raw(topic, payload, qos, retain)
+        return self.publish_raw(topic, payload, qos, retain)
+
+    def publish_raw(self, topic, payload, qos=0, retain=False):
+        """
+        Publish an already encoded payload. Every publish of the client goes through here.
+        Over a rate limit, blocks, or drops or coalesces the message, as set by rate_policy.
+        :param topic:
+        :param payload: bytes
+        :param qos:
+        :param retain:
+        :return: paho MQTTMessageInfo, None if the message was spooled, dropped or coalesced
+        """
+        if self.rate_limiter is not None and not self.rate_limiter.acquire(topic, payload, qos, retain):
+            return None
+        return self.send_raw(topic, payload, qos, retain)
+
+    def send_raw(self, topic, payload, qos=0, retain=False):
+        """
+        Publish a message allowed by the rate limits
+        :return: See publish_raw
+        """
+        if self.spool is not None and (len(self.spool) or not self.is_connected()):
+            # Counted as published once taken from the spool
+            metrics.inc(self.metric_keys["spooled"])
+            if not self.spool.append(topic, payload, qos, retain):
+                self.logger.w("Spool is full, message on %s dropped", topic)
+            self.spool_drainer.wake()
+            return None
+        info = self.clientMqtt.publish(topic, payload, qos, retain)
+        metrics.inc(self.metric_keys["published"])
+        metrics.inc(self.metric_keys["published_bytes"], len(payload))
+        return info
+
+    def publish_spooled(self, topic, payload, qos, retain):
+        """
+        Publish a message taken from the spool
+        :return: False if paho couldn't send it
+        """
+        if self.clientMqtt.publish(topic, payload, qos, retain).rc != mqtt.MQTT_ERR_SUCCESS:
+            return False
+        metrics.inc(self.metric_keys["published"])
+        metrics.inc(self.metric_keys["published_bytes"], len(payload))
+        return True
+
+    def subscribe_mqtt(self, topic, qos=0, timeout=None):
+        """
+        Subscribe to topic now, and again after each reconnection
+        :param topic: Topic filter
+        :param qos:
+        :param timeout: Seconds to wait for the SUBACK, None to return without waiting
+        :return: See sync_subscriptions
+        """
+        return self.add_subscriptions([(topic, qos)], timeout)
+
+    def unsubscribe_mqtt(self, topic):
+        """
+        Unsubscribe from topic
+        :param topic: Topic filter
+        :return:
+        """
+        return self.remove_subscriptions([topic])
+
+    def add_subscriptions(self, subscriptions, timeout=None):
+        """
+        Subscribe to several topics, sent in a single SUBSCRIBE
+        :param subscriptions: Topic filters (QoS 0), (topic, qos) pairs, a dict topic => qos or a SubscriptionSet
+        :param timeout: Seconds to wait for the SUBACK, None to return without waiting
+        :return: See sync_subscriptions
+        """
+        with self.subscriptions_lock:
+            self.subscriptions.update(subscriptions)
+            return self.sync_subscriptions(timeout)
+
+    def remove_subscriptions(self, topics):
+        """
+        Unsubscribe from several topics, sent in a single UNSUBSCRIBE
+        :param topics: Topic filters
+        :return:
+        """
+        with self.subscriptions_lock:
+            for topic in topics:
+                self.subscriptions.remove(topic)
+            return self.sync_subscriptions()
+
+    def replace_subscriptions(self, subscriptions, timeout=None):
+        """
+        Replace every subscription of the client, only sending what changed. Filters of the
+        topic handlers (and the RPC reply topic) stay subscribed.
+        :param subscriptions: Topic filters (QoS 0), (topic, qos) pairs, a dict topic => qos or a SubscriptionSet
+        :param timeout: Seconds to wait for the SUBACK, None to return without waiting
+        :return: See sync_subscriptions
+        """
+        subscriptions = SubscriptionSet(subscriptions)
+        for topic in self.dispatcher.topic_filters:
+            if topic not in subscriptions:
+                subscriptions.add(topic)
+        with self.subscriptions_lock:
+            self.subscriptions.replace(subscriptions)
+            return self.sync_subscriptions(timeout)
+
+    def sync_subscriptions(self, timeout=None):
+        """
+        Send the changes of subscriptions since they were last sent : new topics (or QoS)
+        in a single SUBSCRIBE, removed topics in a single UNSUBSCRIBE. While disconnected,
+        changes are sent on connection.
+        Don't wait for SUBACKs from a message handler, they are received by the network thread.
+        :param timeout: Seconds to wait for the SUBACKs, None to return without waiting
+        :return: True if every new topic was acknowledged in time, False if the broker refused one,
+                 didn't answer in time or is disconnected, None when not waiting
+        """
+        with self.subscriptions_lock:
+            if self.loopback:
+                # Local subscriptions don't depend on the broker connection
+                loopback_bus.update(self, *self.loopback_subscriptions.diff(self.subscriptions))
+                self.loopback_subscriptions = self.subscriptions.copy()
+            to_subscribe, to_unsubscribe = self.broker_subscriptions.diff(self.subscriptions)
+            if not to_subscribe and not to_unsubscribe:
+                return True if timeout is not None else None
+            if self.connection is not None:
+                pending = self.connection.update(self, to_subscribe, to_unsubscribe)
+                self.broker_subscriptions = self.subscriptions.copy()
+            elif self.is_connected():
+                pending = self.send_subscriptions(to_subscribe, to_unsubscribe)
+                if pending is not None:
+                    self.broker_subscriptions = self.subscriptions.copy()
+            else:
+                pending = None
+        if timeout is None:
+            return None
+        if pending is None:
+            return False
+        return self.wait_subacks(pending, timeout)
+
+    def send_subscriptions(self, to_subscribe, to_unsubscribe):
+        """
+        :return: [(mid, topics)] of the SUBSCRIBE packets sent, None if paho couldn't send them
+        """
+        pending = []
+        for subscriptions in batches(to_subscribe):
+            result, mid = self.clientMqtt.subscribe(subscriptions)
+            if result != mqtt.MQTT_ERR_SUCCESS:
+                return None
+            pending.append((mid, [topic for topic, qos in subscriptions]))
+            self.logger.d("subscribe on %s", subscriptions)
+        for topics in batches(to_unsubscribe):
+            if self.clientMqtt.unsubscribe(topics)[0] != mqtt.MQTT_ERR_SUCCESS:
+                return None
+            self.logger.d("unsubscribe on %s", topics)
+        return pending
+
+    def wait_subacks(self, pending, timeout):
+        """
+        Wait for the SUBACKs of [(mid, topics)]
+        :return: True if every topic was acknowledged and granted
+        """
+        deadline = time.time() + timeout
+        waits = [(mid, topics, self.suback_waiter.expect(mid)) for mid, topics in pending]
+        granted = True
+        for mid, topics, event in waits:
+            if not event.wait(max(0, deadline - time.time())):
+                self.suback_waiter.forget(mid)
+                self.logger.w("No SUBACK for %s", topics)
+                granted = False
+                continue
+            refused = [topic for topic, qos in zip(topics, self.suback_waiter.result(mid) or [])
+                       if qos == SUBACK_FAILURE and topic in self.subscriptions]
+            if refused:
+                self.logger.w("Broker refused subscriptions on %s", refused)
+                granted = False
+        return granted
+
+    def call_async(self, topic, payload, timeout=RPC_TIMEOUT):
+        """
+        Send a request on topic, to be answered by an @rpc_handler of another service
+        :param topic:
+        :param payload: Request payload, given to the handler
+        :param timeout: Seconds before the call fails with RpcTimeout
+        :return: concurrent.futures.Future resolved with the payload of the reply,
+                 or failing with RpcError / RpcTimeout
+        """
+        future = Future()
+        call_id = self.get_rpc_calls().add(future, timeout)
+        request = tracer.inject(make_request(call_id, payload, self.rpc_reply_topic))
+        self.logger.d("call %s %s", topic, request)
+        self.publish_object(topic, request)
+        return future
+
+    def call(self, topic, payload, timeout=RPC_TIMEOUT):
+        """
+        Send a request and wait for its reply. Replies are received by the network thread
+        (or the inbound workers) : from a message handler, use call_async instead.
+        :return: payload of the reply
+        """
+        return self.call_async(topic, payload, timeout).result()
+
+    def reply(self, request, payload, error=None):
+        """
+        Answer a request received from call(). Requests without reply topic are ignored.
+        :param request: parsed_json of the request
+        :param payload: Reply payload
+        :param error: Error message, raised as RpcError by the caller
+        :return:
+        """
+        topic = reply_topic(request)
+        if topic is not None:
+            self.publish_json_mqtt(make_reply(request, payload, error), topic)
+
+    def get_rpc_calls(self):
+        with self.rpc_lock:
+            if self.rpc_calls is None:
+                self.rpc_calls = PendingCalls()
+                self.rpc_reply_topic = "%s/%s/%08x" % (RPC_REPLY_TOPIC, self.service_name, getrandbits(32))
+                self.dispatcher.add(self.rpc_reply_topic, self.on_rpc_reply)
+                self.subscribe_mqtt(self.rpc_reply_topic)
+        return self.rpc_calls
+
+    def on_rejected_message(self, topic, error):
+        """
+        Called when a message doesn't match the schema of its handler
+        """
+        metrics.inc(self.metric_keys["rejected"])
+        self.logger.w("Message on %s rejected : %s", topic, error)
+
+    def on_handler_error(self, topic, error):
+        """
+        Called when a topic handler raised, the exception being logged by the dispatcher
+        """
+        metrics.inc(self.metric_keys["errors"])
+
+    def on_rpc_reply(self, parsed_json, topic):
+        if not self.rpc_calls.resolve(parsed_json):
+            self.logger.d("Reply to an unknown or expired call : %s", parsed_json)
+
+    def publish_mqtt_batched(self, id, payload, topic):
+        """
+        Same envelope as publish_mqtt, but the message is sent in a batch with the other
+        messages published on topic during batch_window (or coalesced on coalesce_topics)
+        :param id:
+        :param payload:
+        :param topic:
+        :return:
+        """
+        if id == "":
+            id = None
+        # Sent later by the batch thread, the trace of the caller is attached now
+        self.get_batch_publisher().add(topic, tracer.inject({"id": id, "payload": payload}))
+
+    def publish_json_mqtt_batched(self, parsed_json, topic):
+        """
+        Same as publish_json_mqtt, sent in a batch
+        :param parsed_json:
+        :param topic:
+        :return:
+        """
+        self.get_batch_publisher().add(topic, parsed_json)
+
+    def flush_batches(self):
+        """
+        Publish now every message waiting for its batch
+        """
+        if self.batch_publisher is not None:
+            self.batch_publisher.flush()
+
+    def get_batch_publisher(self):
+        if self.batch_publisher is None:
+            self.batch_publisher = BatchPublisher(
+                self.logger,
+                lambda topic, obj: self.publish_json_mqtt(obj, topic),
+                self.batch_window,
+                self.batch_max,
+                self.coalesce_topics,
+            )
+        return self.batch_publisher
+
+    def publish_state(self, topic, state, qos=0, retain=True):
+        """
+        Publish the state of a device or of the service on topic, only if it changed since
+        the last publish_state on topic. Full states are retained. With state_deltas, changes
+        are sent as JSON Patch operations, with a full state at least every state_snapshot_period.
+        Subscribers use subscribe_state.
+        :param state: JSON value, copied
+        :return: False if the state didn't change and nothing was sent
+        """
+        if self.state_cache is None:
+            with self.state_lock:
+                if self.state_cache is None:
+                    self.state_cache = StateCache(self.logger, self.encode_object, self.publish_encoded,
+                                                  self.state_deltas, self.state_snapshot_period)
+        return self.state_cache.update(topic, state, qos, retain)
+
+    def subscribe_state(self, topic_filter, handler=None, qos=0):
+        """
+        Keep a local view of the states published with publish_state on topic_filter,
+        read with get_state
+        :param handler: Called with (state, topic) after each change, state must not be modified
+        :return:
+        """
+        with self.state_lock:
+            if self.state_view is None:
+                self.state_view = StateView(self.logger)
+
+        def on_state(parsed_json, topic):
+            state = self.state_view.apply(topic, parsed_json)
+            if state is not None and handler is not None:
+                handler(state, topic)
+
+        self.add_topic_handler(topic_filter, on_state)
+        self.subscribe_mqtt(topic_filter, qos)
+
+    def get_state(self, topic):
+        """
+        Returns the last state received on topic (see subscribe_state), None if there is none.
+        Must not be modified.
+        """
+        if self.state_view is None:
+            return None
+        return self.state_view.get(topic)
+
+    def state_stats(self):
+        """
+        Returns the counts of full states, patches and suppressed publishes sent, and of
+        full states, patches and missed changes received
+        """
+        return {
+            "published": self.state_cache.stats() if self.state_cache is not None else None,
+            "received": self.state_view.stats() if self.state_view is not None else None,
+        }
+
+    def publish_shared(self, topic, data, meta=None, consumers=None, lease=None, qos=0):
+        """
+        Publish a large payload for the services of this host : data is copied once in shared
+        memory and only its handle goes through the broker. Subscribers read it with open_shared.
+        The first call with consumers subscribes the topic on which consumers of other processes
+        release payloads, and waits for its SUBACK (MQTT_SHARED_ACK_TIMEOUT), except from the
+        network thread : releases sent before the SUBACK would be lost.
+        Consumers of other processes need POSIX shared memory (Linux, macOS).
+        :param data: bytes-like object
+        :param meta: JSON value sent with the handle
+        :param consumers: Number of consumers which must release the payload before its memory is reused,
+                          None to keep it readable for the whole lease
+        :param lease: Seconds the payload stays readable at most, shared_lease by default
+        :return: handle of the payload, None if the shared memory is full and nothing was published
+        """
+        from broker.shared_payload import SharedPayloadStore, SHARED_KEY, META_KEY
+        if self.shared_store is None or (consumers and self.shared_store.ack_topic is None):
+            with self.shared_lock:
+                if self.shared_store is None:
+                    self.shared_store = SharedPayloadStore(self.logger, self.shared_segment_size,
+                                                           MQTT_SHARED_MAX_SEGMENTS, self.shared_lease)
+                if consumers and self.shared_store.ack_topic is None:
+                    # Consumers of other processes release payloads here
+                    ack_topic = "%s/%s/%08x" % (SHARED_ACK_TOPIC, self.service_name, getrandbits(32))
+                    self.dispatcher.add(ack_topic, self.on_shared_release)
+                    # SUBACKs are received by the network thread, it can't wait for them
+                    timeout = None if threading.get_ident() in network_threads else MQTT_SHARED_ACK_TIMEOUT
+                    if self.subscribe_mqtt(ack_topic, timeout=timeout) is False:
+                        self.logger.w("Release topic %s not acknowledged, payloads may be kept for their lease",
+                                      ack_topic)
+                    self.shared_store.ack_topic = ack_topic
+        handle = self.shared_store.write(data, consumers, lease)
+        if handle is None:
+            self.logger.w("Shared memory is full, message on %s dropped", topic)
+            return None
+        obj = {SHARED_KEY: handle}
+        if meta is not None:
+            obj[META_KEY] = meta
+        self.publish_object(topic, obj, qos)
+        return handle
+
+    def open_shared(self, parsed_json):
+        """
+        Open a payload published with publish_shared, from its handler :
+
+            with self.open_shared(parsed_json) as payload:
+                frame = numpy.frombuffer(payload.data, dtype=numpy.uint8)
+
+        payload.data is a memoryview of the shared memory, valid until the payload is released.
+        Payloads of other processes are mapped with POSIX shared memory (Linux, macOS).
+        :return: SharedPayload
+        :raise StalePayload: if the payload expired, was published on another host, or the platform
+                             can't map payloads of other processes
+        """
+        from broker.shared_payload import shared_reader
+        return shared_reader.open(parsed_json, self.release_shared)
+
+    def release_shared(self, handle):
+        """
+        Tell the publisher of a payload that it was read
+        """
+        from broker.shared_payload import local_segments
+        segment = local_segments.get(handle["name"])
+        if segment is not None:
+            segment.store.release(handle["name"], handle["offset"], handle["generation"])
+        elif handle.get("ack"):
+            self.publish_json_mqtt({"name": handle["name"], "offset": handle["offset"],
+                                    "generation": handle["generation"]}, handle["ack"])
+
+    def on_shared_release(self, parsed_json, topic):
+        self.shared_store.release(parsed_json["name"], parsed_json["offset"], parsed_json["generation"])
+
+    def shared_stats(self):
+        """
+        Returns the segments, blocks in use and published, released and expired payload counts
+        of publish_shared, None if nothing was published
+        """
+        if self.shared_store is None:
+            return None
+        return self.shared_store.stats()
+
+    def rate_stats(self):
+        """
+        Returns how often each rate limit of the client refused a publish, None if there is no limit
+        """
+        if self.rate_limiter is None:
+            return None
+        return self.rate_limiter.stats()
+
+    def spool_stats(self):
+        """
+        Returns pending, spooled, drained and dropped message counts of the spool, None if there is no spool
+        """
+        if self.spool is None:
+            return None
+        return self.spool.stats()
+
+    def inbound_stats(self):
+        """
+        Returns depth, drop counts and latencies of the inbound queue, None if there is no queue
+        """
+        if self.inbound_queue is None:
+            return None
+        return self.inbound_queue.stats()
+
+    def disconnect_mqtt(self):
+        """
+        Release the broker connection: detach from the shared pool, or stop and
+        disconnect the client's own connection
+        :return:
+        """
+        if self.batch_publisher is not None:
+            self.batch_publisher.stop()
+        if self.state_cache is not None:
+            self.state_cache.stop()
+        if self.rate_limiter is not None:
+            self.rate_limiter.stop()
+        if self.shared_store is not None:
+            self.shared_store.close()
+        if self.spool_drainer is not None:
+            # What isn't drained yet stays in the spool files for the next instance
+            self.spool_drainer.stop()
+        if self.loopback:
+            loopback_bus.update(self, [], list(self.loopback_subscriptions))
+        if self.pool is not None:
+            self.pool.release(self)
+        elif self.connection_manager is not None:
+            self.connection_manager.stop()
+        else:
+            if self.loop_start:
+                self.clientMqtt.loop_stop()
+            self.clientMqtt.disconnect()
+        if self.spool is not None:
+            self.spool.close()
+        if self.inbound_queue is not None:
+            self.inbound_queue.stop()
 
     def run(self):
         pass
@@ -0,0 +1,562 @@
+import paho.mqtt.client as mqtt
+from config import *
+from broker.dispatch import TopicDispatcher, REJECTED
+from broker.codecs import CodecTable
+from broker.batching import unpack_batch
+from broker.topic_trie import TopicTrie
+from metrics import metrics, metric_key
+from tracing import tracer, TRACE_KEY
+from broker.rpc import PendingCalls, make_request, make_reply, reply_topic
+from broker.subscriptions import SubscriptionSet, batches
+from broker.connection import set_nodelay
+from broker.rate_limit import RateLimiter, RATE_BLOCK, service_limits, get_global_budget
+from random import getrandbits
+import asyncio
+import time
+import sys
+
+RECONNECT_DELAY_MIN = 1
+RECONNECT_DELAY_MAX = 60
+
+
+class AsyncMessage(object):
+    """
+    Message yielded by AsyncMqttClient.messages()
+    """
+    __slots__ = ("topic", "payload", "qos", "retain")
+
+    def __init__(self, topic, payload, qos=0, retain=False):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+
+
+class AsyncMqttClient:
+    """
+    asyncio flavour of MqttClient.
+    The paho client is driven by the event loop (add_reader/add_writer) instead of a
+    loop_start() thread, so any number of clients can share one loop in one thread.
+    """
+
+    def __init__(
+        self,
+        logger,
+        mqtt_host,
+        mqtt_port,
+        topic_list,
+        topic_list_unsubscribe=[],
+        codec="json",
+        topic_codecs=None,
+        rate_limit=0,
+        rate_burst=None,
+        rate_policy=RATE_BLOCK,
+        topic_rate_limits=None,
+    ):
+        """
+        Create an asyncio Mqtt client. Connection is made by connect_mqtt(), from the event loop.
+        :param mqtt_host: Address of mqtt server
+        :param mqtt_port: Port to connect to server
+        :param topic_list: Topics to subscribe to : topic filters (QoS 0), (topic, qos) pairs or a SubscriptionSet
+        :param topic_list_unsubscribe: List of topics to unsubscribe from after connection
+        :param codec: Payload codec used to publish : json (default), orjson, msgpack or cbor
+        :param topic_codecs: dict of topic filter => codec name, overriding codec for matching topics
+        :param rate_limit: Maximum publishes per second of the client, 0 for no limit
+        :param rate_burst: Publishes allowed at once, rate_limit by default
+        :param rate_policy: block (the publishing task waits), drop or coalesce a publish over a limit
+        :param topic_rate_limits: dict topic filter => publishes per second or (rate, burst, policy) on matching topics.
+                                  The rate options of the service in services.conf replace the rate arguments.
+        """
+        self.logger = logger
+        self.codecs = CodecTable(codec, topic_codecs)
+        self.mqtt_host = mqtt_host
+        self.mqtt_port = mqtt_port
+        self.dispatcher = TopicDispatcher.from_instance(self)
+        self.subscriptions = SubscriptionSet(topic_list)
+        for topic in self.dispatcher.topic_filters:
+            if topic not in self.subscriptions:
+                self.subscriptions.add(topic)
+        self.topic_list_unsubscribe = topic_list_unsubscribe
+
+        self.loop = None
+        self.mqtt_connect_event = None
+        self.streams = TopicTrie()
+        # Message id => (future, qos) of the publishes not completed yet
+        self.pending_publish = {}
+        self.published_mids = set()
+        self.misc_task = None
+        self.watched_fd = None
+        self.closing = False
+        # Reply topic and pending calls, created by the first call
+        self.rpc_calls = None
+        self.rpc_reply_topic = None
+
+        service = type(self).__name__
+        self.service_name = service
+        self.metric_keys = {
+            "received": metric_key("mqtt_messages_received_total", service=service),
+            "handle": metric_key("mqtt_handle_seconds", service=service),
+            "published": metric_key("mqtt_messages_published_total", service=service),
+            "published_bytes": metric_key("mqtt_published_bytes_total", service=service),
+            "rejected": metric_key("mqtt_messages_rejected_total", service=service),
+        }
+        self.dispatcher.on_rejected = self.on_rejected_message
+
+        # Limits set in services.conf for the service replace those of its code
+        configured = service_limits.get(service, {})
+        rate = configured.get("rate_limit", rate_limit)
+        topic_rate_limits = configured.get("topic_rate_limits", topic_rate_limits)
+        self.rate_limiter = None
+        budget = get_global_budget()
+        if rate > 0 or topic_rate_limits or budget is not None:
+            self.rate_limiter = RateLimiter(
+                self.logger, self.send_coalesced, service, rate, configured.get("rate_burst", rate_burst),
+                configured.get("rate_policy", rate_policy), topic_rate_limits, budget
+            )
+
+        self.clientMqtt = mqtt.Client()
+        self.clientMqtt.on_message = self.on_message
+        self.clientMqtt.on_connect = self.on_connect
+        self.clientMqtt.on_disconnect = self.on_disconnect
+        self.clientMqtt.on_publish = self.on_publish
+
+        self.logger.v("Async MQTT client init")
+
+    async def connect_mqtt(self):
+        """
+        Connect to the broker and wait for subscriptions to be sent
+        :return:
+        """
+        self.loop = asyncio.get_running_loop()
+        self.mqtt_connect_event = asyncio.Event()
+        # connect() resolves the host and opens the socket, don't block the loop meanwhile
+        await self.loop.run_in_executor(None, self.clientMqtt.connect, self.mqtt_host, self.mqtt_port)
+        self.watch_socket()
+        self.misc_task = self.loop.create_task(self.misc_loop())
+        await self.mqtt_connect_event.wait()
+
+    def watch_socket(self):
+        sock = self.clientMqtt.socket()
+        if sock is not None:
+            # Keep the fd number: paho closes the socket before calling on_disconnect
+            self.watched_fd = sock.fileno()
+            self.loop.add_reader(self.watched_fd, self.on_readable)
+            self.update_writer()
+
+    def unwatch_socket(self):
+        if self.watched_fd is not None:
+            self.loop.remove_reader(self.watched_fd)
+            self.loop.remove_writer(self.watched_fd)
+            self.watched_fd = None
+
+    def on_readable(self):
+        self.clientMqtt.loop_read()
+        self.update_writer()
+
+    def on_writable(self):
+        self.clientMqtt.loop_write()
+        self.update_writer()
+
+    def update_writer(self):
+        """
+        Watch the socket for writing only while paho has packets waiting to be sent
+        """
+        if self.watched_fd is None or self.clientMqtt.socket() is None:
+            return
+        if self.clientMqtt.want_write():
+            self.loop.add_writer(self.watched_fd, self.on_writable)
+        else:
+            self.loop.remove_writer(self.watched_fd)
+
+    async def misc_loop(self):
+        """
+        Keepalive, retries and reconnection, normally done by paho's network thread
+        """
+        delay = RECONNECT_DELAY_MIN
+        while not self.closing:
+            await asyncio.sleep(1)
+            if self.clientMqtt.socket() is not None:
+                self.clientMqtt.loop_misc()
+                self.update_writer()
+                continue
+            try:
+                self.logger.i("Reconnecting to " + self.mqtt_host)
+                await self.loop.run_in_executor(None, self.clientMqtt.reconnect)
+                self.watch_socket()
+                delay = RECONNECT_DELAY_MIN
+            except Exception as e:
+                self.logger.w("Reconnection failed : " + str(e))
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RECONNECT_DELAY_MAX)
+
+    @property
+    def topic_list(self):
+        """
+        Subscribed topic filters
+        """
+        return list(self.subscriptions)
+
+    def on_connect(self, client, userdata, flags, rc):
+        """
+        Called by paho when client is connected to mosquitto. Subscribe to subscriptions,
+        in as few SUBSCRIBE as possible.
+        """
+        try:
+            set_nodelay(client)
+            for subscriptions in batches(self.subscriptions.items()):
+                self.clientMqtt.subscribe(subscriptions)
+                self.logger.d("subscribe on %s", subscriptions)
+            if self.topic_list_unsubscribe:
+                self.clientMqtt.unsubscribe(list(self.topic_list_unsubscribe))
+                self.logger.d("unsubscribe on %s", self.topic_list_unsubscribe)
+            self.mqtt_connect_event.set()
+        except Exception as e:
+            import traceback
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            exceptionStr = (
+                    os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+                    + ", line "
+                    + str(exc_tb.tb_lineno)
+                    + " : "
+                    + str(e) +
+                    "".join(traceback.format_tb(e.__traceback__))
+            )
+            self.logger.e(exceptionStr)
+
+    def on_disconnect(self, client, userdata, rc):
+        self.logger.w("Disconnected from broker, rc " + str(rc))
+        self.mqtt_connect_event.clear()
+        self.unwatch_socket()
+        self.fail_publishes(self.closing)
+
+    def fail_publishes(self, every_qos):
+        """
+        Fail the futures of pending publishes with ConnectionError. QoS 0 packets not written yet
+        are dropped on reconnection, paho sends QoS 1 and 2 messages again (unless the client is closed).
+        :param every_qos: Fail QoS 1 and 2 publishes too
+        """
+        for mid, (future, qos) in list(self.pending_publish.items()):
+            if qos == 0 or every_qos:
+                del self.pending_publish[mid]
+                if not future.done():
+                    future.set_exception(ConnectionError("Disconnected from broker before publishing"))
+
+    def on_publish(self, client, userdata, mid):
+        pending = self.pending_publish.pop(mid, None)
+        if pending is None:
+            # Written synchronously inside publish(), before the future was registered
+            self.published_mids.add(mid)
+        elif not pending[0].done():
+            pending[0].set_result(mid)
+
+    def on_message(self, client, user_data, msg):
+        """
+        Called when an MQTT message is received, from the event loop.
+        Message is pushed to matching messages() iterators, then routed to handlers
+        (coroutine handlers are scheduled as tasks) or to parse_mqtt.
+        """
+        self.logger.d("mqtt message received")
+        self.logger.d("%s %s", msg.topic, msg.payload)
+        metrics.inc(self.metric_keys["received"])
+
+        # Coroutine handlers run later as tasks, only their synchronous part is measured
+        start = time.perf_counter()
+        received = time.time()
+        try:
+            parsed_json = self.codecs.decode(msg.payload)
+        except Exception as e:
+            self.on_rejected_message(msg.topic, "payload can't be decoded (" + str(e) + ")")
+            return
+        decoded = time.time()
+
+        # Batches are unpacked so that handlers see one message at a time
+        messages = unpack_batch(parsed_json)
+        if messages is None:
+            messages = [parsed_json]
+        for parsed_json in messages:
+            span = tracer.start_span("mqtt.message", tracer.extract(parsed_json), received,
+                                     {"service": self.service_name, "topic": msg.topic})
+            if span is None:
+                self.route_message(parsed_json, msg)
+                continue
+            # Tasks created by handlers copy the current context and continue the trace
+            tracer.record_span("mqtt.decode", span, received, decoded)
+            handler_span = tracer.start_span("mqtt.handler", span)
+            token = tracer.activate(handler_span)
+            try:
+                self.route_message(parsed_json, msg)
+            finally:
+                tracer.finish(handler_span, token)
+                tracer.finish(span)
+        metrics.observe(self.metric_keys["handle"], time.perf_counter() - start)
+
+    def route_message(self, parsed_json, msg):
+        streams = self.streams.match(msg.topic)
+        if streams:
+            message = AsyncMessage(msg.topic, parsed_json, msg.qos, msg.retain)
+            for queue in streams:
+                queue.put_nowait(message)
+
+        handlers = self.dispatcher.match(msg.topic)
+        if not handlers and not streams:
+            handlers = [self.parse_mqtt]
+        schema_messages = {} if self.dispatcher.schemas else None
+        for handler in handlers:
+            try:
+                message = self.dispatcher.argument(handler, parsed_json, msg.topic, schema_messages)
+                if message is REJECTED:
+                    continue
+                result = handler(message, msg.topic)
+                if asyncio.iscoroutine(result):
+                    self.loop.create_task(result)
+            except Exception as e:
+                import traceback
+                exc_type, exc_obj, exc_tb = sys.exc_info()
+                exceptionStr = (
+                        os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+                        + ", line "
+                        + str(exc_tb.tb_lineno)
+                        + " : "
+                        + str(e) +
+                        "".join(traceback.format_tb(e.__traceback__))
+                )
+                self.logger.e(exceptionStr)
+
+    def subscribe_mqtt(self, topic, qos=0):
+        """
+        Subscribe to topic now, and again after each reconnection
+        :param topic: Topic filter
+        :param qos:
+        :return:
+        """
+        self.add_subscriptions([(topic, qos)])
+
+    def add_subscriptions(self, subscriptions):
+        """
+        Subscribe to several topics, sent in a single SUBSCRIBE
+        :param subscriptions: Topic filters (QoS 0), (topic, qos) pairs, a dict topic => qos or a SubscriptionSet
+        :return:
+        """
+        for subscriptions in batches(self.subscriptions.update(subscriptions)):
+            self.clientMqtt.subscribe(subscriptions)
+            self.logger.d("subscribe on %s", subscriptions)
+        self.update_writer()
+
+    def remove_subscriptions(self, topics):
+        """
+        Unsubscribe from several topics, sent in a single UNSUBSCRIBE
+        :param topics: Topic filters
+        :return:
+        """
+        removed = [topic for topic in topics if self.subscriptions.remove(topic)]
+        for topics in batches(removed):
+            self.clientMqtt.unsubscribe(topics)
+            self.logger.d("unsubscribe on %s", topics)
+        self.update_writer()
+
+    def replace_subscriptions(self, subscriptions):
+        """
+        Replace every subscription of the client, only sending what changed. Filters of the
+        topic handlers (and the RPC reply topic) stay subscribed.
+        """
+        subscriptions = SubscriptionSet(subscriptions)
+        for topic in self.dispatcher.topic_filters:
+            if topic not in subscriptions:
+                subscriptions.add(topic)
+        to_subscribe, to_unsubscribe = self.subscriptions.replace(subscriptions)
+        for batch in batches(to_subscribe):
+            self.clientMqtt.subscribe(batch)
+        for batch in batches(to_unsubscribe):
+            self.clientMqtt.unsubscribe(batch)
+        self.logger.d("subscriptions replaced, subscribe on %s, unsubscribe on %s", to_subscribe, to_unsubscribe)
+        self.update_writer()
+
+    async def messages(self, topic_filter):
+        """
+        Asynchronous iterator over messages matching topic_filter.
+        The filter is subscribed if it isn't part of topic_list.
+
+            async for msg in self.messages("sensors/+/temperature"):
+                self.logger.d("%s %s", msg.topic, msg.payload)
+        """
+        queue = asyncio.Queue()
+        self.streams.add(topic_filter, queue)
+        if topic_filter not in self.subscriptions:
+            self.subscribe_mqtt(topic_filter)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self.streams.remove(topic_filter, queue)
+
+    # overrided by children
+    def parse_mqtt(self, parsed_json, topic):
+        """
+        Called for messages matching neither a handler nor a messages() iterator.
+        May be a coroutine function.
+        """
+        pass
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        """
+        Publish raw bytes. Every publish of the client goes through here.
+        Over a rate limit, waits, or drops or coalesces the message, as set by rate_policy.
+        :return: Future resolved with the message id once the message is written (QoS 0)
+                 or acknowledged by the broker (QoS 1 and 2), with None if the message was dropped
+                 or coalesced. It fails with ConnectionError if a QoS 0 message can't be written,
+                 or when the client is closed.
+        """
+        if self.rate_limiter is not None:
+            admitted = self.rate_limiter.admit(topic, payload, qos, retain)
+            if admitted is False:
+                future = self.loop.create_future()
+                future.set_result(None)
+                return future
+            if admitted is not True:
+                return self.loop.create_task(self.publish_blocked(admitted, topic, payload, qos, retain))
+        return self.send_raw(topic, payload, qos, retain)
+
+    async def publish_blocked(self, admitted, topic, payload, qos, retain):
+        await self.rate_limiter.acquire_blocked(admitted)
+        return await self.send_raw(topic, payload, qos, retain)
+
+    def send_coalesced(self, topic, payload, qos, retain):
+        """
+        Publish a coalesced message, called by the thread of the rate limiter
+        """
+        self.loop.call_soon_threadsafe(self.send_raw, topic, payload, qos, retain)
+
+    def send_raw(self, topic, payload, qos=0, retain=False):
+        """
+        Publish a message allowed by the rate limits
+        :return: See publish
+        """
+        future = self.loop.create_future()
+        info = self.clientMqtt.publish(topic, payload, qos, retain)
+        if info.mid in self.published_mids:
+            self.published_mids.discard(info.mid)
+            future.set_result(info.mid)
+        elif info.rc != mqtt.MQTT_ERR_SUCCESS and (qos == 0 or info.rc != mqtt.MQTT_ERR_NO_CONN):
+            # Without connection, paho only keeps QoS 1 and 2 messages until the reconnection
+            future.set_exception(ConnectionError("Publish on %s failed : %s" % (topic, mqtt.error_string(info.rc))))
+            return future
+        else:
+            self.pending_publish[info.mid] = (future, qos)
+        metrics.inc(self.metric_keys["published"])
+        metrics.inc(self.metric_keys["published_bytes"], len(payload))
+        self.update_writer()
+        return future
+
+    async def publish_mqtt(self, id, payload, topic, qos=0):
+        """
+        Publish MQTT message and wait for its completion
+        :param id:
+        :param payload:
+        :param topic:
+        :param qos:
+        :return: message id
+        """
+        self.logger.d("mqtt message sent")
+        if id == "":
+            id = None
+        dict_to_send = {"id": id, "payload": payload}
+        span = tracer.start_span("mqtt.publish", attributes={"service": self.service_name, "topic": topic})
+        if span is None:
+            self.logger.d("%s %s", topic, dict_to_send)
+            return await self.publish(topic, self.codecs.encode(topic, dict_to_send), qos)
+        # Handlers of this message continue the trace, the span lasts until the publish completes
+        dict_to_send[TRACE_KEY] = span.context()
+        self.logger.d("%s %s", topic, dict_to_send)
+        try:
+            return await self.publish(topic, self.codecs.encode(topic, dict_to_send), qos)
+        finally:
+            tracer.finish(span)
+
+    async def publish_json_mqtt(self, parsed_json, topic, qos=0):
+        """
+        Publish parsed_json without interpretation and wait for its completion
+        :param parsed_json:
+        :param topic:
+        :param qos:
+        :return: message id
+        """
+        self.logger.d("mqtt message sent")
+        self.logger.d("%s %s", topic, parsed_json)
+        return await self.publish(topic, self.codecs.encode(topic, parsed_json), qos)
+
+    async def call(self, topic, payload, timeout=RPC_TIMEOUT, qos=0):
+        """
+        Send a request on topic, to be answered by an @rpc_handler of another service,
+        and wait for its reply
+        :param payload: Request payload, given to the handler
+        :param timeout: Seconds before the call fails with RpcTimeout
+        :return: payload of the reply. Raises RpcError if the remote handler failed.
+        """
+        if self.rpc_calls is None:
+            self.rpc_calls = PendingCalls(scheduler=False)
+            self.rpc_reply_topic = "%s/%s/%08x" % (RPC_REPLY_TOPIC, self.service_name, getrandbits(32))
+            self.dispatcher.add(self.rpc_reply_topic, self.on_rpc_reply)
+            self.subscribe_mqtt(self.rpc_reply_topic)
+
+        future = self.loop.create_future()
+        call_id = self.rpc_calls.add(future)
+        expiration = self.loop.call_later(timeout, self.rpc_calls.expire, call_id)
+        try:
+            request = tracer.inject(make_request(call_id, payload, self.rpc_reply_topic))
+            self.logger.d("call %s %s", topic, request)
+            await self.publish(topic, self.codecs.encode(topic, request), qos)
+            return await future
+        finally:
+            expiration.cancel()
+            self.rpc_calls.discard(call_id)
+
+    async def reply(self, request, payload, error=None, qos=0):
+        """
+        Answer a request received from call(). Requests without reply topic are ignored.
+        :param request: parsed_json of the request
+        :param error: Error message, raised as RpcError by the caller
+        """
+        topic = reply_topic(request)
+        if topic is not None:
+            await self.publish(topic, self.codecs.encode(topic, make_reply(request, payload, error)), qos)
+
+    def on_rejected_message(self, topic, error):
+        """
+        Called when a message doesn't match the schema of its handler
+        """
+        metrics.inc(self.metric_keys["rejected"])
+        self.logger.w("Message on %s rejected : %s", topic, error)
+
+    def rate_stats(self):
+        """
+        Returns how often each rate limit of the client refused a publish, None if there is no limit
+        """
+        if self.rate_limiter is None:
+            return None
+        return self.rate_limiter.stats()
+
+    def on_rpc_reply(self, parsed_json, topic):
+        if not self.rpc_calls.resolve(parsed_json):
+            self.logger.d("Reply to an unknown or expired call : %s", parsed_json)
+
+    def disconnect_mqtt(self):
+        """
+        Disconnect from the broker. Safe to call from any thread.
+        :return:
+        """
+        if self.loop is None:
+            return
+        self.loop.call_soon_threadsafe(self.close)
+
+    def close(self):
+        self.closing = True
+        if self.rate_limiter is not None:
+            self.rate_limiter.stop()
+        if self.misc_task is not None:
+            self.misc_task.cancel()
+        # The socket is unwatched by on_disconnect once the broker closes it
+        self.clientMqtt.disconnect()
+        if self.clientMqtt.socket() is None:
+            # Already disconnected, on_disconnect won't be called
+            self.fail_publishes(True)
+        self.update_writer()
@@ -0,0 +1,329 @@
+import paho.mqtt.client as mqtt
+from config import *
+from log import Logger
+from broker.topic_trie import TopicTrie
+from broker.subscriptions import batches
+from broker.connection import set_nodelay
+import threading
+import socket
+import sys
+
+
+class PooledConnection:
+    """
+    One paho client shared by several MqttClient instances.
+    Subscriptions are reference counted so that a topic is only subscribed once on the
+    broker (with the highest QoS asked for it), and inbound messages are routed to every
+    attached client whose filters match.
+    """
+
+    def __init__(self, logger, mqtt_host, mqtt_port, index, retry=False):
+        """
+        Create a shared connection and start its network loop
+        :param logger: Logger of the pool
+        :param mqtt_host: Address of mqtt server
+        :param mqtt_port: Port to connect to server
+        :param index: Index of the connection inside its pool
+        :param retry: If the broker is unreachable, keep retrying from the network loop instead of raising
+        """
+        self.logger = logger
+        self.index = index
+        self.members = []
+        # topic => {client: qos}
+        self.subscriptions = {}
+        self.routes = TopicTrie()
+        # SUBSCRIBE message id => topics, and topics acknowledged by the broker
+        self.pending_subacks = {}
+        self.acknowledged = set()
+        self.connected = False
+        self.lock = threading.RLock()
+
+        self.clientMqtt = mqtt.Client()
+        self.clientMqtt.on_message = self.on_message
+        self.clientMqtt.on_connect = self.on_connect
+        self.clientMqtt.on_disconnect = self.on_disconnect
+        self.clientMqtt.on_subscribe = self.on_subscribe
+        try:
+            self.clientMqtt.connect(mqtt_host, mqtt_port)
+        except (OSError, socket.error):
+            if not retry:
+                raise
+            self.logger.w("Broker %s:%s unreachable, connection %d retried in background", mqtt_host, mqtt_port,
+                          index)
+            self.clientMqtt.connect_async(mqtt_host, mqtt_port)
+        self.clientMqtt.loop_start()
+
+        self.logger.v("Shared connection " + str(index) + " init")
+
+    def attach(self, client):
+        """
+        Attach an MqttClient to this connection. Its topics are subscribed by update().
+        :param client: MqttClient instance
+        :return:
+        """
+        with self.lock:
+            self.members.append(client)
+            if self.connected:
+                self.unsubscribe_unused(client.topic_list_unsubscribe)
+                client.mqtt_connect_event.set()
+
+    def unsubscribe_unused(self, topics):
+        """
+        Unsubscribe topics left by a previous session (topic_list_unsubscribe of a client),
+        except those an attached client subscribes to
+        """
+        topics = [topic for topic in topics if topic not in self.subscriptions]
+        if topics:
+            self.clientMqtt.unsubscribe(topics)
+            self.logger.d("unsubscribe on %s", topics)
+
+    def detach(self, client):
+        """
+        Detach an MqttClient, unsubscribing topics nobody else listens to
+        :param client: MqttClient instance
+        :return:
+        """
+        with self.lock:
+            if client in self.members:
+                self.members.remove(client)
+            self.update(client, [], [topic for topic, clients in self.subscriptions.items() if client in clients])
+
+    def update(self, client, to_subscribe, to_unsubscribe):
+        """
+        Change the subscriptions of client. Broker is only contacted for topics without
+        subscriber yet (or asked with a higher QoS), in a single SUBSCRIBE, and for topics
+        left without subscriber, in a single UNSUBSCRIBE.
+        :param client: MqttClient instance
+        :param to_subscribe: [(topic, qos)]
+        :param to_unsubscribe: [topic]
+        :return: [(mid, topics)] of the SUBSCRIBE packets acknowledging the new topics of client,
+                 None if the connection is down (topics are subscribed on connection)
+        """
+        with self.lock:
+            new_topics = []
+            pending = []
+            for topic, qos in to_subscribe:
+                clients = self.subscriptions.setdefault(topic, {})
+                broker_qos = max(clients.values()) if clients else None
+                if client not in clients:
+                    self.routes.add(topic, client)
+                clients[client] = qos
+                if broker_qos is None or qos > broker_qos:
+                    new_topics.append((topic, qos))
+                elif topic in self.acknowledged:
+                    client.on_subscribe(self.clientMqtt, None, None, None)
+                else:
+                    # Subscribed for another client, SUBACK not received yet
+                    pending.extend((mid, topics) for mid, topics in self.pending_subacks.items()
+                                   if topic in topics and (mid, topics) not in pending)
+
+            removed = []
+            for topic in to_unsubscribe:
+                clients = self.subscriptions.get(topic)
+                if clients is None or client not in clients:
+                    continue
+                del clients[client]
+                self.routes.remove(topic, client)
+                if len(clients) == 0:
+                    del self.subscriptions[topic]
+                    self.acknowledged.discard(topic)
+                    removed.append(topic)
+
+            if not self.connected:
+                return None
+            for subscriptions in batches(new_topics):
+                pending.append(self.send_subscribe(subscriptions))
+            for topics in batches(removed):
+                self.clientMqtt.unsubscribe(topics)
+                self.logger.d("unsubscribe on %s", topics)
+            return pending
+
+    def subscribe(self, client, topic, qos=0):
+        """
+        Add a subscription of client on topic
+        :param client: MqttClient instance
+        :param topic: Topic filter
+        :param qos:
+        :return:
+        """
+        self.update(client, [(topic, qos)], [])
+
+    def send_subscribe(self, subscriptions):
+        """
+        Subscribe [(topic, qos)] in a single SUBSCRIBE
+        :return: (mid, topics)
+        """
+        topics = [topic for topic, qos in subscriptions]
+        result, mid = self.clientMqtt.subscribe(subscriptions)
+        self.pending_subacks[mid] = topics
+        self.logger.d("subscribe on %s", topics)
+        return mid, topics
+
+    def unsubscribe(self, client, topic):
+        """
+        Remove a subscription of client on topic
+        :param client: MqttClient instance
+        :param topic: Topic filter
+        :return:
+        """
+        self.update(client, [], [topic])
+
+    def load(self):
+        return len(self.members)
+
+    def on_connect(self, client, userdata, flags, rc):
+        """
+        Called by paho when the shared connection is (re)connected.
+        Subscribe every topic used by attached clients then release them.
+        """
+        try:
+            set_nodelay(client)
+            with self.lock:
+                self.connected = True
+                for subscriptions in batches([(topic, max(clients.values()))
+                                              for topic, clients in self.subscriptions.items()]):
+                    self.send_subscribe(subscriptions)
+                unsubscribe = []
+                for member in self.members:
+                    unsubscribe.extend(topic for topic in member.topic_list_unsubscribe if topic not in unsubscribe)
+                self.unsubscribe_unused(unsubscribe)
+                for member in self.members:
+                    member.mqtt_connect_event.set()
+                    if member.spool_drainer is not None:
+                        # Spooled publishes go out on the shared connection
+                        member.spool_drainer.wake()
+        except Exception as e:
+            import traceback
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            exceptionStr = (
+                    os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+                    + ", line "
+                    + str(exc_tb.tb_lineno)
+                    + " : "
+                    + str(e) +
+                    "".join(traceback.format_tb(e.__traceback__))
+            )
+            self.logger.e(exceptionStr)
+
+    def on_disconnect(self, client, userdata, rc):
+        with self.lock:
+            self.connected = False
+            self.pending_subacks.clear()
+            self.acknowledged.clear()
+
+    def on_subscribe(self, client, userdata, mid, granted_qos):
+        """
+        Forward a SUBACK to the clients subscribed on its topics
+        """
+        with self.lock:
+            topics = self.pending_subacks.pop(mid, None)
+            if topics is None:
+                return
+            targets = []
+            for topic in topics:
+                self.acknowledged.add(topic)
+                for member in self.subscriptions.get(topic, []):
+                    if member not in targets:
+                        targets.append(member)
+        for member in targets:
+            member.on_subscribe(client, userdata, mid, granted_qos)
+
+    def on_message(self, client, user_data, msg):
+        """
+        Route a message received on the shared connection to matching clients.
+        A client subscribed with overlapping filters receives the message only once.
+        """
+        targets = []
+        with self.lock:
+            for member in self.routes.match(msg.topic):
+                if member not in targets:
+                    targets.append(member)
+
+        for member in targets:
+            try:
+                member.on_message(client, user_data, msg)
+            except Exception as e:
+                import traceback
+                exc_type, exc_obj, exc_tb = sys.exc_info()
+                exceptionStr = (
+                        os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+                        + ", line "
+                        + str(exc_tb.tb_lineno)
+                        + " : "
+                        + str(e) +
+                        "".join(traceback.format_tb(e.__traceback__))
+                )
+                self.logger.e(exceptionStr)
+
+    def close(self):
+        self.clientMqtt.loop_stop()
+        self.clientMqtt.disconnect()
+
+
+class MqttConnectionPool:
+    """
+    Small pool of broker connections shared by many MqttClient instances.
+    Connections are opened lazily, and each client is attached to the least loaded one.
+    """
+
+    def __init__(self, mqtt_host, mqtt_port, size):
+        """
+        Create a connection pool
+        :param mqtt_host: Address of mqtt server
+        :param mqtt_port: Port to connect to server
+        :param size: Maximum number of broker connections
+        """
+        self.logger = Logger("MqttPool")
+        self.mqtt_host = mqtt_host
+        self.mqtt_port = mqtt_port
+        self.size = max(1, size)
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def acquire(self, client, retry=False):
+        """
+        Attach client to a connection of the pool
+        :param client: MqttClient instance
+        :param retry: If a new connection can't reach the broker, retry in background instead of raising
+        :return: The PooledConnection client is attached to
+        """
+        with self.lock:
+            if len(self.connections) < self.size and all(c.load() > 0 for c in self.connections):
+                self.connections.append(
+                    PooledConnection(self.logger, self.mqtt_host, self.mqtt_port, len(self.connections), retry)
+                )
+            connection = min(self.connections, key=lambda c: c.load())
+        connection.attach(client)
+        return connection
+
+    def release(self, client):
+        """
+        Detach client from its connection
+        :param client: MqttClient instance
+        :return:
+        """
+        for connection in self.connections:
+            connection.detach(client)
+
+    def close(self):
+        with self.lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
+
+
+shared_pools = {}
+shared_pools_lock = threading.Lock()
+
+
+def get_shared_pool(mqtt_host, mqtt_port):
+    """
+    Returns the process-wide pool for a broker, or None if pooling is disabled (MQTT_POOL_SIZE = 0)
+    """
+    if MQTT_POOL_SIZE <= 0:
+        return None
+    with shared_pools_lock:
+        key = (mqtt_host, mqtt_port)
+        if key not in shared_pools:
+            shared_pools[key] = MqttConnectionPool(mqtt_host, mqtt_port, MQTT_POOL_SIZE)
+        return shared_pools[key]
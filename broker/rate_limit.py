@@ -0,0 +1,344 @@
+from config import *
+from broker.topic_trie import TopicTrie
+from metrics import metrics, metric_key
+import threading
+import time
+import sys
+
+# What a publish refused by a limit becomes
+# The publishing thread waits for a token
+RATE_BLOCK = "block"
+# The message is dropped
+RATE_DROP = "drop"
+# The message waits for a token, replaced by the next message published on its topic meanwhile
+RATE_COALESCE = "coalesce"
+RATE_POLICIES = [RATE_BLOCK, RATE_DROP, RATE_COALESCE]
+
+# Options of services.conf setting the limits of a service
+RATE_OPTIONS = ["rate", "burst", "rate_policy", "topic_rate"]
+
+# Budget of every publish of the node, set by the Core (see set_global_budget)
+global_budget = None
+# Class name of a service => MqttClient keyword arguments set in services.conf (see configure_service)
+service_limits = {}
+
+
+class TokenBucket(object):
+    """
+    Token bucket : rate tokens are added per second, up to burst, and a publish takes one.
+    The state may live in shared memory (a multiprocessing Array of 2 doubles, with its lock)
+    so that worker processes of the Core draw from the same bucket.
+    """
+
+    def __init__(self, rate, burst=None, state=None, lock=None):
+        """
+        :param rate: Tokens added per second
+        :param burst: Maximum tokens, rate (one second of publishes) by default
+        :param state: Mutable sequence [tokens, time of the last refill], a new full bucket by default
+        :param lock: Lock protecting state, required with a shared state
+        """
+        if rate <= 0:
+            raise ValueError("Rate must be positive : " + str(rate))
+        self.rate = float(rate)
+        self.burst = float(max(1, burst if burst else rate))
+        self.state = state if state is not None else [self.burst, time.time()]
+        self.lock = lock if lock is not None else threading.Lock()
+
+    def take(self, now=None):
+        """
+        Take a token if there is one
+        :return: 0 if a token was taken, otherwise seconds until there is one
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            tokens = min(self.burst, self.state[0] + max(0.0, now - self.state[1]) * self.rate)
+            self.state[1] = now
+            if tokens >= 1:
+                self.state[0] = tokens - 1
+                return 0.0
+            self.state[0] = tokens
+            return (1 - tokens) / self.rate
+
+    def refund(self):
+        """
+        Give back a token taken for a publish refused by another limit
+        """
+        with self.lock:
+            self.state[0] = min(self.burst, self.state[0] + 1)
+
+
+def shared_bucket(rate, burst, context):
+    """
+    Returns a TokenBucket in shared memory, given to worker processes when they are started
+    :param context: multiprocessing context of the worker processes
+    """
+    burst = float(max(1, burst if burst else rate))
+    state = context.Array('d', [burst, time.time()])
+    return TokenBucket(rate, burst, state, state.get_lock())
+
+
+def set_global_budget(bucket):
+    """
+    Every MqttClient created afterwards in the process takes a token from bucket for each publish,
+    None removes the budget
+    """
+    global global_budget
+    global_budget = bucket
+
+
+def get_global_budget():
+    return global_budget
+
+
+def configure_service(class_name, limits):
+    """
+    Limits of the MqttClient of a service, overriding its constructor arguments
+    :param limits: Result of parse_rate_options, None to remove them
+    """
+    if limits:
+        service_limits[class_name] = limits
+    else:
+        service_limits.pop(class_name, None)
+
+
+def parse_rate_options(options):
+    """
+    Returns the MqttClient keyword arguments set by the options of a service in services.conf :
+        rate=<messages/s>, burst=<messages>, rate_policy=block|drop|coalesce,
+        topic_rate=<topic filter>:<messages/s>[:<policy>][|<topic filter>:...]
+    :param options: dict option => value
+    :raise ValueError: if an option is wrong
+    """
+    limits = {}
+    if options.get("rate"):
+        limits["rate_limit"] = float(options["rate"])
+    if options.get("burst"):
+        limits["rate_burst"] = float(options["burst"])
+    if options.get("rate_policy"):
+        if options["rate_policy"] not in RATE_POLICIES:
+            raise ValueError("Unknown rate policy : " + options["rate_policy"])
+        limits["rate_policy"] = options["rate_policy"]
+    if options.get("topic_rate"):
+        topic_limits = {}
+        for topic_rate in options["topic_rate"].split("|"):
+            fields = topic_rate.split(":")
+            if len(fields) not in (2, 3) or not fields[0]:
+                raise ValueError("Wrong topic rate : " + topic_rate)
+            policy = fields[2] if len(fields) == 3 else None
+            if policy is not None and policy not in RATE_POLICIES:
+                raise ValueError("Unknown rate policy : " + policy)
+            topic_limits[fields[0]] = (float(fields[1]), None, policy)
+        limits["topic_rate_limits"] = topic_limits
+    return limits
+
+
+class RateLimiter(object):
+    """
+    Limits the publishes of a client : a publish takes a token from the bucket of every topic
+    filter its topic matches, from the bucket of the client, and from the global budget.
+    When one of them is empty, the policy of the topic limit (or of the client) applies.
+    Tokens are only taken when every bucket has one.
+    """
+
+    def __init__(self, logger, send, service, rate=0, burst=None, policy=RATE_BLOCK, topic_limits=None,
+                 budget=None):
+        """
+        :param logger: Logger of the owning client
+        :param send: Callable taking (topic, payload, qos, retain), publishing coalesced messages
+        :param service: Service name, label of the metrics
+        :param rate: Publishes per second of the client, 0 for no limit
+        :param burst: Publishes allowed at once, rate by default
+        :param policy: block, drop or coalesce
+        :param topic_limits: dict topic filter => rate or (rate, burst, policy), a bucket per filter
+        :param budget: TokenBucket shared by every client
+        """
+        if policy not in RATE_POLICIES:
+            raise ValueError("Unknown rate policy : " + str(policy))
+        self.logger = logger
+        self.send = send
+        self.service = service
+        self.policy = policy
+        # Every limit is [name, bucket, policy, limited, dropped, coalesced, blocked seconds, metric key]
+        self.limits = []
+        self.service_limit = self.new_limit("service", TokenBucket(rate, burst), policy) if rate > 0 else None
+        self.global_limit = self.new_limit("global", budget, policy) if budget is not None else None
+        self.topic_limits = TopicTrie()
+        for topic_filter, limit in (topic_limits or {}).items():
+            if not isinstance(limit, (tuple, list)):
+                limit = (limit,)
+            limit = tuple(limit) + (None, None)
+            if limit[2] is not None and limit[2] not in RATE_POLICIES:
+                raise ValueError("Unknown rate policy : " + str(limit[2]))
+            self.topic_limits.add(topic_filter, self.new_limit(topic_filter, TokenBucket(limit[0], limit[1]),
+                                                               limit[2] or policy))
+        # Limits applying to a topic, by topic
+        self.topic_cache = {}
+
+        # Coalesced messages waiting for tokens : topic => [payload, qos, retain, refusing limit], in publish order
+        self.pending = {}
+        # Topics of the coalesced messages being published, a newer message waits for them
+        self.sending = set()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.thread = None
+        self.running = True
+
+    def new_limit(self, name, bucket, policy):
+        limit = [name, bucket, policy, 0, 0, 0, 0.0,
+                 metric_key("mqtt_rate_limited_total", service=self.service, limit=name)]
+        self.limits.append(limit)
+        return limit
+
+    def limits_of(self, topic):
+        limits = self.topic_cache.get(topic)
+        if limits is None:
+            limits = self.topic_limits.match(topic) if len(self.topic_limits) else []
+            if self.service_limit is not None:
+                limits.append(self.service_limit)
+            if self.global_limit is not None:
+                limits.append(self.global_limit)
+            if len(self.topic_cache) < 10000:
+                self.topic_cache[topic] = limits
+        return limits
+
+    def take(self, limits):
+        """
+        Take a token from every limit
+        :return: (0, None) if tokens were taken, otherwise (seconds to wait, refusing limit)
+        """
+        now = time.time()
+        for index, limit in enumerate(limits):
+            wait = limit[1].take(now)
+            if wait > 0:
+                for taken in limits[:index]:
+                    taken[1].refund()
+                return wait, limit
+        return 0.0, None
+
+    def acquire(self, topic, payload, qos=0, retain=False):
+        """
+        Called before publishing a message, blocks with the block policy
+        :return: True if the message must be published now, False if it was dropped or is coalesced
+        """
+        admitted = self.admit(topic, payload, qos, retain)
+        if admitted is True or admitted is False:
+            return admitted
+        wait, limit, limits = admitted
+        while limit is not None:
+            time.sleep(wait)
+            limit[6] += wait
+            wait, limit = self.take(limits)
+        return True
+
+    async def acquire_blocked(self, admitted):
+        """
+        Wait for the tokens of a publish blocked by admit, without blocking the event loop
+        of an asyncio client
+        :param admitted: Result of admit
+        """
+        import asyncio
+        wait, limit, limits = admitted
+        while limit is not None:
+            await asyncio.sleep(wait)
+            limit[6] += wait
+            wait, limit = self.take(limits)
+
+    def admit(self, topic, payload, qos=0, retain=False):
+        """
+        acquire, without waiting with the block policy
+        :return: True if the message must be published now, False if it was dropped or is coalesced,
+                 otherwise (seconds to wait, refusing limit, limits) to give to acquire_blocked
+        """
+        limits = self.limits_of(topic)
+        if not limits:
+            return True
+        policy = limits[0][2]
+        if policy == RATE_COALESCE and (self.pending or self.sending):
+            # Must not overtake the coalesced message of its topic
+            with self.lock:
+                waiting = self.pending.get(topic)
+                if waiting is not None:
+                    waiting[0:3] = payload, qos, retain
+                    waiting[3][5] += 1
+                    return False
+                if topic in self.sending:
+                    self.pending[topic] = [payload, qos, retain, limits[0]]
+                    return False
+        wait, limit = self.take(limits)
+        if limit is None:
+            return True
+        limit[3] += 1
+        metrics.inc(limit[7])
+        if policy == RATE_DROP:
+            limit[4] += 1
+            return False
+        if policy == RATE_COALESCE:
+            with self.lock:
+                self.pending[topic] = [payload, qos, retain, limit]
+                self.start()
+            return False
+        return wait, limit, limits
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="rate_limiter", daemon=True)
+            self.thread.start()
+        else:
+            self.wakeup.notify()
+
+    def run(self):
+        while True:
+            with self.lock:
+                self.sending.clear()
+                if not self.running:
+                    return
+                ready = []
+                wait = None
+                for topic in list(self.pending):
+                    delay, limit = self.take(self.limits_of(topic))
+                    if limit is None:
+                        ready.append((topic, self.pending.pop(topic)))
+                        self.sending.add(topic)
+                    elif wait is None or delay < wait:
+                        wait = delay
+                if not ready:
+                    self.wakeup.wait(wait)
+                    continue
+            for topic, (payload, qos, retain, limit) in ready:
+                try:
+                    self.send(topic, payload, qos, retain)
+                except Exception as e:
+                    import traceback
+                    exc_type, exc_obj, exc_tb = sys.exc_info()
+                    exceptionStr = (
+                            os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+                            + ", line "
+                            + str(exc_tb.tb_lineno)
+                            + " : "
+                            + str(e) +
+                            "".join(traceback.format_tb(e.__traceback__))
+                    )
+                    self.logger.e(exceptionStr)
+
+    def stats(self):
+        """
+        Returns, for each limit, how many publishes it refused, dropped and coalesced and the
+        seconds publishing threads were blocked, and the number of coalesced messages waiting
+        """
+        stats = {"pending": len(self.pending)}
+        for name, bucket, policy, limited, dropped, coalesced, blocked, key in self.limits:
+            stats[name] = {"policy": policy, "limited": limited, "dropped": dropped, "coalesced": coalesced,
+                           "blocked": blocked}
+        return stats
+
+    def stop(self):
+        """
+        Stop the coalescing thread, waiting coalesced messages are dropped
+        """
+        with self.lock:
+            if self.pending:
+                self.logger.w("%d coalesced messages dropped", len(self.pending))
+                self.pending.clear()
+            self.running = False
+            self.wakeup.notify()
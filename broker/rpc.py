@@ -0,0 +1,202 @@
+from config import *
+from broker.dispatch import topic_handler
+from broker.schema import SchemaError
+import functools
+import heapq
+import inspect
+import itertools
+import threading
+import time
+
+REPLY_TO_KEY = "reply_to"
+ERROR_KEY = "error"
+
+
+class RpcError(Exception):
+    """
+    Raised by a call when the remote handler failed, with its error message
+    """
+    pass
+
+
+class RpcTimeout(Exception):
+    """
+    Raised by a call when no reply was received in time
+    """
+    pass
+
+
+def make_request(call_id, payload, reply_to):
+    """
+    Returns the envelope of a request : the publish_mqtt envelope and the topic to answer on
+    """
+    return {"id": call_id, "payload": payload, REPLY_TO_KEY: reply_to}
+
+
+def make_reply(request, payload, error=None):
+    """
+    Returns the envelope answering request
+    """
+    reply = {"id": request.get("id"), "payload": payload}
+    if error is not None:
+        reply[ERROR_KEY] = error
+    return reply
+
+
+def reply_topic(request):
+    """
+    Returns the topic a request must be answered on, None if it doesn't expect an answer
+    """
+    if type(request) is dict:
+        return request.get(REPLY_TO_KEY)
+    return None
+
+
+class PendingCalls(object):
+    """
+    Calls waiting for their reply, by id. Futures are resolved by resolve() when the
+    reply is received, or fail with RpcTimeout when expire() is called for them.
+
+    With scheduler=True, a thread expires calls at their deadline (futures of
+    concurrent.futures). Otherwise the owner calls expire() itself (asyncio futures,
+    from the event loop).
+    """
+
+    def __init__(self, scheduler=True):
+        self.ids = itertools.count(1)
+        self.calls = {}
+        self.deadlines = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.scheduler = scheduler
+        self.thread = None
+        self.completed = 0
+        self.timeouts = 0
+
+    def add(self, future, timeout=None):
+        """
+        Register the future of a call
+        :return: id of the call
+        """
+        call_id = next(self.ids)
+        with self.lock:
+            self.calls[call_id] = future
+            if self.scheduler and timeout is not None:
+                heapq.heappush(self.deadlines, (time.time() + timeout, call_id))
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, name="rpc_timeouts", daemon=True)
+                    self.thread.start()
+                elif self.deadlines[0][1] == call_id:
+                    self.wakeup.notify()
+        return call_id
+
+    def resolve(self, reply):
+        """
+        Complete the call answered by reply
+        :return: False if the call is unknown (already expired, or not ours)
+        """
+        if type(reply) is not dict:
+            return False
+        with self.lock:
+            future = self.calls.pop(reply.get("id"), None)
+            if future is None:
+                return False
+            self.completed += 1
+        if future.done():
+            return False
+        if reply.get(ERROR_KEY) is not None:
+            future.set_exception(RpcError(reply[ERROR_KEY]))
+        else:
+            future.set_result(reply.get("payload"))
+        return True
+
+    def expire(self, call_id):
+        """
+        Fail a call with RpcTimeout if it is still waiting
+        """
+        with self.lock:
+            future = self.calls.pop(call_id, None)
+            if future is None:
+                return
+            self.timeouts += 1
+        if not future.done():
+            future.set_exception(RpcTimeout("No reply to call " + str(call_id)))
+
+    def discard(self, call_id):
+        with self.lock:
+            self.calls.pop(call_id, None)
+
+    def run(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                expired = []
+                while self.deadlines and self.deadlines[0][0] <= now:
+                    expired.append(heapq.heappop(self.deadlines)[1])
+                if not expired:
+                    self.wakeup.wait(self.deadlines[0][0] - now if self.deadlines else None)
+                    continue
+            for call_id in expired:
+                self.expire(call_id)
+
+    def stats(self):
+        with self.lock:
+            return {"pending": len(self.calls), "completed": self.completed, "timeouts": self.timeouts}
+
+
+def rpc_handler(*topic_filters, schema=None):
+    """
+    Decorator declaring a service method as the handler of requests sent with call() on
+    one or more topic filters. The method is called with (payload, topic) and what it
+    returns is sent back to the caller. An exception is sent back as an error, raised
+    by the caller's call() as RpcError. Coroutine methods are supported on AsyncMqttClient.
+    With a Schema, the method is called with the Message built from the payload, and
+    payloads not matching the schema are answered with an error.
+
+        @rpc_handler("alarm/rpc/get_state")
+        def get_state(self, payload, topic):
+            return {"armed": self.armed}
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def handler(self, parsed_json, topic):
+            payload = parsed_json.get("payload") if type(parsed_json) is dict else None
+            try:
+                if schema is not None:
+                    payload = schema.load(payload)
+                result = method(self, payload, topic)
+            except SchemaError as e:
+                self.on_rejected_message(topic, e)
+                return self.reply(parsed_json, None, "Invalid request : " + str(e))
+            except Exception as e:
+                log_handler_error(self.logger, e)
+                return self.reply(parsed_json, None, str(e))
+            if inspect.iscoroutine(result):
+                return reply_when_done(self, parsed_json, result)
+            return self.reply(parsed_json, result)
+
+        return topic_handler(*topic_filters)(handler)
+    return decorator
+
+
+async def reply_when_done(client, request, coroutine):
+    try:
+        result = await coroutine
+    except Exception as e:
+        log_handler_error(client.logger, e)
+        await client.reply(request, None, str(e))
+        return
+    await client.reply(request, result)
+
+
+def log_handler_error(logger, e):
+    import traceback
+    exceptionStr = (
+            os.path.split(e.__traceback__.tb_frame.f_code.co_filename)[1]
+            + ", line "
+            + str(e.__traceback__.tb_lineno)
+            + " : "
+            + str(e) +
+            "".join(traceback.format_tb(e.__traceback__))
+    )
+    logger.e("RPC handler error : " + exceptionStr)
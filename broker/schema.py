@@ -0,0 +1,235 @@
+import keyword
+
+"""
+    Message schemas. A schema is declared once, with the fields expected in a decoded payload,
+    and compiled into a loader function checking every field and building a Message object
+    (__slots__ class, one attribute per field). Handlers declared with a schema receive that
+    object instead of the decoded dict, and malformed payloads never reach them.
+
+        SetState = Schema("SetState", {
+            "command": str,
+            "zone": int,
+            "armed": Field(bool, required=False, default=False),
+            "sensors": Field(list, items=str, required=False),
+        })
+
+        @topic_handler("alarm/set_state", schema=SetState)
+        def on_set_state(self, message, topic):
+            self.zones[message.zone] = message.armed
+"""
+
+MISSING = object()
+
+# JSON numbers without a fraction are decoded as int, where a float is expected too
+ACCEPTED_TYPES = {float: (float, int)}
+
+
+class SchemaError(ValueError):
+    """
+    Raised by Schema.load when a payload doesn't match the schema
+    """
+    pass
+
+
+class Field(object):
+    """
+    Declaration of a schema field. A bare type (or Schema) in a schema stands for a
+    required field of that type.
+    """
+
+    def __init__(self, types=object, required=True, default=None, nullable=False, items=None, key=None):
+        """
+        :param types: Type, tuple of types or Schema of the value. object accepts anything.
+        :param required: If False, default is used when the key is missing
+        :param default: Value of a missing optional field, must not be modified (shared by messages)
+        :param nullable: Accept None as value
+        :param items: Type or Schema of the elements, for list fields
+        :param key: Key of the field in the payload, if it isn't a valid attribute name
+        """
+        self.types = types
+        self.required = required
+        self.default = default
+        self.nullable = nullable
+        self.items = items
+        self.key = key
+
+
+class Message(object):
+    """
+    Base class of the objects built by schemas
+    """
+    __slots__ = ()
+    schema = None
+
+    def as_dict(self):
+        """
+        Returns the payload of the message, to publish it
+        """
+        return self.schema.dump(self)
+
+    def __eq__(self, other):
+        return type(other) is type(self) and all(
+            getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self):
+        return "%s(%s)" % (type(self).__name__, ", ".join(
+            "%s=%r" % (name, getattr(self, name)) for name in self.__slots__))
+
+
+def type_names(types):
+    return "/".join(t.__name__ for t in types)
+
+
+class Schema(object):
+    """
+    Compiled description of a payload : a JSON object with typed fields
+    """
+
+    def __init__(self, name, fields, strict=False):
+        """
+        :param name: Name of the message class
+        :param fields: dict field name => type, tuple of types, Schema or Field, in payload order
+        :param strict: Reject payloads having keys not declared in fields
+        """
+        self.name = name
+        self.strict = strict
+        self.fields = {}
+        for attribute, field in fields.items():
+            if not isinstance(field, Field):
+                field = Field(field)
+            if field.key is None:
+                field.key = attribute
+            if not attribute.isidentifier() or keyword.iskeyword(attribute):
+                raise ValueError("Invalid field name : " + attribute)
+            self.fields[attribute] = field
+        self.message_class = type(name, (Message,), {"__slots__": tuple(self.fields), "schema": self})
+        self.load = self.compile()
+
+    def checked_types(self, types):
+        """
+        Returns the tuple of exact types accepted for types, None if anything is accepted
+        """
+        if not isinstance(types, tuple):
+            types = (types,)
+        if object in types:
+            return None
+        accepted = []
+        for checked in types:
+            for accepted_type in ACCEPTED_TYPES.get(checked, (checked,)):
+                if accepted_type not in accepted:
+                    accepted.append(accepted_type)
+        return tuple(accepted)
+
+    def compile(self):
+        """
+        Generate the loader of the schema : required keys are read in a single try block,
+        then every value is checked, without any loop over the fields
+        """
+        namespace = {"MISSING": MISSING, "SchemaError": SchemaError, "new": object.__new__,
+                     "cls": self.message_class, "known": frozenset(f.key for f in self.fields.values())}
+        lines = ["def load(obj):",
+                 "    if type(obj) is not dict:",
+                 "        raise SchemaError(%r %% type(obj).__name__)" % (self.name + " : expected an object, got %s")]
+        if self.strict:
+            lines += ["    if not known.issuperset(obj):",
+                      "        raise SchemaError(%r %% sorted(set(obj) - known))" % (self.name + " : unknown keys %s")]
+
+        fields = list(self.fields.values())
+        required = [index for index, field in enumerate(fields) if field.required]
+        if required:
+            lines.append("    try:")
+            lines += ["        value_%d = obj[%r]" % (index, fields[index].key) for index in required]
+            lines += ["    except KeyError as e:",
+                      "        raise SchemaError(%r %% e.args[0]) from None" % (self.name + ".%s : missing")]
+
+        for index, (attribute, field) in enumerate(self.fields.items()):
+            where = "%s.%s" % (self.name, attribute)
+            value = "value_%d" % index
+            if field.required:
+                indent = "    "
+                if field.nullable:
+                    lines.append("    if %s is not None:" % value)
+                    indent = "        "
+            else:
+                namespace["default_%d" % index] = field.default
+                lines += ["    %s = obj.get(%r, MISSING)" % (value, field.key),
+                          "    if %s is MISSING:" % value,
+                          "        %s = default_%d" % (value, index),
+                          "    elif %s is not None:" % value if field.nullable else "    else:"]
+                indent = "        "
+            checks = self.compile_value(field.types, field.items, index, where, indent, namespace)
+            lines += checks or [indent + "pass"]
+
+        lines.append("    message = new(cls)")
+        lines += ["    message.%s = value_%d" % (attribute, index) for index, attribute in enumerate(self.fields)]
+        lines.append("    return message")
+
+        code = compile("\n".join(lines), "<schema %s>" % self.name, "exec")
+        exec(code, namespace)
+        return namespace["load"]
+
+    def compile_value(self, types, items, index, where, indent, namespace):
+        """
+        Lines checking (and converting nested schemas of) value_<index>
+        """
+        value = "value_%d" % index
+        if isinstance(types, Schema):
+            namespace["load_%d" % index] = types.load
+            return [indent + "%s = load_%d(%s)" % (value, index, value)]
+        lines = []
+        accepted = self.checked_types(types)
+        if accepted is not None:
+            namespace["types_%d" % index] = accepted
+            if len(accepted) == 1 and accepted[0] in (int, float, str, bool, list, dict):
+                check = "type(%s) is not %s" % (value, accepted[0].__name__)
+            else:
+                check = "type(%s) not in types_%d" % (value, index)
+            lines += [indent + "if %s:" % check,
+                      indent + "    raise SchemaError(%r %% type(%s).__name__)" % (
+                          where + " : expected " + type_names(accepted) + ", got %s", value)]
+        if items is not None:
+            if isinstance(items, Schema):
+                namespace["items_%d" % index] = items.load
+                lines.append(indent + "%s = [items_%d(item) for item in %s]" % (value, index, value))
+            elif self.checked_types(items) is not None:
+                namespace["items_%d" % index] = self.checked_types(items)
+                lines += [indent + "for item in %s:" % value,
+                          indent + "    if type(item) not in items_%d:" % index,
+                          indent + "        raise SchemaError(%r %% type(item).__name__)" % (
+                              where + " : expected items of " + type_names(namespace["items_%d" % index])
+                              + ", got %s")]
+        return lines
+
+    def decode(self, payload, codec):
+        """
+        Decode an encoded payload and load it
+        :param codec: Codec (or CodecTable) with a decode method
+        """
+        return self.load(codec.decode(payload))
+
+    def dump(self, message):
+        """
+        Returns the payload of a message built by this schema
+        """
+        obj = {}
+        for attribute, field in self.fields.items():
+            value = getattr(message, attribute)
+            if isinstance(value, Message):
+                value = value.as_dict()
+            elif type(value) is list and isinstance(field.items, Schema):
+                value = [item.as_dict() for item in value]
+            obj[field.key] = value
+        return obj
+
+    def __call__(self, **values):
+        """
+        Build a message from field values, checked like a received payload
+        """
+        return self.load({self.fields[attribute].key: value for attribute, value in values.items()})
+
+    def __repr__(self):
+        return "Schema(%s)" % self.name
+
+
+# Payload of the legacy {"command", "data"} messages read by parse_mqtt
+Command = Schema("Command", {"command": str, "data": Field(required=False)})
@@ -0,0 +1,351 @@
+from config import *
+from collections import deque
+import mmap
+from random import getrandbits
+import threading
+import socket
+import struct
+import time
+
+"""
+    Large payloads shared between the services of a host. The publisher copies the data once
+    into a shared memory segment and publishes a small handle :
+
+        {"shm": {"name": segment, "offset": 4096, "length": 1048576, "generation": 12,
+                 "host": hostname, "ack": ack topic or None}, "meta": {...}}
+
+    Subscribers of the same host map the segment and read the data through a memoryview,
+    without copy. A block is reused once its lease expired, or sooner when the number of
+    consumers given to publish_shared released it. The generation written before the data
+    lets readers detect a block reused under them.
+"""
+
+SHARED_KEY = "shm"
+META_KEY = "meta"
+# Generation of the block, before its data
+BLOCK_HEADER = struct.Struct("<Q")
+BLOCK_ALIGN = 64
+# Readers of other processes keep at most SHARED_ATTACH_MAX segments mapped
+SHARED_ATTACH_MAX = 64
+
+HOST = socket.gethostname()
+
+
+class StalePayload(Exception):
+    """
+    Raised when a block was reused by its publisher (lease expired) or its segment is gone
+    """
+    pass
+
+
+def is_shared(parsed_json):
+    """
+    Returns True if a received message is the handle of a shared payload
+    """
+    return type(parsed_json) is dict and type(parsed_json.get(SHARED_KEY)) is dict
+
+
+def attach(name):
+    """
+    Map a segment created by another process, read only. SharedMemory isn't used : it registers
+    the segment to the resource tracker (shared with the Core by process services), which would
+    unlink it when the reader exits.
+    :return: mmap
+    :raise StalePayload: if the platform has no POSIX shared memory
+    """
+    try:
+        from _posixshmem import shm_open
+    except ImportError:
+        raise StalePayload("Shared payloads of other processes need POSIX shared memory")
+    fd = shm_open("/" + name, os.O_RDONLY, 0o600)
+    try:
+        return mmap.mmap(fd, os.fstat(fd).st_size, access=mmap.ACCESS_READ)
+    finally:
+        os.close(fd)
+
+
+class SharedBlock(object):
+    __slots__ = ("offset", "end", "generation", "deadline", "consumers")
+
+    def __init__(self, offset, end, generation, deadline, consumers):
+        self.offset = offset
+        self.end = end
+        self.generation = generation
+        self.deadline = deadline
+        # Releases still expected, None if the block only expires
+        self.consumers = consumers
+
+
+class SharedSegment(object):
+    """
+    Shared memory segment used as a ring : blocks are allocated after the newest one and
+    freed from the oldest one
+    """
+
+    def __init__(self, store, name, size):
+        """
+        :param store: SharedPayloadStore the segment belongs to
+        """
+        # Imported here : loading multiprocessing slows down the startup of every service
+        from multiprocessing import shared_memory
+        self.store = store
+        self.memory = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self.name = self.memory.name
+        self.size = size
+        self.blocks = deque()
+        self.head = 0
+
+    def reclaim(self, now):
+        """
+        Free the oldest blocks, released or expired
+        :return: Number of blocks freed because their lease expired
+        """
+        expired = 0
+        while self.blocks and (self.blocks[0].consumers == 0 or self.blocks[0].deadline <= now):
+            if self.blocks.popleft().consumers != 0:
+                expired += 1
+        if not self.blocks:
+            self.head = 0
+        return expired
+
+    def allocate(self, size):
+        """
+        Returns the offset of a free area of size bytes, None if there is none
+        """
+        if not self.blocks:
+            return 0 if size <= self.size else None
+        oldest = self.blocks[0].offset
+        if self.head > oldest:
+            if self.head + size <= self.size:
+                return self.head
+            # Wrap around
+            return 0 if size <= oldest else None
+        return self.head if self.head + size <= oldest else None
+
+    def used(self):
+        return sum(block.end - block.offset for block in self.blocks)
+
+    def close(self):
+        self.memory.unlink()
+        try:
+            self.memory.close()
+        except BufferError:
+            # Payloads of the segment are still open in the process, it is unmapped with them
+            pass
+
+
+class SharedPayloadStore(object):
+    """
+    Segments of a publisher. Segments are created on demand, up to max_segments, a payload
+    larger than segment_size getting a segment of its own.
+    """
+
+    def __init__(self, logger, segment_size=MQTT_SHARED_SEGMENT_SIZE, max_segments=MQTT_SHARED_MAX_SEGMENTS,
+                 lease=MQTT_SHARED_LEASE, ack_topic=None):
+        """
+        :param logger: Logger of the owning client
+        :param segment_size: Bytes of a segment
+        :param max_segments: Maximum number of segments
+        :param lease: Seconds a block stays readable when its consumers didn't all release it
+        :param ack_topic: Topic on which readers of other processes release blocks, given with consumers
+        """
+        self.logger = logger
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.lease = lease
+        self.ack_topic = ack_topic
+        self.id = "mqtt_%d_%08x" % (os.getpid(), getrandbits(32))
+        self.segments = []
+        self.lock = threading.Lock()
+        self.generation = 0
+
+        self.published = 0
+        self.published_bytes = 0
+        self.released = 0
+        self.expired = 0
+        self.full = 0
+
+    def write(self, data, consumers=None, lease=None):
+        """
+        Copy data into a free block
+        :param data: bytes-like object
+        :param consumers: Releases after which the block is freed before its lease expires
+        :param lease: Seconds the block stays readable, lease of the store by default
+        :return: handle of the block, None if every segment is full
+        """
+        data = memoryview(data).cast("B")
+        size = BLOCK_HEADER.size + len(data)
+        size += -size % BLOCK_ALIGN
+        now = time.time()
+        with self.lock:
+            segment, offset = self.allocate(size, now)
+            if segment is None:
+                self.full += 1
+                return None
+            self.generation += 1
+            block = SharedBlock(offset, offset + size, self.generation,
+                                now + (self.lease if lease is None else lease), consumers)
+            segment.blocks.append(block)
+            segment.head = block.end
+            BLOCK_HEADER.pack_into(segment.memory.buf, offset, block.generation)
+            segment.memory.buf[offset + BLOCK_HEADER.size:offset + BLOCK_HEADER.size + len(data)] = data
+            self.published += 1
+            self.published_bytes += len(data)
+            return {"name": segment.name, "offset": offset, "length": len(data), "generation": block.generation,
+                    "host": HOST, "ack": self.ack_topic if consumers else None}
+
+    def allocate(self, size, now):
+        for segment in self.segments:
+            self.expired += segment.reclaim(now)
+            offset = segment.allocate(size)
+            if offset is not None:
+                return segment, offset
+        # Empty segments are dropped to make room
+        for segment in list(self.segments):
+            if not segment.blocks and len(self.segments) >= self.max_segments:
+                self.segments.remove(segment)
+                local_segments.pop(segment.name, None)
+                segment.close()
+        if len(self.segments) >= self.max_segments:
+            return None, None
+        segment = SharedSegment(self, "%s_%d" % (self.id, self.generation), max(self.segment_size, size))
+        self.segments.append(segment)
+        local_segments[segment.name] = segment
+        return segment, 0
+
+    def release(self, name, offset, generation):
+        """
+        A consumer read the block
+        :return: False if the block was already freed
+        """
+        with self.lock:
+            for segment in self.segments:
+                if segment.name != name:
+                    continue
+                for block in segment.blocks:
+                    if block.offset == offset and block.generation == generation:
+                        if block.consumers:
+                            block.consumers -= 1
+                            if block.consumers == 0:
+                                self.released += 1
+                        return True
+        return False
+
+    def stats(self):
+        with self.lock:
+            return {"segments": len(self.segments), "blocks": sum(len(s.blocks) for s in self.segments),
+                    "used_bytes": sum(s.used() for s in self.segments), "published": self.published,
+                    "published_bytes": self.published_bytes, "released": self.released, "expired": self.expired,
+                    "full": self.full}
+
+    def close(self):
+        """
+        Unlink the segments. Readers still mapping them keep their data.
+        """
+        with self.lock:
+            for segment in self.segments:
+                local_segments.pop(segment.name, None)
+                segment.close()
+            self.segments = []
+
+
+class SharedPayload(object):
+    """
+    Shared payload opened by a subscriber. data is a read-only memoryview of the block : it
+    must be released (release() or with block) before the lease of the block expires.
+    """
+
+    def __init__(self, handle, meta, data, buffer, on_release):
+        self.handle = handle
+        self.meta = meta
+        self.data = data
+        self.buffer = buffer
+        self.on_release = on_release
+
+    def valid(self):
+        """
+        Returns False if the publisher reused the block since it was opened (lease expired) :
+        what was read from data may be corrupted
+        """
+        return BLOCK_HEADER.unpack_from(self.buffer, self.handle["offset"])[0] == self.handle["generation"]
+
+    def tobytes(self):
+        """
+        Returns a copy of the data, kept after release
+        """
+        return self.data.tobytes()
+
+    def release(self):
+        if self.data is not None:
+            self.data.release()
+            self.buffer.release()
+            self.data = None
+            self.buffer = None
+            self.on_release(self.handle)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class SharedPayloadReader(object):
+    """
+    Segments mapped by the subscribers of a process. Segments of the publishers of the
+    process are read directly.
+    """
+
+    def __init__(self):
+        self.segments = {}
+        self.lock = threading.Lock()
+
+    def open(self, parsed_json, on_release):
+        """
+        :param parsed_json: Message published with publish_shared
+        :param on_release: Called with the handle when the payload is released
+        :return: SharedPayload
+        :raise StalePayload: if the block was reused or the segment is gone
+        """
+        handle = parsed_json[SHARED_KEY]
+        if handle.get("host") != HOST:
+            raise StalePayload("Shared payload published on " + str(handle.get("host")))
+        segment = local_segments.get(handle["name"])
+        if segment is not None:
+            buffer = segment.memory.buf.toreadonly()
+        else:
+            buffer = memoryview(self.map(handle["name"]))
+        offset = handle["offset"]
+        if BLOCK_HEADER.unpack_from(buffer, offset)[0] != handle["generation"]:
+            raise StalePayload("Shared payload %s:%d was reused" % (handle["name"], offset))
+        start = offset + BLOCK_HEADER.size
+        return SharedPayload(handle, parsed_json.get(META_KEY), buffer[start:start + handle["length"]], buffer,
+                             on_release)
+
+    def map(self, name):
+        with self.lock:
+            segment = self.segments.get(name)
+            if segment is None:
+                try:
+                    segment = attach(name)
+                except FileNotFoundError:
+                    raise StalePayload("Shared payload segment %s is gone" % name)
+                if len(self.segments) >= SHARED_ATTACH_MAX:
+                    self.unmap_oldest()
+                self.segments[name] = segment
+            return segment
+
+    def unmap_oldest(self):
+        for name, segment in list(self.segments.items()):
+            try:
+                segment.close()
+            except BufferError:
+                # Payloads of the segment are still open
+                continue
+            del self.segments[name]
+            return
+
+
+# Segments created by the publishers of the process, by name : their readers release blocks directly
+local_segments = {}
+shared_reader = SharedPayloadReader()
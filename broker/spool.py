@@ -0,0 +1,332 @@
+from config import *
+import mmap
+import struct
+import threading
+import time
+import sys
+
+SPOOL_DROP_OLDEST = "drop_oldest"
+SPOOL_DROP_NEWEST = "drop_newest"
+SPOOL_POLICIES = [SPOOL_DROP_OLDEST, SPOOL_DROP_NEWEST]
+
+# Record : magic, payload length, topic length, qos, retain, then topic and payload.
+# Segments are zero filled : a record is complete once its magic byte is written, last.
+RECORD_MAGIC = 0xA5
+RECORD_HEADER = struct.Struct("<BIHBB")
+# Read position : segment index, offset in the segment
+CURSOR = struct.Struct("<QQ")
+CURSOR_FILE = "cursor"
+SEGMENT_SUFFIX = ".seg"
+
+
+class SpoolSegment(object):
+    """
+    Preallocated, memory-mapped file holding records one after another
+    """
+
+    def __init__(self, directory, index, size=None):
+        """
+        Open segment index of directory, creating it with size bytes if size is given
+        """
+        self.index = index
+        self.path = os.path.join(directory, "%016d%s" % (index, SEGMENT_SUFFIX))
+        if size is not None:
+            with open(self.path, "wb") as segment_file:
+                segment_file.truncate(size)
+        self.file = open(self.path, "r+b")
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+
+        # Records already written, when reopening a spool
+        self.count = 0
+        self.write_offset = 0
+        record = self.read(0)
+        while record is not None:
+            self.count += 1
+            self.write_offset = record[1]
+            record = self.read(self.write_offset)
+
+    def append(self, topic, payload, qos, retain):
+        """
+        :param topic: bytes
+        :param payload: bytes
+        :return: False if the segment is full
+        """
+        offset = self.write_offset
+        start = offset + RECORD_HEADER.size
+        end = start + len(topic) + len(payload)
+        if end > self.size:
+            return False
+        self.map[start:start + len(topic)] = topic
+        self.map[start + len(topic):end] = payload
+        RECORD_HEADER.pack_into(self.map, offset, 0, len(payload), len(topic), qos, 1 if retain else 0)
+        self.map[offset] = RECORD_MAGIC
+        self.write_offset = end
+        self.count += 1
+        return True
+
+    def read(self, offset):
+        """
+        :return: ((topic, payload, qos, retain), offset of the next record), None at the end of the records
+        """
+        if offset + RECORD_HEADER.size > self.size or self.map[offset] != RECORD_MAGIC:
+            return None
+        magic, payload_length, topic_length, qos, retain = RECORD_HEADER.unpack_from(self.map, offset)
+        start = offset + RECORD_HEADER.size
+        topic = self.map[start:start + topic_length].decode("utf-8")
+        payload = self.map[start + topic_length:start + topic_length + payload_length]
+        return (topic, payload, qos, retain == 1), start + topic_length + payload_length
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def delete(self):
+        self.close()
+        os.remove(self.path)
+
+
+class DiskSpool(object):
+    """
+    Append-only log of publishes, kept in memory-mapped segment files of a directory.
+    Records are read in order from a cursor stored next to the segments, so that what
+    wasn't published yet survives a restart. Segments are deleted once read.
+
+    The spool holds at most max_bytes of segments : when a new segment is needed, the
+    oldest segment is evicted (drop_oldest) or the new record is refused (drop_newest).
+    """
+
+    def __init__(self, directory, segment_size=1024 * 1024, max_bytes=64 * 1024 * 1024, policy=SPOOL_DROP_OLDEST):
+        """
+        :param directory: Directory of the spool, created if needed. Only one spool may use it.
+        :param segment_size: Size of segment files, in bytes
+        :param max_bytes: Maximum size of all segments, in bytes
+        :param policy: drop_oldest or drop_newest when max_bytes is reached
+        """
+        if policy not in SPOOL_POLICIES:
+            raise ValueError("Unknown spool policy : " + str(policy))
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.spooled = 0
+        self.drained = 0
+        self.dropped = 0
+
+        os.makedirs(directory, exist_ok=True)
+        cursor_path = os.path.join(directory, CURSOR_FILE)
+        if not os.path.exists(cursor_path):
+            with open(cursor_path, "wb") as cursor_file:
+                cursor_file.write(CURSOR.pack(0, 0))
+        self.cursor_file = open(cursor_path, "r+b")
+        self.cursor = mmap.mmap(self.cursor_file.fileno(), CURSOR.size)
+        read_index, self.read_offset = CURSOR.unpack_from(self.cursor)
+
+        self.segments = []
+        indexes = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory)
+                         if name.endswith(SEGMENT_SUFFIX))
+        for index in indexes:
+            segment = SpoolSegment(directory, index)
+            if index < read_index:
+                # Read before the last stop
+                segment.delete()
+            else:
+                self.segments.append(segment)
+        if self.segments and self.segments[0].index != read_index:
+            self.read_offset = 0
+        if not self.segments:
+            self.segments.append(SpoolSegment(directory, read_index, segment_size))
+        self.save_cursor()
+
+        # Records not read yet
+        self.pending = sum(segment.count for segment in self.segments[1:])
+        record = self.segments[0].read(self.read_offset)
+        while record is not None:
+            self.pending += 1
+            record = self.segments[0].read(record[1])
+        self.next_offset = None
+
+    def __len__(self):
+        return self.pending
+
+    def size(self):
+        return sum(segment.size for segment in self.segments)
+
+    def save_cursor(self):
+        CURSOR.pack_into(self.cursor, 0, self.segments[0].index, self.read_offset)
+
+    def append(self, topic, payload, qos=0, retain=False):
+        """
+        Add a publish at the end of the spool
+        :return: False if the record was dropped (drop_newest policy, spool full)
+        """
+        topic = topic.encode("utf-8")
+        with self.lock:
+            if not self.segments[-1].append(topic, payload, qos, retain):
+                size = max(self.segment_size, RECORD_HEADER.size + len(topic) + len(payload))
+                while self.size() + size > self.max_bytes and len(self.segments) > 1:
+                    if self.policy == SPOOL_DROP_NEWEST:
+                        self.dropped += 1
+                        return False
+                    self.evict_oldest()
+                if self.size() + size > self.max_bytes and self.policy == SPOOL_DROP_NEWEST and len(self):
+                    self.dropped += 1
+                    return False
+                # The previous segment is complete, write it back now
+                self.segments[-1].flush()
+                segment = SpoolSegment(self.directory, self.segments[-1].index + 1, size)
+                self.segments.append(segment)
+                segment.append(topic, payload, qos, retain)
+            self.pending += 1
+            self.spooled += 1
+        return True
+
+    def evict_oldest(self):
+        segment = self.segments.pop(0)
+        unread = segment.count
+        record = segment.read(0)
+        while record is not None and record[1] <= self.read_offset:
+            unread -= 1
+            record = segment.read(record[1])
+        self.dropped += unread
+        self.pending -= unread
+        segment.delete()
+        self.read_offset = 0
+        self.next_offset = None
+        self.save_cursor()
+
+    def peek(self):
+        """
+        :return: (topic, payload, qos, retain) of the oldest record, None if the spool is empty
+        """
+        with self.lock:
+            while True:
+                record = self.segments[0].read(self.read_offset)
+                if record is not None:
+                    self.next_offset = record[1]
+                    return record[0]
+                if len(self.segments) == 1:
+                    return None
+                # Segment entirely read
+                self.segments.pop(0).delete()
+                self.read_offset = 0
+                self.save_cursor()
+
+    def commit(self):
+        """
+        Remove the record returned by the last peek
+        """
+        with self.lock:
+            if self.next_offset is None:
+                return
+            self.read_offset = self.next_offset
+            self.next_offset = None
+            self.pending -= 1
+            self.drained += 1
+            self.save_cursor()
+
+    def flush(self):
+        """
+        Write segments and cursor back to disk
+        """
+        with self.lock:
+            for segment in self.segments:
+                segment.flush()
+            self.cursor.flush()
+
+    def stats(self):
+        return {
+            "pending": self.pending,
+            "bytes": self.size(),
+            "spooled": self.spooled,
+            "drained": self.drained,
+            "dropped": self.dropped,
+        }
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            for segment in self.segments:
+                segment.close()
+            self.cursor.close()
+            self.cursor_file.close()
+
+
+class SpoolDrainer(object):
+    """
+    Publishes the records of a spool in order while the client is connected, at most
+    rate records per second so that a long outage doesn't end in a flood.
+    """
+
+    def __init__(self, logger, spool, publish, is_connected, rate=100):
+        """
+        :param logger: Logger of the owning client
+        :param spool: DiskSpool
+        :param publish: Callable taking (topic, payload, qos, retain), returns False if it failed
+        :param is_connected: Callable returning True while the broker is connected
+        :param rate: Maximum records published per second, 0 for no limit
+        """
+        self.logger = logger
+        self.spool = spool
+        self.publish = publish
+        self.is_connected = is_connected
+        self.rate = rate
+        self.condition = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="spool_drainer", daemon=True)
+        self.thread.start()
+
+    def wake(self):
+        """
+        Called when records are appended or the client connects
+        """
+        with self.condition:
+            self.condition.notify()
+
+    def run(self):
+        next_publish = time.time()
+        while self.running:
+            with self.condition:
+                if not (len(self.spool) and self.is_connected()):
+                    # Connection changes aren't always notified, check again regularly
+                    self.condition.wait(0.5)
+                    next_publish = time.time()
+                    continue
+            try:
+                record = self.spool.peek()
+                if record is None:
+                    continue
+                if not self.publish(*record):
+                    time.sleep(0.5)
+                    continue
+                self.spool.commit()
+            except Exception as e:
+                import traceback
+                exc_type, exc_obj, exc_tb = sys.exc_info()
+                exceptionStr = (
+                        os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+                        + ", line "
+                        + str(exc_tb.tb_lineno)
+                        + " : "
+                        + str(e) +
+                        "".join(traceback.format_tb(e.__traceback__))
+                )
+                self.logger.e(exceptionStr)
+                time.sleep(0.5)
+                continue
+
+            if self.rate > 0:
+                next_publish = max(next_publish + 1.0 / self.rate, time.time() - 1.0)
+                delay = next_publish - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join(5)
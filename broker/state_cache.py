@@ -0,0 +1,342 @@
+from config import *
+from random import getrandbits
+import threading
+import time
+import sys
+
+# Envelope of a full state (retained) : {"state": ..., "seq": n, "epoch": id}
+# Envelope of a delta : {"patch": [JSON Patch operations], "seq": n, "epoch": id}
+STATE_KEY = "state"
+PATCH_KEY = "patch"
+SEQ_KEY = "seq"
+# Changes when the publisher restarts, so that receivers don't apply deltas to an older sequence
+EPOCH_KEY = "epoch"
+
+
+def clone(value):
+    """
+    Deep copy of a JSON value
+    """
+    if type(value) is dict:
+        return {key: clone(item) for key, item in value.items()}
+    if type(value) is list:
+        return [clone(item) for item in value]
+    return value
+
+
+def equal(a, b):
+    """
+    JSON equality : unlike ==, 1, 1.0 and true are different values
+    """
+    if type(a) is not type(b):
+        return False
+    if type(a) is dict:
+        if len(a) != len(b):
+            return False
+        for key, value in a.items():
+            if key not in b or not equal(value, b[key]):
+                return False
+        return True
+    if type(a) is list:
+        return len(a) == len(b) and all(equal(x, y) for x, y in zip(a, b))
+    return a == b
+
+
+def escape(key):
+    return key.replace("~", "~0").replace("/", "~1")
+
+
+def unescape(token):
+    return token.replace("~1", "/").replace("~0", "~")
+
+
+def diff(old, new, path=""):
+    """
+    Returns the JSON Patch operations (RFC 6902 add, remove and replace) turning old into new.
+    Objects are compared key by key, other values (lists included) are replaced as a whole.
+    """
+    if type(old) is not dict or type(new) is not dict:
+        return [] if equal(old, new) else [{"op": "replace", "path": path, "value": new}]
+    ops = []
+    for key in old:
+        if key not in new:
+            ops.append({"op": "remove", "path": path + "/" + escape(key)})
+    for key, value in new.items():
+        if key not in old:
+            ops.append({"op": "add", "path": path + "/" + escape(key), "value": value})
+        else:
+            ops.extend(diff(old[key], value, path + "/" + escape(key)))
+    return ops
+
+
+def apply_patch(document, ops):
+    """
+    Apply JSON Patch add, remove and replace operations to document, in place
+    :return: Patched document, a new object if the root was replaced
+    """
+    for op in ops:
+        path = op["path"]
+        if path == "":
+            if op["op"] == "remove":
+                raise ValueError("Can't remove the document root")
+            document = clone(op["value"])
+            continue
+        tokens = [unescape(token) for token in path.split("/")[1:]]
+        parent = document
+        for token in tokens[:-1]:
+            parent = parent[int(token)] if type(parent) is list else parent[token]
+        key = tokens[-1]
+        if type(parent) is list:
+            if op["op"] == "add":
+                parent.insert(len(parent) if key == "-" else int(key), clone(op["value"]))
+            elif op["op"] == "remove":
+                del parent[int(key)]
+            else:
+                parent[int(key)] = clone(op["value"])
+        elif op["op"] == "remove":
+            del parent[key]
+        elif op["op"] in ("add", "replace"):
+            parent[key] = clone(op["value"])
+        else:
+            raise ValueError("Unsupported patch operation : " + str(op["op"]))
+    return document
+
+
+class StateCache(object):
+    """
+    Last state published on each topic by a client. publish_state() sends nothing when the
+    state didn't change. With deltas, a change is sent as the JSON Patch from the previous
+    state (not retained), and the full state is sent (retained) when the patch isn't smaller,
+    and snapshot_period seconds after the first delta following a full state, so that new
+    subscribers and receivers which missed a delta catch up.
+    """
+
+    def __init__(self, logger, encode, publish, deltas=False, snapshot_period=STATE_SNAPSHOT_PERIOD):
+        """
+        :param logger: Logger of the owning client
+        :param encode: Callable taking (topic, obj), returning (obj, encoded payload)
+        :param publish: Callable taking (topic, obj, payload, qos, retain)
+        :param deltas: Send changes as patches
+        :param snapshot_period: Maximum seconds between a delta and the next full state
+        """
+        self.logger = logger
+        self.encode = encode
+        self.publish = publish
+        self.deltas = deltas
+        self.snapshot_period = snapshot_period
+        self.epoch = "%08x" % getrandbits(32)
+        # topic => [state, seq, encoded size of the full state, qos, retain]
+        self.states = {}
+        # topic => time the full state must be sent at
+        self.snapshots_due = {}
+        # topic => lock held while a state of the topic is built and published, so that its
+        # messages are sent in order without blocking the other topics
+        self.topic_locks = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.thread = None
+        self.running = True
+
+        self.snapshots = 0
+        self.patches = 0
+        self.suppressed = 0
+
+    def update(self, topic, state, qos=0, retain=True):
+        """
+        Publish state on topic if it changed
+        :param retain: Retain full states
+        :return: False if nothing was sent
+        """
+        with self.topic_lock(topic):
+            with self.lock:
+                entry = self.states.get(topic)
+                if entry is not None and equal(entry[0], state):
+                    self.suppressed += 1
+                    return False
+
+                if entry is None or not self.deltas:
+                    seq = entry[1] + 1 if entry is not None else 1
+                    message = self.snapshot(topic, clone(state), seq, qos, retain)
+                else:
+                    seq = entry[1] + 1
+                    envelope, payload = self.encode(topic, {PATCH_KEY: diff(entry[0], state), SEQ_KEY: seq,
+                                                            EPOCH_KEY: self.epoch})
+                    if len(payload) >= entry[2]:
+                        message = self.snapshot(topic, clone(state), seq, qos, retain)
+                    else:
+                        entry[0] = clone(state)
+                        entry[1] = seq
+                        self.patches += 1
+                        message = (envelope, payload, qos, False)
+                        if topic not in self.snapshots_due:
+                            self.snapshots_due[topic] = time.time() + self.snapshot_period
+                            self.start()
+            # Published without self.lock : a publish blocked by a rate limit doesn't stop the other topics
+            self.publish(topic, *message)
+            return True
+
+    def topic_lock(self, topic):
+        with self.lock:
+            lock = self.topic_locks.get(topic)
+            if lock is None:
+                lock = threading.Lock()
+                self.topic_locks[topic] = lock
+            return lock
+
+    def snapshot(self, topic, state, seq, qos, retain):
+        """
+        Record state as the full state of topic, self.lock held
+        :return: (envelope, payload, qos, retain) to publish
+        """
+        envelope, payload = self.encode(topic, {STATE_KEY: state, SEQ_KEY: seq, EPOCH_KEY: self.epoch})
+        self.states[topic] = [state, seq, len(payload), qos, retain]
+        self.snapshots_due.pop(topic, None)
+        self.snapshots += 1
+        return envelope, payload, qos, retain
+
+    def send_due_snapshot(self, topic):
+        with self.topic_lock(topic):
+            with self.lock:
+                due = self.snapshots_due.get(topic)
+                if due is None or due > time.time():
+                    # Sent by update, or forgotten, meanwhile
+                    return
+                state, seq, size, qos, retain = self.states[topic]
+                message = self.snapshot(topic, state, seq, qos, retain)
+            self.publish(topic, *message)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="state_snapshots", daemon=True)
+            self.thread.start()
+        else:
+            self.wakeup.notify()
+
+    def run(self):
+        while True:
+            with self.lock:
+                if not self.running:
+                    return
+                now = time.time()
+                due = [topic for topic, deadline in self.snapshots_due.items() if deadline <= now]
+                if not due:
+                    self.wakeup.wait(min(self.snapshots_due.values()) - now if self.snapshots_due else None)
+                    continue
+            for topic in due:
+                try:
+                    self.send_due_snapshot(topic)
+                except Exception as e:
+                    import traceback
+                    exc_type, exc_obj, exc_tb = sys.exc_info()
+                    exceptionStr = (
+                            os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+                            + ", line "
+                            + str(exc_tb.tb_lineno)
+                            + " : "
+                            + str(e) +
+                            "".join(traceback.format_tb(e.__traceback__))
+                    )
+                    self.logger.e(exceptionStr)
+                    with self.lock:
+                        self.snapshots_due.pop(topic, None)
+
+    def get(self, topic):
+        """
+        Returns the last state published on topic, None if there is none
+        """
+        with self.lock:
+            entry = self.states.get(topic)
+            return entry[0] if entry is not None else None
+
+    def forget(self, topic):
+        """
+        Drop the state of topic : the next publish_state sends it in full
+        """
+        with self.lock:
+            self.states.pop(topic, None)
+            self.snapshots_due.pop(topic, None)
+
+    def stats(self):
+        with self.lock:
+            return {"topics": len(self.states), "snapshots": self.snapshots, "patches": self.patches,
+                    "suppressed": self.suppressed}
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.wakeup.notify()
+
+
+class StateView(object):
+    """
+    Last state received on each topic, kept up to date from the full states and deltas
+    published with publish_state
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        # topic => [state, seq, epoch]
+        self.states = {}
+        self.lock = threading.Lock()
+        self.snapshots = 0
+        self.patches = 0
+        self.gaps = 0
+
+    def apply(self, topic, envelope):
+        """
+        Update the state of topic from a received envelope
+        :return: New state, None if the envelope isn't a state or can't be applied (missed delta,
+                 the state is updated again by the next full state)
+        """
+        if type(envelope) is not dict:
+            return None
+        seq = envelope.get(SEQ_KEY)
+        epoch = envelope.get(EPOCH_KEY)
+        with self.lock:
+            entry = self.states.get(topic)
+            if STATE_KEY in envelope:
+                if (entry is not None and entry[2] == epoch and entry[1] is not None and type(seq) is int
+                        and seq <= entry[1]):
+                    # Retained state sent again on subscription or reconnection, older than the view
+                    return None
+                # Shared with the publisher by the loopback bus, patches must not modify it
+                state = clone(envelope[STATE_KEY])
+                self.states[topic] = [state, seq, epoch]
+                self.snapshots += 1
+                return state
+            if PATCH_KEY not in envelope:
+                return None
+            if entry is None or entry[2] != epoch or entry[1] is None or type(seq) is not int or seq > entry[1] + 1:
+                self.gaps += 1
+                self.logger.d("Missed state change on %s, waiting for the next full state", topic)
+                return None
+            if seq <= entry[1]:
+                # Already applied
+                return None
+            try:
+                entry[0] = apply_patch(entry[0], envelope[PATCH_KEY])
+            except (KeyError, IndexError, ValueError, TypeError) as e:
+                self.gaps += 1
+                self.logger.w("Invalid state patch on %s : %s", topic, e)
+                entry[1] = None
+                return None
+            entry[1] = seq
+            self.patches += 1
+            return entry[0]
+
+    def get(self, topic):
+        """
+        Returns the state received on topic, None if there is none. Must not be modified.
+        """
+        with self.lock:
+            entry = self.states.get(topic)
+            return entry[0] if entry is not None else None
+
+    def topics(self):
+        with self.lock:
+            return list(self.states)
+
+    def stats(self):
+        with self.lock:
+            return {"topics": len(self.states), "snapshots": self.snapshots, "patches": self.patches,
+                    "gaps": self.gaps}
@@ -0,0 +1,148 @@
+import threading
+
+# Topics per SUBSCRIBE packet, so that a packet stays small for constrained brokers
+SUBSCRIBE_BATCH = 100
+# Granted QoS of a refused topic in a SUBACK
+SUBACK_FAILURE = 0x80
+# SUBACKs kept when nobody waits for them (subscriptions sent on connection)
+UNCLAIMED_SUBACKS = 256
+
+
+class SubscriptionSet(object):
+    """
+    Topic filters of a client with their QoS, in subscription order.
+    diff() gives the SUBSCRIBE / UNSUBSCRIBE needed to go from one set to another.
+    """
+
+    def __init__(self, subscriptions=()):
+        """
+        :param subscriptions: Topic filters (QoS 0), (topic, qos) pairs, a dict topic => qos or a SubscriptionSet
+        """
+        self.topics = {}
+        self.update(subscriptions)
+
+    @staticmethod
+    def pairs(subscriptions):
+        if isinstance(subscriptions, (dict, SubscriptionSet)):
+            return list(subscriptions.items())
+        return [(topic, 0) if isinstance(topic, str) else (topic[0], topic[1]) for topic in subscriptions]
+
+    def add(self, topic, qos=0):
+        """
+        :return: True if topic is new or its QoS changed
+        """
+        if self.topics.get(topic) == qos:
+            return False
+        self.topics[topic] = qos
+        return True
+
+    def update(self, subscriptions):
+        """
+        Add several subscriptions
+        :return: (topic, qos) pairs which were new or changed
+        """
+        return [(topic, qos) for topic, qos in self.pairs(subscriptions) if self.add(topic, qos)]
+
+    def remove(self, topic):
+        """
+        :return: True if topic was part of the set
+        """
+        return self.topics.pop(topic, None) is not None
+
+    def replace(self, subscriptions):
+        """
+        Replace the whole set
+        :return: (to_subscribe, to_unsubscribe), see diff
+        """
+        other = SubscriptionSet(subscriptions)
+        changes = self.diff(other)
+        self.topics = other.topics
+        return changes
+
+    def diff(self, other):
+        """
+        Returns what must be sent to go from this set to other :
+        ([(topic, qos)] to subscribe, [topic] to unsubscribe)
+        """
+        to_subscribe = [(topic, qos) for topic, qos in other.items() if self.topics.get(topic) != qos]
+        to_unsubscribe = [topic for topic in self.topics if topic not in other]
+        return to_subscribe, to_unsubscribe
+
+    def items(self):
+        return list(self.topics.items())
+
+    def copy(self):
+        return SubscriptionSet(self)
+
+    def clear(self):
+        self.topics.clear()
+
+    def __contains__(self, topic):
+        return topic in self.topics
+
+    def __iter__(self):
+        return iter(list(self.topics))
+
+    def __len__(self):
+        return len(self.topics)
+
+    def __repr__(self):
+        return "SubscriptionSet(%r)" % self.topics
+
+
+def batches(items, size=SUBSCRIBE_BATCH):
+    """
+    Split items in lists of at most size items, one per packet
+    """
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+class SubackWaiter(object):
+    """
+    Lets callers wait for the SUBACK of a SUBSCRIBE, by message id. SUBACKs may be received
+    before the caller registers its message id.
+    """
+
+    def __init__(self):
+        self.events = {}
+        self.granted = {}
+        self.lock = threading.Lock()
+
+    def expect(self, mid):
+        """
+        :return: Event set when the SUBACK of mid is received
+        """
+        with self.lock:
+            event = threading.Event()
+            if mid in self.granted:
+                event.set()
+            else:
+                self.events[mid] = event
+            return event
+
+    def acknowledge(self, mid, granted_qos):
+        """
+        Called from on_subscribe
+        """
+        with self.lock:
+            self.granted[mid] = granted_qos
+            event = self.events.pop(mid, None)
+            if event is None and len(self.granted) > UNCLAIMED_SUBACKS:
+                del self.granted[next(iter(self.granted))]
+        if event is not None:
+            event.set()
+
+    def result(self, mid):
+        """
+        :return: granted QoS list of mid (0x80 for a refused topic), forgotten once read
+        """
+        with self.lock:
+            return self.granted.pop(mid, None)
+
+    def forget(self, mid):
+        """
+        Stop waiting for mid
+        """
+        with self.lock:
+            self.events.pop(mid, None)
+            self.granted.pop(mid, None)
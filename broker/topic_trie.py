@@ -0,0 +1,145 @@
+"""
+    Topic filters compiled into a trie, one node per topic level.
+    Matching a topic walks at most one path per wildcard branch, so its cost depends
+    on the depth of the topic and not on the number of registered filters.
+"""
+
+
+def topic_matches(topic_filter, topic):
+    """
+    Linear MQTT matching of a single filter against a topic ('+' and '#' supported)
+    :param topic_filter: Subscription filter
+    :param topic: Topic of a message
+    :return: True if topic matches topic_filter
+    """
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    if topic.startswith("$") and filter_levels[0] in ("+", "#"):
+        return False
+    for index, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if index >= len(topic_levels):
+            return False
+        if level != "+" and level != topic_levels[index]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+class TopicNode(object):
+    __slots__ = ("children", "values")
+
+    def __init__(self):
+        self.children = {}
+        self.values = []
+
+
+class TopicTrie(object):
+    """
+    Map of MQTT topic filters to values.
+    Several values can be registered on the same filter.
+    """
+
+    def __init__(self):
+        self.root = TopicNode()
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, topic_filter, value):
+        """
+        Register value on topic_filter
+        :param topic_filter: Subscription filter, may contain '+' and '#'
+        :param value: Any object returned by match()
+        :return:
+        """
+        node = self.root
+        for level in topic_filter.split("/"):
+            child = node.children.get(level)
+            if child is None:
+                child = TopicNode()
+                node.children[level] = child
+            node = child
+        node.values.append(value)
+        self.count += 1
+
+    def remove(self, topic_filter, value):
+        """
+        Unregister value from topic_filter, pruning empty branches
+        :param topic_filter: Subscription filter
+        :param value: Value previously given to add()
+        :return: True if value was registered
+        """
+        path = []
+        node = self.root
+        for level in topic_filter.split("/"):
+            child = node.children.get(level)
+            if child is None:
+                return False
+            path.append((node, level))
+            node = child
+        if value not in node.values:
+            return False
+        node.values.remove(value)
+        self.count -= 1
+        while path and not node.values and not node.children:
+            parent, level = path.pop()
+            del parent.children[level]
+            node = parent
+        return True
+
+    def get(self, topic_filter):
+        """
+        Returns the values registered on exactly topic_filter (no wildcard matching)
+        """
+        node = self.root
+        for level in topic_filter.split("/"):
+            node = node.children.get(level)
+            if node is None:
+                return []
+        return list(node.values)
+
+    def match(self, topic):
+        """
+        Returns the values of every filter matching topic
+        :param topic: Topic of a message (no wildcard)
+        :return: list of values
+        """
+        levels = topic.split("/")
+        result = []
+        # Wildcards at first level don't match topics beginning with '$'
+        self._match(self.root, levels, 0, result, topic.startswith("$"))
+        return result
+
+    def _match(self, node, levels, index, result, system_topic):
+        children = node.children
+        if not children:
+            return
+        wildcards = not (system_topic and index == 0)
+        if wildcards:
+            multi = children.get("#")
+            if multi is not None:
+                result.extend(multi.values)
+        if index == len(levels):
+            return
+        child = children.get(levels[index])
+        if child is not None:
+            if index + 1 == len(levels):
+                result.extend(child.values)
+                # 'a/#' also matches 'a'
+                multi = child.children.get("#")
+                if multi is not None:
+                    result.extend(multi.values)
+            else:
+                self._match(child, levels, index + 1, result, system_topic)
+        if wildcards:
+            single = children.get("+")
+            if single is not None:
+                if index + 1 == len(levels):
+                    result.extend(single.values)
+                    multi = single.children.get("#")
+                    if multi is not None:
+                        result.extend(multi.values)
+                else:
+                    self._match(single, levels, index + 1, result, system_topic)
@@ -16,6 +16,62 @@ SERVICE_NAME = "system"
 MQTT_HOST = os.getenv('MQTT_HOST', "127.0.0.1")
 MQTT_PORT = int(os.getenv('MQTT_PORT', "1883"))
 FILE_LOG = os.getenv("FILE_LOG", LOGFILE)
+# Number of broker connections shared by all MqttClient of the process.
+# 0 disables pooling : each MqttClient opens its own connection.
+MQTT_POOL_SIZE = int(os.getenv('MQTT_POOL_SIZE', "0"))
+# Brokers to fail over between, by order of preference : "host:port,host:port".
+# If set, clients not using the pool connect to these brokers instead of MQTT_HOST/MQTT_PORT.
+MQTT_BROKERS = os.getenv('MQTT_BROKERS', "")
+# Messages between clients of the same process are delivered without the broker : "decode" (each
+# subscriber decodes its own copy) or "share" (subscribers get the published object). Empty disables.
+MQTT_LOOPBACK = os.getenv('MQTT_LOOPBACK', "")
+
+# Recent warnings and errors are served by the Core on request
+LOG_REQUEST_TOPIC = "system/log/request"
+LOG_RESPONSE_TOPIC = "system/log/response"
+
+# Metrics of the Core process are published on METRICS_TOPIC every METRICS_PERIOD seconds (0, the default, disables),
+# and served in the Prometheus text format on http://METRICS_HTTP_HOST:METRICS_HTTP_PORT/metrics (port 0 disables).
+# Metrics of the services run in process mode stay in their process and aren't exposed.
+METRICS_TOPIC = "system/metrics"
+METRICS_PERIOD = int(os.getenv('METRICS_PERIOD', "0"))
+METRICS_HTTP_HOST = os.getenv('METRICS_HTTP_HOST', "127.0.0.1")
+METRICS_HTTP_PORT = int(os.getenv('METRICS_HTTP_PORT', "0"))
+
+# Publishes made while the broker is unreachable are kept in MQTT_SPOOL_DIR/<service> (empty disables),
+# up to MQTT_SPOOL_MAX_BYTES, and published again after reconnection at MQTT_SPOOL_RATE messages/s (0 : no limit)
+MQTT_SPOOL_DIR = os.getenv('MQTT_SPOOL_DIR', "")
+MQTT_SPOOL_MAX_BYTES = int(os.getenv('MQTT_SPOOL_MAX_BYTES', str(64 * 1024 * 1024)))
+MQTT_SPOOL_RATE = float(os.getenv('MQTT_SPOOL_RATE', "100"))
+
+# Replies to call() are received on RPC_REPLY_TOPIC/<service>/<client id>, calls fail after RPC_TIMEOUT seconds
+RPC_REPLY_TOPIC = "rpc/reply"
+RPC_TIMEOUT = float(os.getenv('RPC_TIMEOUT', "5"))
+
+# Publishes per second of every service of the node (worker processes included), 0 for no limit. Publishes of the
+# Core itself aren't counted. Over the budget, each service applies its rate policy (see the options of services.conf)
+MQTT_RATE_GLOBAL = float(os.getenv('MQTT_RATE_GLOBAL', "0"))
+MQTT_RATE_GLOBAL_BURST = float(os.getenv('MQTT_RATE_GLOBAL_BURST', "0"))
+
+# States published with publish_state and sent as deltas are sent in full at most STATE_SNAPSHOT_PERIOD seconds
+# after a delta, for subscribers which missed it
+STATE_SNAPSHOT_PERIOD = float(os.getenv('STATE_SNAPSHOT_PERIOD', "30"))
+
+# Payloads published with publish_shared are written in shared memory segments of MQTT_SHARED_SEGMENT_SIZE bytes
+# (at most MQTT_SHARED_MAX_SEGMENTS per client), readable MQTT_SHARED_LEASE seconds unless every consumer released them.
+# Consumers of other processes release them on SHARED_ACK_TOPIC/<service>/<client id>, subscribed by the first
+# publish_shared with consumers, which waits up to MQTT_SHARED_ACK_TIMEOUT seconds for its SUBACK
+MQTT_SHARED_SEGMENT_SIZE = int(os.getenv('MQTT_SHARED_SEGMENT_SIZE', str(16 * 1024 * 1024)))
+MQTT_SHARED_MAX_SEGMENTS = int(os.getenv('MQTT_SHARED_MAX_SEGMENTS', "4"))
+MQTT_SHARED_LEASE = float(os.getenv('MQTT_SHARED_LEASE', "10"))
+MQTT_SHARED_ACK_TIMEOUT = float(os.getenv('MQTT_SHARED_ACK_TIMEOUT', "5"))
+SHARED_ACK_TOPIC = "shm/ack"
+
+# Fraction of received messages (and of publishes outside of a trace) traced, 0 disables tracing.
+# Spans are exported to TRACE_FILE (json lines), or to an OTLP/HTTP collector if TRACE_OTLP_ENDPOINT is set
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', "0"))
+TRACE_FILE = os.getenv('TRACE_FILE', "traces.jsonl")
+TRACE_OTLP_ENDPOINT = os.getenv('TRACE_OTLP_ENDPOINT', "")
 
 
 class SignalShutDown(Exception):
@@ -26,5 +82,10 @@ def handler_stop_signals(signum, frame):
     raise SignalShutDown("received shutdown signal")
 
 
-signal.signal(signal.SIGINT, handler_stop_signals)
-signal.signal(signal.SIGTERM, handler_stop_signals)
+def install_signal_handlers():
+    """
+    SIGINT and SIGTERM raise SignalShutDown. Called by the entry points (main, service
+    worker processes), importing config has no side effect.
+    """
+    signal.signal(signal.SIGINT, handler_stop_signals)
+    signal.signal(signal.SIGTERM, handler_stop_signals)
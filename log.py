@@ -1,8 +1,15 @@
 #!/usr/bin/env python
 
 from time import time
-from logging import handlers, addLevelName, Formatter, getLoggerClass, setLoggerClass, NOTSET, DEBUG
+from array import array
+from collections import deque
+from logging import addLevelName, Formatter, getLoggerClass, setLoggerClass, NOTSET, DEBUG, INFO, WARNING, \
+    ERROR
 from config import FILE_LOG
+import atexit
+import sys
+import threading
+import weakref
 
 """
     Logging module, which provides logging interface. This way
@@ -40,16 +47,36 @@ logger = Logging("Microservices", Logging.VERBOSE)
 
 # FILE HANDLER
 formatter = Formatter("%(asctime)s : %(name)s-%(serviceName)s: %(level)s : %(message)s")
-file_handler = handlers.RotatingFileHandler(FILE_LOG, "a", maxBytes=10 * 1024 * 1024, backupCount=10)
-file_handler.setLevel(Logging.VERBOSE)
-file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
+# Opened by the first record written to file, not at import
+file_handler = None
+file_handler_lock = threading.Lock()
+
+
+def get_file_handler():
+    """
+        Returns the rotating file handler of logger, opening the log file on first call
+    """
+    global file_handler
+    if file_handler is None:
+        with file_handler_lock:
+            if file_handler is None:
+                from logging import handlers
+                handler = handlers.RotatingFileHandler(FILE_LOG, "a", maxBytes=10 * 1024 * 1024, backupCount=10)
+                handler.setLevel(Logging.VERBOSE)
+                handler.setFormatter(formatter)
+                logger.addHandler(handler)
+                file_handler = handler
+    return file_handler
 
 SELECTIVE_LOGGING = False
 LOGGING_MODULES = []
 CURRENT_LEVEL = LEVEL_VERBOSE
 
 
+# Level name => level of the python logging module
+LOGGING_LEVELS = {"VERBOSE": 4, "DEBUG": DEBUG, "INFO": INFO, "WARNING": WARNING, "ERROR": ERROR}
+
+
 class Bcolors:
     HEADER = '\033[95m'
     OKBLUE = '\033[94m'
@@ -62,15 +89,15 @@ class Bcolors:
     UNDERLINE = '\033[4m'
 
 
-log_messages = []
+# Number of warnings and errors kept in memory by log_messages
+LOG_MESSAGES_CAPACITY = 1000
 
-
-def add_log_message(level, tag, msg):
-    global log_messages
-    log_messages.append(LogMessage(level, tag, msg))
+LEVEL_NAMES = {LEVEL_VERBOSE: "VERBOSE", LEVEL_DEBUG: "DEBUG", LEVEL_INFO: "INFO", LEVEL_WARNING: "WARNING",
+               LEVEL_ERROR: "ERROR"}
 
 
 class LogMessage(object):
+    __slots__ = ("level", "tag", "msg", "timestamp")
 
     def __init__(self, level, tag, msg, timestamp=None):
         self.level = level
@@ -86,8 +113,376 @@ class LogMessage(object):
     def is_warning(self):
         return self.level == LEVEL_WARNING
 
+    def as_dict(self):
+        return {"level": LEVEL_NAMES.get(self.level, self.level), "tag": self.tag, "msg": self.msg,
+                "timestamp": self.timestamp}
+
+
+class LogRingBuffer(object):
+    """
+        Fixed-capacity store of log records : once full, each new record replaces the oldest one.
+        Levels and timestamps are kept in typed arrays, tags and messages in preallocated lists,
+        and each record is identified by an increasing sequence number (slot = seq % capacity).
+        Per-level and per-tag indexes make filtered queries proportional to the matching records.
+    """
+    __slots__ = ("capacity", "levels", "timestamps", "tags", "msgs", "next_seq", "level_index", "tag_index",
+                 "lock")
+
+    def __init__(self, capacity=LOG_MESSAGES_CAPACITY):
+        self.capacity = max(1, capacity)
+        self.levels = array('b', [0]) * self.capacity
+        self.timestamps = array('d', [0.0]) * self.capacity
+        self.tags = [None] * self.capacity
+        self.msgs = [None] * self.capacity
+        self.next_seq = 0
+        self.level_index = {}
+        self.tag_index = {}
+        self.lock = threading.Lock()
+
+    def oldest_seq(self):
+        return max(0, self.next_seq - self.capacity)
+
+    def __len__(self):
+        return min(self.next_seq, self.capacity)
+
+    def append(self, level, tag, msg, timestamp=None):
+        if not timestamp:
+            timestamp = time()
+        with self.lock:
+            seq = self.next_seq
+            slot = seq % self.capacity
+            self.levels[slot] = level
+            self.timestamps[slot] = timestamp
+            self.tags[slot] = tag
+            self.msgs[slot] = msg
+            self.next_seq = seq + 1
+            self.add_to_index(self.level_index, level, seq)
+            self.add_to_index(self.tag_index, tag, seq)
+
+    def add_to_index(self, index, key, seq):
+        entries = index.get(key)
+        if entries is None:
+            entries = deque()
+            index[key] = entries
+        entries.append(seq)
+        # Forget evicted records
+        oldest = self.oldest_seq()
+        while entries[0] < oldest:
+            entries.popleft()
+
+    def record(self, seq):
+        slot = seq % self.capacity
+        return LogMessage(self.levels[slot], self.tags[slot], self.msgs[slot], self.timestamps[slot])
+
+    def __getitem__(self, index):
+        with self.lock:
+            length = len(self)
+            if index < 0:
+                index += length
+            if index < 0 or index >= length:
+                raise IndexError("log message index out of range")
+            return self.record(self.oldest_seq() + index)
+
+    def __iter__(self):
+        return iter(self.query())
+
+    def first_seq_after(self, since):
+        """
+            Binary search of the first record not older than since (records are stored in time order)
+        """
+        low, high = self.oldest_seq(), self.next_seq
+        while low < high:
+            middle = (low + high) // 2
+            if self.timestamps[middle % self.capacity] < since:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def query(self, level=None, tag=None, since=None, until=None, limit=None):
+        """
+            Returns the stored records matching every given filter, oldest first
+            :param level: LEVEL_* value
+            :param tag: Ident of the logger (service name), or "TRACEBACK"
+            :param since: Minimum timestamp
+            :param until: Maximum timestamp
+            :param limit: Only return the most recent limit records
+            :return: list of LogMessage
+        """
+        with self.lock:
+            oldest = self.oldest_seq()
+            if since is not None:
+                oldest = max(oldest, self.first_seq_after(since))
+
+            candidates = None
+            for index, key in ((self.level_index, level), (self.tag_index, tag)):
+                if key is not None:
+                    entries = index.get(key, ())
+                    if candidates is None or len(entries) < len(candidates):
+                        candidates = entries
+            if candidates is None:
+                candidates = range(oldest, self.next_seq)
+
+            result = []
+            for seq in reversed(candidates):
+                if seq < oldest:
+                    break
+                slot = seq % self.capacity
+                if level is not None and self.levels[slot] != level:
+                    continue
+                if tag is not None and self.tags[slot] != tag:
+                    continue
+                if until is not None and self.timestamps[slot] > until:
+                    continue
+                result.append(self.record(seq))
+                if limit is not None and len(result) >= limit:
+                    break
+            result.reverse()
+            return result
+
+    def clear(self):
+        with self.lock:
+            self.next_seq = 0
+            self.level_index = {}
+            self.tag_index = {}
+            self.tags = [None] * self.capacity
+            self.msgs = [None] * self.capacity
+
+
+log_messages = LogRingBuffer(LOG_MESSAGES_CAPACITY)
+
+
+def add_log_message(level, tag, msg):
+    log_messages.append(level, tag, str(msg))
+
+
+def get_log_messages(level=None, tag=None, since=None, until=None, limit=None):
+    """
+        Returns the recent warnings and errors matching the filters, see LogRingBuffer.query
+    """
+    return log_messages.query(level, tag, since, until, limit)
+
+
+def console_line(ident, level, msg):
+    """
+        Returns the line printed on the console for a message, using nice formatting.
+    """
+    header = Bcolors.NORMAL
+    failcolor = Bcolors.NORMAL
+    if level == "INFO":
+        header = Bcolors.OKGREEN
+    elif level == "WARNING":
+        header = Bcolors.WARNING
+        failcolor = Bcolors.WARNING
+    elif level == "ERROR":
+        header = Bcolors.FAIL
+        failcolor = Bcolors.FAIL
+
+    return ((Bcolors.HEADER + "%s " + Bcolors.ENDC +
+             ":" + header + " %s " + Bcolors.ENDC +
+             failcolor + "- %s" + Bcolors.ENDC) % (ident.ljust(20), level.ljust(8), msg))
+
+
+class LogWriter(object):
+    """
+        Background writer of the asynchronous logging mode.
+        Loggers only append a record to a bounded buffer, the writer thread formats
+        records and writes them to the console and to the log file in batches.
+        When the buffer is full, new records are dropped and counted.
+    """
+
+    def __init__(self, maxsize=10000, batch_size=256):
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.records = deque()
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.idle = threading.Condition(self.lock)
+        self.writing = False
+        self.running = True
+        self.dropped = 0
+        self.dropped_reported = 0
+        self.written = 0
+
+        self.thread = threading.Thread(target=self.run, name="log_writer", daemon=True)
+        self.thread.start()
+
+    def put(self, record):
+        """
+            Queue a record : (timestamp, ident, level, msg, to_console, to_file)
+            :return: False if the buffer is full and the record was dropped
+        """
+        with self.lock:
+            if len(self.records) >= self.maxsize:
+                self.dropped += 1
+                return False
+            self.records.append(record)
+            self.not_empty.notify()
+        return True
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.records and self.running:
+                    self.idle.notify_all()
+                    self.not_empty.wait()
+                if not self.records and not self.running:
+                    self.idle.notify_all()
+                    return
+                batch = [self.records.popleft() for _ in range(min(self.batch_size, len(self.records)))]
+                dropped = self.dropped - self.dropped_reported
+                self.dropped_reported = self.dropped
+                self.writing = True
+
+            if dropped:
+                batch.append((time(), "Logger", "WARNING", "%d log records dropped, buffer is full" % dropped,
+                              True, CURRENT_LEVEL > 0))
+            try:
+                self.write_batch(batch)
+            except Exception as e:
+                sys.stderr.write("Log writer error : " + str(e) + "\n")
+
+            with self.lock:
+                self.written += len(batch)
+                self.writing = False
+
+    def write_batch(self, batch):
+        lines = [console_line(ident, level, msg) for timestamp, ident, level, msg, to_console, to_file in batch
+                 if to_console]
+        if lines:
+            sys.stdout.write("\n".join(lines) + "\n")
+            sys.stdout.flush()
+
+        file_records = []
+        for timestamp, ident, level, msg, to_console, to_file in batch:
+            if to_file:
+                record = logger.makeRecord(logger.name, LOGGING_LEVELS[level], "", 0, msg, None, None,
+                                           extra={"serviceName": ident, "level": level})
+                record.created = timestamp
+                record.msecs = (timestamp - int(timestamp)) * 1000
+                file_records.append(record)
+        if file_records:
+            # One flush per batch instead of one per record
+            file_handler = get_file_handler()
+            file_handler.acquire()
+            try:
+                for record in file_records:
+                    if file_handler.shouldRollover(record):
+                        file_handler.doRollover()
+                    file_handler.stream.write(file_handler.format(record) + file_handler.terminator)
+                file_handler.stream.flush()
+            finally:
+                file_handler.release()
+
+    def flush(self, timeout=None):
+        """
+            Wait until every queued record is written
+            :return: True if the buffer was emptied before timeout
+        """
+        with self.lock:
+            return self.idle.wait_for(lambda: not self.records and not self.writing, timeout)
+
+    def stop(self, timeout=5):
+        """
+            Write the remaining records and stop the writer thread
+        """
+        with self.lock:
+            self.running = False
+            self.not_empty.notify()
+        self.thread.join(timeout)
+
+    def stats(self):
+        with self.lock:
+            return {"queued": len(self.records), "written": self.written, "dropped": self.dropped}
+
+
+log_writer = None
+
+
+def enable_async_logging(maxsize=10000, batch_size=256):
+    """
+        Switch every Logger to the asynchronous mode : v/d/i/w/e only queue the record
+        and a background thread writes them. Remaining records are written at exit.
+    """
+    global log_writer
+    if log_writer is None:
+        log_writer = LogWriter(maxsize, batch_size)
+        atexit.register(shutdown_logging)
+    return log_writer
+
+
+def flush_logging(timeout=None):
+    """
+        Wait until every queued record is written (asynchronous mode only)
+    """
+    if log_writer is not None:
+        return log_writer.flush(timeout)
+    return True
+
+
+def shutdown_logging():
+    """
+        Write the remaining records and go back to synchronous logging
+    """
+    global log_writer
+    if log_writer is not None:
+        writer = log_writer
+        log_writer = None
+        writer.stop()
+
+
+def logging_stats():
+    """
+        Returns queued/written/dropped counters of the asynchronous mode, None in synchronous mode
+    """
+    if log_writer is not None:
+        return log_writer.stats()
+    return None
+
+
+# Every Logger, to update their selective logging flag
+loggers = weakref.WeakSet()
+
+
+def set_selective_logging(modules):
+    """
+        Only print to console the logs of the given modules (all of them if modules is empty).
+        Loggers already created are updated.
+    """
+    global SELECTIVE_LOGGING, LOGGING_MODULES
+    SELECTIVE_LOGGING = len(modules) > 0
+    LOGGING_MODULES = list(modules)
+    for existing_logger in list(loggers):
+        existing_logger.update_selection()
+
+
+def format_message(msg, args):
+    """
+        Builds the message of a log call : msg % args if args are given, msg() if msg is callable.
+        Only called once the level filters passed.
+    """
+    if args:
+        try:
+            return str(msg) % args
+        except (TypeError, ValueError):
+            return str(msg) + " " + " ".join(str(arg) for arg in args)
+    if callable(msg):
+        return str(msg())
+    return str(msg)
+
 
 class Logger(object):
+    """
+        Logger of a service.
+
+        v/d/i/w/e take a message and optional %-style arguments, or a callable returning the
+        message. Formatting only happens if the message passes the level filter, so that
+        a suppressed call costs almost nothing :
+
+            self.logger.d("%s %s", topic, payload)
+            self.logger.v(lambda: expensive_dump(state))
+    """
+
     def __init__(self, service):
 
         self.log_to_console = True
@@ -98,105 +493,96 @@ class Logger(object):
         else:
             self.ident = service.__class__.__name__
 
-        self.config = {"serviceName": self.ident, "level": ""}
+        # One extra dict per level, never modified : Loggers are used from several threads
+        self.extras = {}
+        for level in LOGGING_LEVELS:
+            self.extras[level] = {"serviceName": self.ident, "level": level}
+
+        self.update_selection()
+        loggers.add(self)
+
+    def update_selection(self):
+        """
+            Precompute the selective logging filter : if we are in selective logging, we don't
+            want to print any output related to modules not in the LOGGING_MODULES list
+        """
+        self.selected = not SELECTIVE_LOGGING or self.ident in LOGGING_MODULES
 
     def print_to_console(self, msg, level):
         """
             Prints message to console using nice formatting.
         """
-        # If we are in selective logging, we don't want to print any output
-        # related to modules not in the LOGGING_MODULES list
-        if SELECTIVE_LOGGING:
-            if self.ident not in LOGGING_MODULES:
-                return
-
-        header = Bcolors.NORMAL
-        failcolor = Bcolors.NORMAL
-        if level == "INFO":
-            header = Bcolors.OKGREEN
-        elif level == "WARNING":
-            header = Bcolors.WARNING
-            failcolor = Bcolors.WARNING
-        elif level == "ERROR":
-            header = Bcolors.FAIL
-            failcolor = Bcolors.FAIL
-
-        print ((Bcolors.HEADER + "%s " + Bcolors.ENDC +
-                ":" + header +" %s " + Bcolors.ENDC +
-                failcolor + "- %s" + Bcolors.ENDC) % (self.ident.ljust(20), level.ljust(8), msg) )
-
-    def v(self, msg):
+        if not self.selected:
+            return
+
+        print(console_line(self.ident, level, msg))
+
+    def write(self, msg, args, level):
         """
-            Logs debug message.
+            Formats message and writes it to console and file, or queue it in asynchronous mode.
         """
-        if CURRENT_LEVEL < LEVEL_VERBOSE:
+        to_console = self.log_to_console and self.selected
+        to_file = CURRENT_LEVEL > 0
+        if not to_console and not to_file:
+            return
+
+        msg = format_message(msg, args)
+        writer = log_writer
+        if writer is not None:
+            writer.put((time(), self.ident, level, msg, to_console, to_file))
             return
 
-        msg = str(msg)
-        if self.log_to_console:
-            self.print_to_console(msg.encode("utf8"), "VERBOSE")
-        if CURRENT_LEVEL > 0:
-            self.config["level"] = "VERBOSE"
-            self.log.verbose(msg, extra=self.config)
+        if to_console:
+            print(console_line(self.ident, level, msg))
+        if to_file:
+            if file_handler is None:
+                get_file_handler()
+            self.log.log(LOGGING_LEVELS[level], msg, extra=self.extras[level])
 
-    def d(self, msg):
+    def v(self, msg, *args):
         """
-            Logs debug message.
+            Logs verbose message.
         """
+        if CURRENT_LEVEL < LEVEL_VERBOSE:
+            return
+        self.write(msg, args, "VERBOSE")
 
+    def d(self, msg, *args):
+        """
+            Logs debug message.
+        """
         if CURRENT_LEVEL < LEVEL_DEBUG:
             return
+        self.write(msg, args, "DEBUG")
 
-        msg = str(msg)
-        if self.log_to_console:
-            self.print_to_console(msg.encode("utf8"), "DEBUG")
-        if CURRENT_LEVEL > 0:
-            self.config["level"] = "DEBUG"
-            self.log.debug(msg, extra=self.config)
-
-    def i(self, msg):
+    def i(self, msg, *args):
         """
-            Logs debug message.
+            Logs info message.
         """
         if CURRENT_LEVEL < LEVEL_INFO:
             return
+        self.write(msg, args, "INFO")
 
-        msg = str(msg)
-        if self.log_to_console:
-            self.print_to_console(msg.encode("utf8"), "INFO")
-        if CURRENT_LEVEL > 0:
-            self.config["level"] = "INFO"
-            self.log.info(msg, extra=self.config)
-
-    def w(self, msg):
+    def w(self, msg, *args):
         """
             Logs warning message.
         """
+        # Warnings and errors are always kept in log_messages, format them right away
+        msg = format_message(msg, args)
         add_log_message(LEVEL_WARNING, self.ident, msg)
         if CURRENT_LEVEL < LEVEL_WARNING:
             return
+        self.write(msg, (), "WARNING")
 
-        msg = str(msg)
-        if self.log_to_console:
-            self.print_to_console(msg.encode("utf8"), "WARNING")
-        if CURRENT_LEVEL > 0:
-            self.config["level"] = "WARNING"
-            self.log.warning(msg, extra=self.config)
-
-    def e(self, msg):
+    def e(self, msg, *args):
         """
             Logs error message.
         """
+        msg = format_message(msg, args)
         add_log_message(LEVEL_ERROR, self.ident, msg)
         if CURRENT_LEVEL < LEVEL_ERROR:
             return
-
-        msg = str(msg)
-        if self.log_to_console:
-            self.print_to_console(msg.encode("utf8"), "ERROR")
-        if CURRENT_LEVEL > 0:
-            self.config["level"] = "ERROR"
-            self.log.error(msg, extra=self.config)
+        self.write(msg, (), "ERROR")
 
 
 def write(data):
@@ -209,4 +595,5 @@ def write(data):
     add_log_message(LEVEL_ERROR, "TRACEBACK", str(data))
 
 __all__ = ["Logger", "LEVEL_DEBUG", "LEVEL_ERROR", "LEVEL_VERBOSE", "LEVEL_INFO", "LEVEL_WARNING",
-           "CURRENT_LEVEL", "SELECTIVE_LOGGING"]
+           "CURRENT_LEVEL", "SELECTIVE_LOGGING", "set_selective_logging", "enable_async_logging", "flush_logging",
+           "shutdown_logging", "logging_stats", "get_log_messages"]
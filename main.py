@@ -1,16 +1,53 @@
-import sys
 import time
+
+# Startup profiling starts before the runtime is imported
+START_TIME = time.time()
+
+import sys
 import argparse
+import threading
 import log
 
 from config import *
-import services.core.core as core
+
+RUNTIME_IMPORT_TIME = time.time() - START_TIME
+
+# Maximum time the startup profile waits for a service's first SUBACK after READY
+PROFILE_SUBACK_TIMEOUT = 5
 
 #####################################
 # ---------- MAIN ---------- #
 #####################################
 
 
+def print_startup_profile(core_service, core_import_time, core_init_time):
+    """
+        Print where startup time went, once every service is launched
+    """
+    core_service.ready_event.wait()
+    # Services which don't start their network loop in __init__ subscribe from run()
+    for client in [core_service] + [getattr(core_service, service["service_name"], None)
+                                    for service in core_service.services]:
+        # Async clients subscribe from the event loop and have no subscribed_event
+        subscribed_event = getattr(client, "subscribed_event", None)
+        if subscribed_event is not None and getattr(client, "topic_list", None):
+            subscribed_event.wait(PROFILE_SUBACK_TIMEOUT)
+
+    def seconds(timings, step):
+        return "%9.3f" % timings[step] if step in timings else "%9s" % "-"
+
+    lines = ["Startup profile (seconds)",
+             "  runtime imports %9.3f" % RUNTIME_IMPORT_TIME,
+             "  core import     %9.3f" % core_import_time,
+             "  core init       %9.3f" % core_init_time,
+             "  %-20s %9s %9s %9s %9s" % ("service", "import", "construct", "connect", "subscribe")]
+    for name, timings in core_service.startup_profile():
+        lines.append("  %-20s %s %s %s %s" % (name, seconds(timings, "import"), seconds(timings, "construct"),
+                                               seconds(timings, "connect"), seconds(timings, "subscribe")))
+    lines.append("  time to READY   %9.3f" % (core_service.readyTime - START_TIME))
+    print("\n".join(lines))
+
+
 def main():
     parser = argparse.ArgumentParser(description='Micro Services')
     parser.add_argument("-l", "--log_level", help="logging level: higher the value, the more logs you get",
@@ -20,22 +57,41 @@ def main():
     parser.add_argument("-r", "--max_restart", help="Maximum number of restart tries when a service doesn't run.",
                         default=3, type=int)
     parser.add_argument("-d", "--daemon", help="Enable daemon mode ", required=False, action="store_true")
+    parser.add_argument("-a", "--async_logging", help="Write logs from a background thread, callers only queue them",
+                        required=False, action="store_true")
+    parser.add_argument("-p", "--profile_startup", "--profile-startup",
+                        help="Print import, connection and subscription times of the startup",
+                        required=False, action="store_true")
 
     args = parser.parse_args()
+    install_signal_handlers()
 
     # If selective logging is used
     if args.selective_logging:
         # Get selective modules
-        log.SELECTIVE_LOGGING = True
-        log.LOGGING_MODULES = args.selective_logging
+        log.set_selective_logging(args.selective_logging)
 
     if args.log_level:
         log.CURRENT_LEVEL = args.log_level
 
+    if args.async_logging:
+        log.enable_async_logging()
+
+    # The Core imports the services listed in services.conf only
+    start = time.time()
+    import services.core.core as core
+    core_import_time = time.time() - start
+
     if args.max_restart:
         core.MAX_RESTART_RETRY = args.max_restart
 
+    start = time.time()
     core_service = core.Core(args.daemon)
+    core_init_time = time.time() - start
+
+    if args.profile_startup:
+        threading.Thread(target=print_startup_profile, args=(core_service, core_import_time, core_init_time),
+                         name="startup_profile", daemon=True).start()
 
     try:
         core_service.run()
@@ -47,6 +103,8 @@ def main():
         pass
         core_service.logger.i("Ending microservices...")
         core_service.kill_all_services()
+        # SIGKILL below skips atexit, write queued logs now
+        log.shutdown_logging()
         import os
         import signal
         os.kill(os.getpid(), signal.SIGKILL)
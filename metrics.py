@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+from time import time
+import threading
+
+"""
+    Metrics module : counters, gauges and latency histograms of the process.
+
+    Counters and histograms are written to a shard owned by the calling thread, so the
+    hot path takes no lock. Shards are summed when metrics are collected : published by
+    the Core on METRICS_TOPIC and served in the Prometheus text format.
+"""
+
+# Histogram buckets : values in microseconds, 2^SUB_BUCKET_BITS buckets per power of two
+# (about 12% relative precision)
+SUB_BUCKET_BITS = 3
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+def metric_key(name, **labels):
+    """
+        Returns the key of a metric, to be computed once and given to inc/observe/set_gauge
+        :param name: Metric name, ex : mqtt_messages_received_total
+        :param labels: Label values, ex : service="Example"
+    """
+    return (name, tuple(sorted(labels.items())))
+
+
+def format_key(key):
+    """
+        Returns name{label="value",...} of a metric key
+    """
+    name, labels = key
+    if not labels:
+        return name
+    return name + "{" + ",".join('%s="%s"' % (label, str(value).replace('"', '\\"')) for label, value in labels) + "}"
+
+
+def bucket_index(micros):
+    if micros < 2 * SUB_BUCKETS:
+        return micros
+    shift = micros.bit_length() - SUB_BUCKET_BITS - 1
+    return (shift + 1) * SUB_BUCKETS + (micros >> shift) - SUB_BUCKETS
+
+
+def bucket_upper_bound(index):
+    """
+        Returns the highest value of a bucket, in microseconds
+    """
+    if index < 2 * SUB_BUCKETS:
+        return index
+    shift = index // SUB_BUCKETS - 1
+    return ((index % SUB_BUCKETS + SUB_BUCKETS + 1) << shift) - 1
+
+
+class Histogram(object):
+    """
+        Log-linear histogram of durations, in the spirit of HdrHistogram
+    """
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        index = bucket_index(int(seconds * 1000000))
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        for index, count in other.counts.copy().items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.max > self.max:
+            self.max = other.max
+
+    def quantile(self, q):
+        """
+            Returns the value under which a fraction q of the recorded durations are, in seconds
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(bucket_upper_bound(index) / 1000000.0, self.max)
+        return self.max
+
+    def as_dict(self):
+        summary = {"count": self.count, "sum": self.total, "max": self.max}
+        for q in QUANTILES:
+            summary["p%g" % (q * 100)] = self.quantile(q)
+        return summary
+
+
+class MetricsShard(object):
+    """
+        Counters and histograms written by a single thread
+    """
+    __slots__ = ("thread", "counters", "histograms")
+
+    def __init__(self, thread):
+        self.thread = thread
+        self.counters = {}
+        self.histograms = {}
+
+    def merge_into(self, counters, histograms):
+        for key, value in self.counters.copy().items():
+            counters[key] = counters.get(key, 0) + value
+        for key, histogram in self.histograms.copy().items():
+            if key not in histograms:
+                histograms[key] = Histogram()
+            histograms[key].merge(histogram)
+
+
+class MetricsRegistry(object):
+    """
+        Metrics of the process. Threads record in their own shard, collect() sums them.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.shards = []
+        # Totals of the shards of threads which ended
+        self.retired = MetricsShard(None)
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = MetricsShard(threading.current_thread())
+            with self.lock:
+                self.shards.append(shard)
+            self.local.shard = shard
+            return shard
+
+    def inc(self, key, value=1):
+        """
+            Increment a counter
+            :param key: Returned by metric_key
+        """
+        counters = self.shard().counters
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, key, seconds):
+        """
+            Record a duration in a histogram
+            :param key: Returned by metric_key
+        """
+        histograms = self.shard().histograms
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = Histogram()
+            histograms[key] = histogram
+        histogram.record(seconds)
+
+    def set_gauge(self, key, value):
+        self.gauges[key] = value
+
+    def collect(self):
+        """
+            Returns (counters, gauges, histograms), each a dict of metric key => value
+        """
+        counters = {}
+        histograms = {}
+        with self.lock:
+            for shard in list(self.shards):
+                if not shard.thread.is_alive():
+                    # The thread can't write anymore, its shard is folded into the retired totals
+                    self.shards.remove(shard)
+                    shard.merge_into(self.retired.counters, self.retired.histograms)
+                else:
+                    shard.merge_into(counters, histograms)
+            self.retired.merge_into(counters, histograms)
+        return counters, self.gauges.copy(), histograms
+
+    def snapshot(self):
+        """
+            Returns the metrics as a JSON serializable dict
+        """
+        counters, gauges, histograms = self.collect()
+        return {
+            "timestamp": time(),
+            "counters": dict((format_key(key), value) for key, value in counters.items()),
+            "gauges": dict((format_key(key), value) for key, value in gauges.items()),
+            "histograms": dict((format_key(key), histogram.as_dict()) for key, histogram in histograms.items()),
+        }
+
+    def prometheus_text(self):
+        """
+            Returns the metrics in the Prometheus text exposition format.
+            Histograms are exposed as summaries (quantiles, sum and count).
+        """
+        counters, gauges, histograms = self.collect()
+        lines = []
+        for metrics_type, values in (("counter", counters), ("gauge", gauges)):
+            for name in sorted(set(key[0] for key in values)):
+                lines.append("# TYPE %s %s" % (name, metrics_type))
+                for key in sorted(key for key in values if key[0] == name):
+                    lines.append("%s %s" % (format_key(key), values[key]))
+        for name in sorted(set(key[0] for key in histograms)):
+            lines.append("# TYPE %s summary" % name)
+            for key in sorted(key for key in histograms if key[0] == name):
+                histogram = histograms[key]
+                for q in QUANTILES:
+                    lines.append("%s %s" % (format_key((name, key[1] + (("quantile", q),))), histogram.quantile(q)))
+                lines.append("%s %s" % (format_key((name + "_sum", key[1])), histogram.total))
+                lines.append("%s %s" % (format_key((name + "_count", key[1])), histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self.lock:
+            for shard in self.shards:
+                shard.counters.clear()
+                shard.histograms.clear()
+            self.retired = MetricsShard(None)
+            self.gauges.clear()
+
+
+metrics = MetricsRegistry()
+
+http_server = None
+
+
+def start_http_server(port, host="127.0.0.1"):
+    """
+        Serve metrics in the Prometheus text format on http://host:port/metrics, from a daemon thread
+    """
+    global http_server
+    if http_server is not None:
+        return http_server
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = metrics.prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    http_server = ThreadingHTTPServer((host, port), MetricsHandler)
+    http_server.daemon_threads = True
+    threading.Thread(target=http_server.serve_forever, name="metrics_http", daemon=True).start()
+    return http_server
+
+
+def stop_http_server():
+    global http_server
+    if http_server is not None:
+        http_server.shutdown()
+        http_server.server_close()
+        http_server = None
+
+
+__all__ = ["metrics", "metric_key", "format_key", "Histogram", "MetricsRegistry", "start_http_server",
+           "stop_http_server"]
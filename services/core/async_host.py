@@ -0,0 +1,65 @@
+import asyncio
+import threading
+
+
+class AsyncServiceHandle(object):
+    """
+        Handle of an async service running on the AsyncServiceHost.
+        Exposes the same liveness interface as a threading.Thread.
+    """
+
+    def __init__(self, future):
+        self.future = future
+
+    def is_alive(self):
+        return not self.future.done()
+
+    isAlive = is_alive
+
+    def cancel(self):
+        self.future.cancel()
+
+
+class AsyncServiceHost(object):
+    """
+        Event loop, running in its own thread, on which every async service
+        of the Core is scheduled.
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.loop = None
+        self.thread = None
+        self.started = threading.Event()
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.run_loop, name="async_services", daemon=True)
+        self.thread.start()
+        self.started.wait()
+
+    def run_loop(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.started.set()
+        self.logger.i("Async service loop started")
+        self.loop.run_forever()
+
+    def submit(self, coroutine):
+        """
+            Schedule coroutine on the event loop
+            :return: AsyncServiceHandle
+        """
+        self.start()
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        future.add_done_callback(self.on_service_done)
+        return AsyncServiceHandle(future)
+
+    def on_service_done(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            self.logger.e("Async service stopped on exception : " + repr(future.exception()))
+
+    def stop(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
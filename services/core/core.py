@@ -1,23 +1,50 @@
 import log
 import sys
 import time
+import queue
+import random
 import threading
 import traceback
 import os
-import sdnotify
+from concurrent.futures import ThreadPoolExecutor
 
 SRC_ROOT_DIR = "../../"
 sys.path.append(SRC_ROOT_DIR)
 
 from config import *
-from services.service_base import ServiceBase
+from services.service_base import ServiceBase, AsyncServiceBase
+from services.core.registry import ServiceRegistry
 from broker.mqtt import MqttClient
+from broker.dispatch import topic_handler
+from broker.rate_limit import RATE_OPTIONS, parse_rate_options, configure_service, set_global_budget, shared_bucket
+from metrics import metrics, metric_key, start_http_server
 
 SERVICE_CONF_FILE = "services.conf"
 VERSION_FILE = "VERSION"
 
 MAX_RESTART_RETRY = 3
 
+# Restart backoff : first restart is immediate, then RESTART_BACKOFF_BASE * 2^n seconds
+# (+/- RESTART_JITTER), up to RESTART_BACKOFF_MAX. A service running for RESTART_STABLE_TIME
+# is considered healthy again and its restart count is reset.
+RESTART_BACKOFF_BASE = 0.5
+RESTART_BACKOFF_MAX = 60
+RESTART_JITTER = 0.2
+RESTART_STABLE_TIME = 25
+
+# Maximum time between two supervision passes (process heartbeats, watchdog)
+SUPERVISION_PERIOD = 5
+# Watchdog period when WATCHDOG_USEC isn't given by systemd
+DEFAULT_WATCHDOG_PERIOD = 10
+
+# Execution modes of a service, set with the "mode" option in services.conf
+SERVICE_MODES = ["thread", "process", "async"]
+SERVICE_OPTIONS = ["mode", "after"] + RATE_OPTIONS
+
+# Services are constructed concurrently (their constructors mostly wait for the broker),
+# except those listed in their "after" option which are waited for
+STARTUP_WORKERS = 8
+
 class Core(MqttClient, ServiceBase):
 
     def __init__(self, daemon):
@@ -35,12 +62,40 @@ class Core(MqttClient, ServiceBase):
         self.isDaemon = False
         if daemon:
             self.isDaemon = True
+            # Only needed in daemon mode
+            import sdnotify
             self.daemon = sdnotify.SystemdNotifier()
 
         self.logger.i("Log level is " + str(log.CURRENT_LEVEL))
         self.logger.i("Maximum restart retry number is " + str(MAX_RESTART_RETRY))
 
+        # Outbound budget of the services, in shared memory for process services. Created after the
+        # Core's own client : supervision, metrics and logs are never held back by the services.
+        if MQTT_RATE_GLOBAL > 0:
+            from services.core.process_host import process_context
+            set_global_budget(shared_bucket(MQTT_RATE_GLOBAL, MQTT_RATE_GLOBAL_BURST, process_context))
+            self.logger.i("Global publish budget is %.1f messages/s" % MQTT_RATE_GLOBAL)
+
         self.relaunchCnt = {}
+        # Exits of service threads/processes/tasks, consumed by the supervision loop
+        self.service_events = queue.Queue()
+        self.launchGeneration = {}
+        self.launchTime = {}
+        self.pendingRestarts = {}
+        self.lastSupervision = time.time()
+        # Set once every service is launched, when READY=1 is sent in daemon mode
+        self.ready_event = threading.Event()
+        self.readyTime = None
+        self.nextMetrics = time.time() + METRICS_PERIOD
+
+        # Event loop shared by async services, created with the first of them
+        self.async_host = None
+        # service name => (services.conf path, mandatory, execution mode)
+        self.service_modes = {}
+        # service name => MqttClient rate arguments set in services.conf
+        self.service_rate_limits = {}
+        # Service classes are imported once, restarts reuse them
+        self.registry = ServiceRegistry(self.logger)
 
         try:
             self.version = self.get_version()
@@ -55,8 +110,8 @@ class Core(MqttClient, ServiceBase):
 
             # Import and init plugin_modules
             for service in self.services:
-                self.relaunchCnt[service["name"]] = 0
-                self.init_service(service["name"], service["mandatory"])
+                self.relaunchCnt[service["service_name"]] = 0
+            self.init_services()
 
         except Exception as e:
             exc_type, exc_obj, exc_tb = sys.exc_info()
@@ -85,14 +140,41 @@ class Core(MqttClient, ServiceBase):
                 if len(service_line) > 0:
                     if service_line[0] != '#' :
 
-                        # A service is made of its name and its "mandatory" attribute which is "true" or "false"
+                        # A service is made of its name and its "mandatory" attribute which is "true" or "false",
+                        # optionally followed by options formatted as key=value
                         # Verify that it's formatted well
-                        if len(service_line.split(",")) != 2:
+                        fields = service_line.split(",")
+                        if len(fields) < 2:
                             raise Exception("Service's format is wrong in services.conf : " + service_line)
-                        elif service_line.split(",")[1] != "True" and service_line.split(",")[1] != "False":
+                        elif fields[1] != "True" and fields[1] != "False":
                             raise Exception("Service's format is wrong in services.conf : " + service_line)
-                        else :
-                            services.append({"name":service_line.split(",")[0], "mandatory":service_line.split(",")[1]})
+
+                        options = {}
+                        for option in fields[2:]:
+                            if len(option.split("=")) != 2 or option.split("=")[0].strip() not in SERVICE_OPTIONS:
+                                raise Exception("Service's option is wrong in services.conf : " + service_line)
+                            options[option.split("=")[0].strip()] = option.split("=")[1].strip()
+
+                        mode = options.get("mode", "thread")
+                        if mode not in SERVICE_MODES:
+                            raise Exception("Service's mode is wrong in services.conf : " + service_line)
+
+                        # Services that must be constructed first, separated by "|" (ex : after=net/abstraction|storage)
+                        after = []
+                        if options.get("after"):
+                            after = [name.split('/')[-1] for name in options["after"].split("|")]
+                        for name in after:
+                            if name not in [previous["service_name"] for previous in services]:
+                                raise Exception("Service's after option must name a previous service in services.conf : " + service_line)
+
+                        # Publish rate limits (ex : rate=50,rate_policy=drop,topic_rate=sensors/#:5:coalesce)
+                        try:
+                            rate_limits = parse_rate_options(options)
+                        except ValueError as e:
+                            raise Exception("Service's rate options are wrong in services.conf : " + service_line + " : " + str(e))
+
+                        services.append({"name":fields[0], "service_name":fields[0].split('/')[-1], "mandatory":fields[1],
+                                         "mode":mode, "after":after, "options":options, "rate_limits":rate_limits})
 
         return services
 
@@ -105,25 +187,67 @@ class Core(MqttClient, ServiceBase):
 
 
 
-    def init_service(self, service, mandatory):
+    def init_services(self):
+        """
+            Import and construct every service of services.conf, concurrently. A service with
+            an "after" option is constructed once the services it names are.
+        """
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=STARTUP_WORKERS, thread_name_prefix="service_init") as executor:
+            futures = {}
+            # Services are submitted in services.conf order and "after" only names previous
+            # services, so a waiting task never holds a worker needed by what it waits for
+            for service in self.services:
+                futures[service["service_name"]] = executor.submit(
+                    self.init_service_after,
+                    service,
+                    [futures[name] for name in service["after"]],
+                )
+            for service in self.services:
+                futures[service["service_name"]].result()
+
+        for service_name, steps in self.registry.report().items():
+            self.logger.i(
+                "%s imported in %.3f s, constructed in %.3f s",
+                service_name,
+                steps.get("import", 0),
+                steps.get("construct", 0),
+            )
+        self.logger.i("Services initialized in %.3f s", time.time() - start)
+
+    def init_service_after(self, service, dependencies):
+        for dependency in dependencies:
+            dependency.result()
+        self.init_service(service["name"], service["mandatory"], service["mode"], service["rate_limits"])
+
+    def init_service(self, service, mandatory, mode="thread", rate_limits=None):
         # Import service package
         self.logger.i("Importing " + service)
 
-        service_name = service
+        # A service path (ex : net/abstraction) is named after its final package part => "abstraction"
+        service_name = service.split('/')[-1]
+        service_class = self.registry.resolve(service)
+        self.service_rate_limits[service_name] = rate_limits
+
+        # A process-hosted service is created inside its worker process by launch_service
+        if mode == "process":
+            self.service_modes[service_name] = (service, mandatory == "True", mode)
+            return
 
-        # If service is a path (ex : net/abstraction) we transform it to "net.abstraction" to import it
-        # We also use only the final package part to name it => "abstraction"
-        if len(service.split('/')) > 1 :
-            service_name = service.split('/')[-1]
-            exec("import services."  +
-                 service.replace("/",".") + "." +
-                 service_name + " as " +  service_name)
-        else:
-            exec("import services." + service + "." + service + " as " + service)
+        # Release the broker connection of a previous (crashed) instance before replacing it
+        previous = getattr(self, service_name, None)
+        if previous is not None and hasattr(previous, "disconnect_mqtt"):
+            previous.disconnect_mqtt()
 
         # Init service
-        capitalizedService = service_name[0].capitalize() + service_name[1:]
-        exec("self." + service_name + "=" + service_name + "." + capitalizedService + "(" + mandatory +")")
+        configure_service(service_class.__name__, rate_limits)
+        start = time.time()
+        setattr(self, service_name, service_class(mandatory == "True"))
+        self.registry.record(service_name, "construct", time.time() - start)
+        self.service_modes[service_name] = (service, mandatory == "True", mode)
+
+        if mode == "async" and not isinstance(getattr(self, service_name), AsyncServiceBase):
+            raise Exception(service + " is not an async service and can't be run in async mode")
 
     def launch_service(self, service):
         self.logger.i("Launching " + service)
@@ -133,71 +257,274 @@ class Core(MqttClient, ServiceBase):
             if len(service.split('/')) > 1 :
                 service = service.split('/')[-1]
 
-            exec("self." + service + "_thread = threading.Thread(target=self." + service + ".run)")
-            exec("self." + service + "_thread.start()")
+            # Every launch has its own generation, so that the exit of a replaced instance is ignored
+            generation = self.launchGeneration.get(service, 0) + 1
+            self.launchGeneration[service] = generation
+            self.launchTime[service] = time.time()
+
+            def on_exit(*args):
+                self.service_events.put((service, generation))
+
+            # Process services get a worker process, async services are scheduled on the
+            # shared event loop, others get their own thread
+            service_path, mandatory, mode = self.service_modes[service]
+            if mode == "process":
+                # multiprocessing and asyncio are only imported when a service needs them
+                from services.core.process_host import ProcessServiceHandle
+                previous = getattr(self, service + "_thread", None)
+                if isinstance(previous, ProcessServiceHandle):
+                    previous.terminate()
+                handle = ProcessServiceHandle(self.logger, service_path, mandatory, on_exit,
+                                              self.service_rate_limits.get(service))
+                setattr(self, service + "_thread", handle)
+                handle.start()
+            elif isinstance(getattr(self, service), AsyncServiceBase):
+                if self.async_host is None:
+                    from services.core.async_host import AsyncServiceHost
+                    self.async_host = AsyncServiceHost(self.logger)
+                handle = self.async_host.submit(getattr(self, service).main())
+                handle.future.add_done_callback(on_exit)
+                setattr(self, service + "_thread", handle)
+            else:
+                handle = threading.Thread(
+                    target=self.run_service, args=(service, getattr(self, service).run, on_exit), name=service
+                )
+                setattr(self, service + "_thread", handle)
+                handle.start()
 
         except Exception as e:
             print(e)
 
+    def run_service(self, service, run, on_exit):
+        """
+            Thread target of a service : notify the supervision loop as soon as run returns or raises
+        """
+        try:
+            run()
+            self.logger.e(service + " run() returned")
+        except Exception as e:
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            exceptionStr = (
+                    os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+                    + ", line "
+                    + str(exc_tb.tb_lineno)
+                    + " : "
+                    + str(e)
+                    + "".join(traceback.format_tb(e.__traceback__))
+            )
+            self.logger.e(service + " crashed : " + exceptionStr)
+        finally:
+            on_exit()
+
     def kill_all_services(self):
-        pass
+        # Threads die with the Core process, worker processes have to be stopped
+        for service in self.services:
+            handle = getattr(self, service["service_name"] + "_thread", None)
+            if service["mode"] == "process" and handle is not None:
+                handle.terminate()
 
 
+    @topic_handler(LOG_REQUEST_TOPIC)
+    def on_log_request(self, parsed_json, topic):
+        """
+            Answer on LOG_RESPONSE_TOPIC with the recent warnings and errors kept in memory.
+            Request : {"command": "get_errors", "data": {"level": 0, "tag": "Example", "since": 1582624000,
+                       "until": 1582628000, "limit": 50}}, every filter being optional.
+        """
+        filters = {}
+        if isinstance(parsed_json, dict) and isinstance(parsed_json.get("data"), dict):
+            filters = parsed_json["data"]
+
+        records = log.get_log_messages(
+            filters.get("level"),
+            filters.get("tag"),
+            filters.get("since"),
+            filters.get("until"),
+            filters.get("limit", 50),
+        )
+        self.publish_mqtt(
+            parsed_json.get("id") if isinstance(parsed_json, dict) else None,
+            [record.as_dict() for record in records],
+            LOG_RESPONSE_TOPIC,
+        )
+
+    def startup_profile(self):
+        """
+            Returns the startup timings of the Core and of each service, in seconds :
+            [(name, {"import", "construct", "connect", "subscribe"})]. Process services
+            are created in their worker process and only have an import timing.
+        """
+        registry_timings = self.registry.report()
+        profile = [("core", dict(self.startup_timings))]
+        for service in self.services:
+            timings = dict(registry_timings.get(service["service_name"], {}))
+            timings.update(getattr(getattr(self, service["service_name"], None), "startup_timings", {}))
+            profile.append((service["service_name"], timings))
+        return profile
+
     def notify(self, notif):
         self.daemon.notify(notif)
 
-    def run(self):
-        global MAX_RESTART_RETRY
+    def restart_delay(self, service_name):
+        """
+            Exponential backoff with jitter, based on the number of consecutive restarts
+        """
+        if self.relaunchCnt[service_name] == 0:
+            return 0
+        delay = min(RESTART_BACKOFF_MAX, RESTART_BACKOFF_BASE * 2 ** (self.relaunchCnt[service_name] - 1))
+        return delay * random.uniform(1 - RESTART_JITTER, 1 + RESTART_JITTER)
 
+    def on_service_exit(self, service):
+        """
+            Called by the supervision loop when a service stopped : schedule its restart
+        """
+        service_name = service["service_name"]
+        self.logger.e(service_name + "_thread is inactive")
+        metrics.inc(metric_key("core_service_exits_total", service=service_name))
+
+        # A service which ran long enough before stopping gets a fresh restart count
+        if time.time() - self.launchTime.get(service_name, 0) >= RESTART_STABLE_TIME:
+            self.relaunchCnt[service_name] = 0
+        self.schedule_restart(service)
+
+    def schedule_restart(self, service):
+        """
+            Schedule the restart of a service after the backoff delay of its restart count
+        """
+        service_name = service["service_name"]
+        if self.relaunchCnt[service_name] >= MAX_RESTART_RETRY:
+            # If service isn't mandatory, create fault on the gateway and keep retrying at the backoff pace
+            if service["mandatory"] == "False":
+                pass
+                # self.send_service_fault_mqtt(CMD_ID_SERVICE_FAULT, service_name)
+            else:
+                self.logger.e("Max retry number was reached on a mandatory service. Send KO system message")
+                sys.exit(2)
+
+        delay = self.restart_delay(service_name)
+        self.logger.e("Restarting %s_thread in %.1f s", service_name, delay)
+        self.pendingRestarts[service_name] = (time.time() + delay, service)
+
+    def restart_due_services(self):
+        now = time.time()
+        for service_name, (due, service) in list(self.pendingRestarts.items()):
+            if due <= now:
+                del self.pendingRestarts[service_name]
+                # Re-Init and Relaunch inactive service
+                try:
+                    self.init_service(service["name"], service["mandatory"], service["mode"],
+                                      service["rate_limits"])
+                except Exception as e:
+                    exc_type, exc_obj, exc_tb = sys.exc_info()
+                    exceptionStr = (
+                            os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+                            + ", line "
+                            + str(exc_tb.tb_lineno)
+                            + " : "
+                            + str(e)
+                            + "".join(traceback.format_tb(e.__traceback__))
+                    )
+                    self.logger.e(service_name + " restart failed : " + exceptionStr)
+                    # Counted as a restart, so that the next attempt waits longer
+                    self.relaunchCnt[service_name] += 1
+                    metrics.inc(metric_key("core_service_restarts_total", service=service_name))
+                    self.schedule_restart(service)
+                    continue
+                self.launch_service(service["name"])
+                self.relaunchCnt[service_name] += 1
+                metrics.inc(metric_key("core_service_restarts_total", service=service_name))
+
+    def check_heartbeats(self):
+        """
+            Process services can hang without exiting : a stale heartbeat terminates the
+            process, whose exit is then notified like any other
+        """
+        for service in self.services:
+            handle = getattr(self, service["service_name"] + "_thread", None)
+            if service["mode"] == "process" and handle is not None:
+                handle.is_alive()
+
+    def publish_metrics(self):
+        """
+            Publish the metrics of the Core process on METRICS_TOPIC. Services run in process mode
+            aren't part of them.
+        """
+        running = 0
+        for service in self.services:
+            handle = getattr(self, service["service_name"] + "_thread", None)
+            if handle is not None and handle.is_alive() and service["service_name"] not in self.pendingRestarts:
+                running += 1
+        metrics.set_gauge(metric_key("core_services_running"), running)
+        metrics.set_gauge(metric_key("core_services_pending_restart"), len(self.pendingRestarts))
+        self.publish_json_mqtt(metrics.snapshot(), METRICS_TOPIC)
+
+    def watchdog_period(self):
+        """
+            systemd expects a WATCHDOG=1 notification every WATCHDOG_USEC microseconds,
+            notify twice as often
+        """
         try:
+            return int(os.environ["WATCHDOG_USEC"]) / 1e6 / 2
+        except (KeyError, ValueError):
+            return DEFAULT_WATCHDOG_PERIOD
+
+    def watchdog_loop(self):
+        period = self.watchdog_period()
+        self.logger.i("Watchdog period is %.1f s", period)
+        while True:
+            # Only notify if the supervision loop is still running
+            if time.time() - self.lastSupervision < 2 * SUPERVISION_PERIOD + period:
+                self.daemon.notify("WATCHDOG=1")
+            else:
+                self.logger.e("Supervision loop is stuck, watchdog isn't notified")
+            time.sleep(period)
+
+    def run(self):
+        try:
+            # Services are already constructed, launching only starts their thread/process/task
             for service in self.services:
                 self.launch_service(service["name"])
-                time.sleep(0.1)
 
+            self.readyTime = time.time()
+            self.ready_event.set()
+            metrics.set_gauge(metric_key("core_startup_seconds"), self.readyTime - self.init_time)
+            if METRICS_HTTP_PORT > 0:
+                start_http_server(METRICS_HTTP_PORT, METRICS_HTTP_HOST)
+                self.logger.i("Metrics served on http://%s:%d/metrics", METRICS_HTTP_HOST, METRICS_HTTP_PORT)
             if self.isDaemon:
                 self.daemon.notify("READY=1")
+                threading.Thread(target=self.watchdog_loop, name="watchdog", daemon=True).start()
 
+            services = {}
+            for service in self.services:
+                services[service["service_name"]] = service
 
             while(1):
-                self.logger.v("Checking threads...")
-
-                # iterate over all thread objects to find the one missing
-                for service in self.services:
-                    self.isAlive = False
-
-                    # If service string is a path, just use the package name
-                    if len(service["name"].split('/')) > 1:
-                        service_name = service["name"].split('/')[-1]
-                    else :
-                        service_name = service["name"]
-
-                    exec("self.isAlive = self." + service_name + "_thread.isAlive()")
-
-                    if self.isAlive:
-                        self.logger.v(service_name + " is alive")
-                        self.relaunchCnt[service_name] = 0
-
-                    # Try to relaunch a crashed service if relaunching hasn't failed already
-                    if not self.isAlive and self.relaunchCnt[service_name] < MAX_RESTART_RETRY:
-                        self.logger.e(service_name + "_thread is inactive")
-                        # Re-Init and Relaunch inactive thread if we have tried less than MAX_RESTART_RETRY times
-                        self.logger.e("Restarting " + service_name + "_thread")
-                        self.init_service(service["name"],service["mandatory"])
-                        self.launch_service(service["name"])
-                        self.relaunchCnt[service_name] += 1
-
-                        if self.relaunchCnt[service_name] >= MAX_RESTART_RETRY:
-                            # If service isn't mandatory, create fault on the gateway
-                            if service["mandatory"] == "False":
-                                pass
-                                # self.send_service_fault_mqtt(CMD_ID_SERVICE_FAULT, service_name)
-                            else:
-                                self.logger.e("Max retry number was reached on a mandatory service. Send KO system message")
-                                sys.exit(2)
-
-                if self.isDaemon:
-                    self.daemon.notify("WATCHDOG=1")
-                time.sleep(25)
+                self.lastSupervision = time.time()
+
+                timeout = SUPERVISION_PERIOD
+                if self.pendingRestarts:
+                    next_restart = min(due for due, service in self.pendingRestarts.values())
+                    timeout = max(0, min(timeout, next_restart - time.time()))
+                if METRICS_PERIOD > 0:
+                    timeout = max(0, min(timeout, self.nextMetrics - time.time()))
+
+                # Wait for a service to stop, or for the next restart / heartbeat check
+                try:
+                    service_name, generation = self.service_events.get(timeout=timeout)
+                    if generation == self.launchGeneration.get(service_name):
+                        self.on_service_exit(services[service_name])
+                except queue.Empty:
+                    self.logger.v("Checking services...")
+                    self.check_heartbeats()
+                start = time.time()
+
+                self.restart_due_services()
+
+                if METRICS_PERIOD > 0 and time.time() >= self.nextMetrics:
+                    self.nextMetrics = time.time() + METRICS_PERIOD
+                    self.publish_metrics()
+                metrics.observe(metric_key("core_supervision_seconds"), time.time() - start)
 
         except Exception as e:
             exc_type, exc_obj, exc_tb = sys.exc_info()
@@ -0,0 +1,107 @@
+import multiprocessing
+import threading
+import time
+
+from services.core.registry import load_service_class
+
+HEARTBEAT_INTERVAL = 1.0
+HEARTBEAT_TIMEOUT = 10.0
+
+# Services processes are spawned, not forked : the Core process runs paho network
+# threads whose locks must not be inherited by children.
+process_context = multiprocessing.get_context("spawn")
+
+
+def heartbeat_loop(heartbeat, interval):
+    while True:
+        heartbeat.value = time.time()
+        time.sleep(interval)
+
+
+def run_service_process(service, mandatory, heartbeat, interval, rate_limits=None, budget=None):
+    """
+        Entry point of a worker process : the service is created here, so it opens its own
+        broker connection, and a heartbeat is written to shared memory for the Core.
+        :param rate_limits: Rate arguments of the service's MqttClient set in services.conf
+        :param budget: Global publish budget of the Core, a TokenBucket in shared memory
+    """
+    # Imported here, the service classes import log and config
+    from config import SignalShutDown, install_signal_handlers
+    from services.service_base import AsyncServiceBase
+    from broker.rate_limit import configure_service, set_global_budget
+
+    install_signal_handlers()
+
+    heartbeat.value = time.time()
+    threading.Thread(target=heartbeat_loop, args=(heartbeat, interval), daemon=True).start()
+
+    try:
+        service_class = load_service_class(service)
+        set_global_budget(budget)
+        configure_service(service_class.__name__, rate_limits)
+        service_instance = service_class(mandatory)
+        if isinstance(service_instance, AsyncServiceBase):
+            import asyncio
+            asyncio.run(service_instance.main())
+        else:
+            service_instance.run()
+    except SignalShutDown:
+        # Terminated by the Core
+        pass
+
+
+class ProcessServiceHandle(object):
+    """
+        Handle of a service hosted in a worker process.
+        Exposes the same liveness interface as a threading.Thread : a service is alive while
+        its process runs and its heartbeat is fresh. A process whose heartbeat is stale is
+        considered hung and is terminated.
+    """
+
+    def __init__(self, logger, service, mandatory, on_exit=None, rate_limits=None):
+        """
+            :param logger: Logger of the Core
+            :param service: services.conf name of the service
+            :param mandatory: Mandatory flag given to the service constructor
+            :param on_exit: Called without argument as soon as the process exits
+            :param rate_limits: Rate arguments of the service's MqttClient set in services.conf
+        """
+        from broker.rate_limit import get_global_budget
+
+        self.logger = logger
+        self.service = service
+        self.on_exit = on_exit
+        self.heartbeat = process_context.Value('d', time.time())
+        self.process = process_context.Process(
+            target=run_service_process,
+            args=(service, mandatory, self.heartbeat, HEARTBEAT_INTERVAL, rate_limits, get_global_budget()),
+            name=service,
+            daemon=True,
+        )
+
+    def start(self):
+        self.heartbeat.value = time.time()
+        self.process.start()
+        self.logger.i(self.service + " started in process " + str(self.process.pid))
+        if self.on_exit is not None:
+            threading.Thread(target=self.wait_exit, name=self.service + "_waiter", daemon=True).start()
+
+    def wait_exit(self):
+        self.process.join()
+        self.on_exit()
+
+    def is_alive(self):
+        if not self.process.is_alive():
+            return False
+        if time.time() - self.heartbeat.value > HEARTBEAT_TIMEOUT:
+            self.logger.e(self.service + " process heartbeat is stale, terminating it")
+            self.terminate()
+            return False
+        return True
+
+    isAlive = is_alive
+
+    def terminate(self):
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(HEARTBEAT_TIMEOUT)
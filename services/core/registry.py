@@ -0,0 +1,88 @@
+import importlib
+import threading
+import time
+
+# Packages can provide services without being copied in services/ by declaring
+# an entry point in this group : name = "package.module:ServiceClass"
+ENTRY_POINT_GROUP = "microservices.services"
+
+
+def service_entry_points():
+    """
+        Returns the installed service entry points, by name
+    """
+    # importlib.metadata is slow to import, only services missing from services/ need it
+    try:
+        from importlib import metadata
+    except ImportError:
+        return {}
+    entry_points = metadata.entry_points()
+    if hasattr(entry_points, "select"):
+        entry_points = entry_points.select(group=ENTRY_POINT_GROUP)
+    else:
+        entry_points = entry_points.get(ENTRY_POINT_GROUP, [])
+    return dict((entry_point.name, entry_point) for entry_point in entry_points)
+
+
+def load_service_class(service, entry_points=None):
+    """
+        Returns the class of a service from its services.conf name : the service package
+        (ex : "net/abstraction" => services.net.abstraction.abstraction.Abstraction), or an
+        installed entry point of that name
+        :param entry_points: Entry points by name, looked up when the service package doesn't exist
+    """
+    service_name = service.split('/')[-1]
+    module_name = "services." + service.replace("/", ".") + "." + service_name
+    try:
+        module = importlib.import_module(module_name)
+    except ModuleNotFoundError as e:
+        # Only a missing service package falls back to entry points, not a missing dependency of it
+        if e.name is None or not (module_name + ".").startswith(e.name + "."):
+            raise
+        if entry_points is None:
+            entry_points = service_entry_points()
+        if service not in entry_points:
+            raise
+        return entry_points[service].load()
+    return getattr(module, service_name[0].capitalize() + service_name[1:])
+
+
+class ServiceRegistry(object):
+    """
+        Resolves service classes once and caches them, and records startup timings per service.
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.classes = {}
+        self.timings = {}
+        self.lock = threading.Lock()
+
+    def resolve(self, service):
+        """
+            Returns the class of a service, importing it on first call only
+            :param service: services.conf name of the service
+        """
+        service_class = self.classes.get(service)
+        if service_class is not None:
+            return service_class
+
+        start = time.time()
+        service_class = load_service_class(service)
+        self.record(service.split('/')[-1], "import", time.time() - start)
+        self.classes[service] = service_class
+        return service_class
+
+    def record(self, service_name, step, duration):
+        """
+            Record the duration of a startup step (import, construct...) of a service, in seconds
+        """
+        with self.lock:
+            self.timings.setdefault(service_name, {})[step] = duration
+
+    def report(self):
+        """
+            Returns the recorded startup timings : service name => step => seconds
+        """
+        with self.lock:
+            return dict((name, dict(steps)) for name, steps in self.timings.items())
@@ -9,6 +9,8 @@ sys.path.append(SRC_ROOT_DIR)
 from config import *
 from services.service_base import ServiceBase
 from broker.mqtt import MqttClient
+from broker.dispatch import topic_handler
+from broker.schema import Command
 
 MAX_RESTART_RETRY = 3
 
@@ -22,16 +24,15 @@ class Example(MqttClient, ServiceBase):
             self.logger,
             MQTT_HOST,
             MQTT_PORT,
-            ["test/test_topic"],
+            [],
             loop_start=True,
         )
         self.logger.d("__init__")
 
-    def parse_mqtt(self, parsed_json, topic):
-        # Call base class parser
-        MqttClient.parse_mqtt(self,parsed_json, topic)
-        self.logger.d("Received command : " + self.command)
-        self.logger.d("Received data : " + self.data)
+    @topic_handler("test/test_topic", schema=Command)
+    def on_test_topic(self, message, topic):
+        self.logger.d("Received command : %s", message.command)
+        self.logger.d("Received data : %s", message.data)
 
     def run(self):
         # Do stuff
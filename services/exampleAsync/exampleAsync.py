@@ -0,0 +1,31 @@
+import log
+import sys
+import asyncio
+
+SRC_ROOT_DIR = "../../"
+sys.path.append(SRC_ROOT_DIR)
+
+from config import *
+from services.service_base import AsyncServiceBase
+from broker.mqtt_async import AsyncMqttClient
+
+
+class ExampleAsync(AsyncMqttClient, AsyncServiceBase):
+
+    def __init__(self, mandatory):
+
+        AsyncServiceBase.__init__(self, mandatory)
+        AsyncMqttClient.__init__(
+            self,
+            self.logger,
+            MQTT_HOST,
+            MQTT_PORT,
+            [],
+        )
+        self.logger.d("__init__")
+
+    async def run(self):
+        # Do stuff
+        async for msg in self.messages("test/test_topic_async"):
+            self.logger.d("Received command : %s", msg.payload.get("command"))
+            await self.publish_mqtt(None, msg.payload.get("data"), "test/test_topic_async/answer", qos=1)
@@ -26,3 +26,25 @@ class ServiceBase(object):
     def run(self):
         pass
 
+
+
+class AsyncServiceBase(ServiceBase):
+    """
+        asyncio flavour of ServiceBase.
+        run() is a coroutine and every async service of the Core shares the
+        same event loop, in a single thread.
+    """
+
+    async def main(self):
+        """
+            Entry point scheduled by the Core : connect to the broker if the
+            service is an AsyncMqttClient, then run.
+        """
+        connect_mqtt = getattr(self, "connect_mqtt", None)
+        if connect_mqtt is not None:
+            await connect_mqtt()
+        await self.run()
+
+    @abstractmethod
+    async def run(self):
+        pass
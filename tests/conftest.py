@@ -0,0 +1,103 @@
+import os
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from broker.mqtt import MqttClient
+from metrics import metrics
+
+
+class RecordingLogger(object):
+    """
+    Logger keeping its messages, so that tests don't write the log file
+    """
+
+    def __init__(self):
+        self.messages = []
+
+    def record(self, level, message, *args):
+        self.messages.append((level, message % args if args else message))
+
+    def v(self, message, *args):
+        self.record("v", message, *args)
+
+    def d(self, message, *args):
+        self.record("d", message, *args)
+
+    def i(self, message, *args):
+        self.record("i", message, *args)
+
+    def w(self, message, *args):
+        self.record("w", message, *args)
+
+    def e(self, message, *args):
+        self.record("e", message, *args)
+
+
+@pytest.fixture
+def logger():
+    return RecordingLogger()
+
+
+@pytest.fixture
+def broker():
+    """
+    Port of a stand-in broker (benchmarks/stub_broker.py) running for the test
+    """
+    from benchmarks.stub_broker import StubBroker
+    stub = StubBroker()
+    port = stub.start()
+    yield port
+    stub.stop()
+
+
+def counter(key):
+    """
+    Value of a counter of the process metrics
+    """
+    return metrics.collect()[0].get(key, 0)
+
+
+def free_port():
+    """
+    Port nothing listens on, to start a broker on later
+    """
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_until(condition, timeout=5):
+    """
+    Wait for condition() to be true, messages being handled by other threads
+    :return: False on timeout
+    """
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class Receiver(MqttClient):
+    """
+    Client keeping the messages given to parse_mqtt
+    """
+
+    def __init__(self, logger, port, topic_list, **kwargs):
+        self.received = []
+        self.received_event = threading.Event()
+        MqttClient.__init__(self, logger, "127.0.0.1", port, topic_list, loop_start=True, **kwargs)
+        assert self.subscribed_event.wait(5)
+
+    def parse_mqtt(self, parsed_json, topic):
+        self.received.append((topic, parsed_json))
+        self.received_event.set()
@@ -0,0 +1,73 @@
+import time
+
+from benchmarks.stub_broker import StubBroker
+from broker.batching import BatchPublisher, make_batch, unpack_batch
+from broker.codecs import CodecTable
+from broker.mqtt import MqttClient
+from conftest import Receiver, wait_until
+
+
+def test_batches_are_only_envelopes_made_by_make_batch():
+    messages = [{"a": 1}, {"a": 2}]
+    table = CodecTable()
+    assert unpack_batch(table.decode(table.encode("a/b", make_batch(messages)))) == messages
+    assert unpack_batch({"batch": messages}) is None
+    assert unpack_batch(messages) is None
+
+
+def test_full_topic_is_published_at_once(logger):
+    sent = []
+    publisher = BatchPublisher(logger, lambda topic, obj: sent.append((topic, obj)), window=60, max_count=3)
+    try:
+        for value in range(4):
+            publisher.add("batch/a", value)
+        assert sent == [("batch/a", make_batch([0, 1, 2]))]
+        assert publisher.stats()["waiting"] == 1
+    finally:
+        publisher.stop()
+    # Waiting messages are published on stop, a single message without envelope
+    assert sent[1:] == [("batch/a", 3)]
+
+
+def test_window_publishes_waiting_messages(logger):
+    sent = []
+    publisher = BatchPublisher(logger, lambda topic, obj: sent.append((topic, obj)), window=0.05)
+    try:
+        start = time.time()
+        publisher.add("batch/a", 1)
+        publisher.add("batch/b", 2)
+        publisher.add("batch/a", 3)
+        assert wait_until(lambda: len(sent) == 2)
+        assert time.time() - start >= 0.04
+        assert sorted(sent) == [("batch/a", make_batch([1, 3])), ("batch/b", 2)]
+    finally:
+        publisher.stop()
+
+
+def test_coalesced_topics_only_publish_latest_message(logger):
+    sent = []
+    publisher = BatchPublisher(logger, lambda topic, obj: sent.append((topic, obj)), window=60,
+                               coalesce_topics=["state/#"])
+    for value in range(3):
+        publisher.add("state/a", value)
+    publisher.stop()
+    assert sent == [("state/a", 2)]
+    assert publisher.stats()["messages_coalesced"] == 2
+
+
+def test_handlers_receive_batched_messages_one_at_a_time(logger):
+    stub = StubBroker()
+    port = stub.start()
+    receiver = Receiver(logger, port, ["batched/in"])
+    sender = MqttClient(logger, "127.0.0.1", port, [], loop_start=True, batch_window=60)
+    try:
+        for value in range(3):
+            sender.publish_mqtt_batched(None, value, "batched/in")
+        sender.flush_batches()
+        assert wait_until(lambda: len(receiver.received) == 3)
+        assert [parsed_json["payload"] for topic, parsed_json in receiver.received] == [0, 1, 2]
+        assert stub.stats()["received"] == 1
+    finally:
+        sender.disconnect_mqtt()
+        receiver.disconnect_mqtt()
+        stub.stop()
@@ -0,0 +1,43 @@
+import pytest
+
+from broker.codecs import CodecTable, JsonCodec, codecs, get_codec, MARKER_MSGPACK, MARKER_CBOR
+
+MESSAGE = {"id": 1, "payload": {"text": "é", "values": [1, 2.5, None, True]}}
+
+
+@pytest.mark.parametrize("name", sorted(codecs))
+def test_round_trip(name):
+    table = CodecTable(name)
+    assert table.decode(table.encode("a/b", MESSAGE)) == MESSAGE
+
+
+def test_json_payloads_have_no_marker():
+    payload = CodecTable().encode("a/b", MESSAGE)
+    assert payload[0] not in (MARKER_MSGPACK, MARKER_CBOR)
+    assert JsonCodec().decode(payload) == MESSAGE
+
+
+def test_topic_codecs_override_default():
+    class Marked(object):
+        name = "marked"
+        marker = None
+
+        def encode(self, obj):
+            return b"marked"
+
+        def decode(self, payload):
+            return payload
+
+    codecs["marked"] = Marked()
+    try:
+        table = CodecTable("json", {"binary/#": "marked"})
+        assert table.encode("binary/x", MESSAGE) == b"marked"
+        assert table.encode("text/x", MESSAGE) == CodecTable().encode("text/x", MESSAGE)
+    finally:
+        del codecs["marked"]
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        get_codec("unknown")
+
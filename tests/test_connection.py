@@ -0,0 +1,56 @@
+from benchmarks.stub_broker import StubBroker
+from broker.connection import parse_brokers, LINK_UP, LINK_DEGRADED, LINK_DOWN
+from broker.mqtt import MqttClient
+from conftest import Receiver, free_port, wait_until
+
+
+class LinkRecorder(Receiver):
+
+    def __init__(self, logger, port, topic_list, **kwargs):
+        self.link_states = []
+        Receiver.__init__(self, logger, port, topic_list, **kwargs)
+
+    def on_link_state(self, state, broker):
+        self.link_states.append((state, broker[1]))
+
+
+def test_parse_brokers():
+    assert parse_brokers("a:1883, b:1884") == [("a", 1883), ("b", 1884)]
+    assert parse_brokers(["a", ("b", "1884")]) == [("a", 1883), ("b", 1884)]
+    assert parse_brokers("") == []
+
+
+def test_failover_to_next_broker_and_back(logger):
+    first_port = free_port()
+    second = StubBroker()
+    second_port = second.start()
+    first = StubBroker(first_port)
+    client = LinkRecorder(logger, first_port, ["failover/in"],
+                          brokers="127.0.0.1:%d,127.0.0.1:%d" % (first_port, second_port))
+    senders = []
+    stopped = []
+    try:
+        assert client.link_states == [(LINK_DEGRADED, second_port)]
+        senders.append(MqttClient(logger, "127.0.0.1", second_port, [], loop_start=True))
+        senders[-1].publish_json_mqtt({"value": 1}, "failover/in")
+        assert wait_until(lambda: len(client.received) == 1)
+
+        # The first broker is tried again once the second one is lost, subscriptions are sent again
+        first.start()
+        second.stop()
+        stopped.append(second)
+        assert wait_until(lambda: client.link_states[-1] == (LINK_UP, first_port), 10)
+        assert (LINK_DOWN, second_port) in client.link_states
+        assert wait_until(lambda: first.routes.match("failover/in"))
+        senders.append(MqttClient(logger, "127.0.0.1", first_port, [], loop_start=True))
+        senders[-1].publish_json_mqtt({"value": 2}, "failover/in")
+        assert wait_until(lambda: len(client.received) == 2)
+        assert [parsed_json["value"] for topic, parsed_json in client.received] == [1, 2]
+        assert client.connection_manager.stats()["reconnects"] == 1
+    finally:
+        for sender in senders:
+            sender.disconnect_mqtt()
+        client.disconnect_mqtt()
+        first.stop()
+        if not stopped:
+            second.stop()
@@ -0,0 +1,101 @@
+import threading
+
+import pytest
+
+from broker.inbound_queue import InboundQueue, OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST
+from broker.mqtt import MqttClient
+from conftest import Receiver, wait_until
+
+
+class BlockedHandler(object):
+    """
+    Handler waiting for release() on its first item, so that the next items stay queued
+    """
+
+    def __init__(self):
+        self.items = []
+        self.started = threading.Event()
+        self.released = threading.Event()
+
+    def __call__(self, item):
+        self.started.set()
+        self.released.wait(5)
+        self.items.append(item)
+
+    def release(self):
+        self.released.set()
+
+
+@pytest.mark.parametrize("policy, queued, handled", [
+    (OVERFLOW_DROP_OLDEST, [True, True, True, True], [0, 3, 4]),
+    (OVERFLOW_DROP_NEWEST, [True, True, False, False], [0, 1, 2]),
+])
+def test_full_queue_drops_as_policy(logger, policy, queued, handled):
+    handler = BlockedHandler()
+    queue = InboundQueue(logger, handler, 2, policy=policy)
+    try:
+        queue.put(0)
+        assert handler.started.wait(5)
+        assert [queue.put(item) for item in range(1, 5)] == queued
+        handler.release()
+        assert wait_until(lambda: len(handler.items) == 3)
+        assert handler.items == handled
+        assert queue.stats()["dropped"] == 2
+    finally:
+        queue.stop()
+
+
+def test_full_queue_blocks_network_thread(logger):
+    handler = BlockedHandler()
+    queue = InboundQueue(logger, handler, 1, policy=OVERFLOW_BLOCK)
+    try:
+        queue.put(0)
+        assert handler.started.wait(5)
+        queue.put(1)
+        putter = threading.Thread(target=queue.put, args=(2,))
+        putter.start()
+        putter.join(0.2)
+        assert putter.is_alive()
+        handler.release()
+        putter.join(5)
+        assert wait_until(lambda: handler.items == [0, 1, 2])
+        assert queue.stats()["blocked"] == 1
+    finally:
+        queue.stop()
+
+
+def test_handler_errors_dont_stop_workers(logger):
+    handled = []
+
+    def handler(item):
+        if item == "fail":
+            raise ValueError("handler failure")
+        handled.append(item)
+
+    queue = InboundQueue(logger, handler, 10)
+    try:
+        queue.put("fail")
+        queue.put("next")
+        assert wait_until(lambda: handled == ["next"])
+        assert any(level == "e" and "handler failure" in message for level, message in logger.messages)
+    finally:
+        queue.stop()
+
+
+class ThreadRecorder(Receiver):
+
+    def parse_mqtt(self, parsed_json, topic):
+        Receiver.parse_mqtt(self, threading.current_thread().name, topic)
+
+
+def test_messages_are_handled_by_workers(logger, broker):
+    receiver = ThreadRecorder(logger, broker, ["queued/in"], inbound_queue_size=10, inbound_workers=2)
+    sender = MqttClient(logger, "127.0.0.1", broker, [], loop_start=True)
+    try:
+        sender.publish_json_mqtt({"value": 1}, "queued/in")
+        assert wait_until(lambda: receiver.received)
+        assert receiver.received[0][1].startswith("inbound_")
+        assert receiver.inbound_queue.stats()["workers"] == 2
+    finally:
+        sender.disconnect_mqtt()
+        receiver.disconnect_mqtt()
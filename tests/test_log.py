@@ -0,0 +1,104 @@
+import threading
+
+import log
+from log import LogWriter
+
+
+def record(msg):
+    # Neither console nor file
+    return (0.0, "test", "INFO", msg, False, False)
+
+
+def test_log_writer_drops_records_when_full():
+    writer = LogWriter(maxsize=2, batch_size=10)
+    batches = []
+    writing = threading.Event()
+    released = threading.Event()
+
+    def write_batch(batch):
+        writing.set()
+        released.wait(5)
+        batches.append([msg for timestamp, ident, level, msg, to_console, to_file in batch])
+
+    writer.write_batch = write_batch
+    try:
+        writer.put(record("first"))
+        assert writing.wait(5)
+        assert [writer.put(record(msg)) for msg in ("second", "third", "fourth")] == [True, True, False]
+        released.set()
+        assert writer.flush(5)
+        assert batches == [["first"], ["second", "third", "1 log records dropped, buffer is full"]]
+        assert writer.stats() == {"queued": 0, "written": 4, "dropped": 1}
+    finally:
+        released.set()
+        writer.stop()
+
+
+def test_log_writer_writes_remaining_records_on_stop():
+    writer = LogWriter()
+    written = []
+    writer.write_batch = lambda batch: written.extend(msg for timestamp, ident, level, msg, c, f in batch)
+    for index in range(100):
+        writer.put(record(str(index)))
+    writer.stop()
+    assert written == [str(index) for index in range(100)]
+
+
+def test_messages_are_formatted_only_above_the_level(monkeypatch):
+    monkeypatch.setattr(log, "CURRENT_LEVEL", log.LEVEL_INFO)
+    logger = log.Logger("LazyTest")
+    logger.log_to_console = False
+    built = []
+
+    def message():
+        built.append(True)
+        return "built"
+
+    written = []
+    monkeypatch.setattr(logger, "write", lambda msg, args, level: written.append(log.format_message(msg, args)))
+    logger.d(message)
+    logger.v("%s", object())
+    assert built == [] and written == []
+    logger.i(message)
+    logger.i("%s=%d", "count", 3)
+    assert written == ["built", "count=3"]
+
+
+def test_warnings_are_kept_even_below_the_level(monkeypatch):
+    monkeypatch.setattr(log, "CURRENT_LEVEL", log.LEVEL_ERROR)
+    logger = log.Logger("WarningTest")
+    logger.w("%s is %s", "broker", "down")
+    assert [message.msg for message in log.get_log_messages(tag="WarningTest")] == ["broker is down"]
+
+
+def test_wrong_arguments_are_still_logged():
+    assert log.format_message("value %d", ("text",)) == "value %d text"
+    assert log.format_message("%s", ()) == "%s"
+
+
+def test_ring_buffer_keeps_the_latest_records():
+    buffer = log.LogRingBuffer(3)
+    for index in range(5):
+        buffer.append(log.LEVEL_WARNING, "test", str(index), 100.0 + index)
+    assert len(buffer) == 3
+    assert [message.msg for message in buffer] == ["2", "3", "4"]
+    assert buffer[0].msg == "2" and buffer[-1].msg == "4"
+    # Indexes forget evicted records
+    assert list(buffer.level_index[log.LEVEL_WARNING]) == [2, 3, 4]
+
+
+def test_ring_buffer_queries():
+    buffer = log.LogRingBuffer(10)
+    for index in range(8):
+        level = log.LEVEL_ERROR if index % 2 else log.LEVEL_WARNING
+        buffer.append(level, "odd" if index % 2 else "even", str(index), 100.0 + index)
+
+    def query(**filters):
+        return [message.msg for message in buffer.query(**filters)]
+
+    assert query(level=log.LEVEL_ERROR) == ["1", "3", "5", "7"]
+    assert query(tag="even", since=103.0) == ["4", "6"]
+    assert query(since=102.0, until=104.0) == ["2", "3", "4"]
+    assert query(level=log.LEVEL_WARNING, limit=2) == ["4", "6"]
+    buffer.clear()
+    assert query() == []
@@ -0,0 +1,71 @@
+from broker.loopback import loopback_bus, LOOPBACK_KEY
+from broker.mqtt import MqttClient
+from conftest import Receiver, wait_until
+
+
+def test_loopback_key_of_payloads_is_not_removed(logger, broker):
+    receiver = Receiver(logger, broker, ["payload/in"])
+    local = Receiver(logger, broker, ["payload/in"], loopback="decode")
+    sender = MqttClient(logger, "127.0.0.1", broker, [], loop_start=True)
+    try:
+        sender.publish_json_mqtt({"loopback": True, "batch": [1]}, "payload/in")
+        assert wait_until(lambda: receiver.received and local.received)
+        assert receiver.received == [("payload/in", {"loopback": True, "batch": [1]})]
+        assert local.received == [("payload/in", {"loopback": True, "batch": [1]})]
+    finally:
+        sender.disconnect_mqtt()
+        local.disconnect_mqtt()
+        receiver.disconnect_mqtt()
+
+
+def test_local_subscriber_gets_message_once(logger, broker):
+    local = Receiver(logger, broker, ["local/in"], loopback="decode")
+    outside = Receiver(logger, broker, ["local/in"])
+    publisher = MqttClient(logger, "127.0.0.1", broker, [], loop_start=True, loopback="share")
+    echoes = loopback_bus.echoes
+    try:
+        publisher.publish_json_mqtt({"value": 1}, "local/in")
+        # Copy sent back by the broker to the local subscriber
+        assert wait_until(lambda: loopback_bus.echoes == echoes + 1)
+        assert local.received == [("local/in", {"value": 1})]
+        assert wait_until(lambda: outside.received)
+        # Subscribers without loopback see the reserved key
+        topic, parsed_json = outside.received[0]
+        assert parsed_json["value"] == 1 and loopback_bus.owns(parsed_json[LOOPBACK_KEY])
+    finally:
+        publisher.disconnect_mqtt()
+        outside.disconnect_mqtt()
+        local.disconnect_mqtt()
+
+
+def test_messages_over_rate_limit_are_not_delivered_locally(logger, broker):
+    local = Receiver(logger, broker, ["limited/in"], loopback="decode")
+    outside = Receiver(logger, broker, ["limited/in"])
+    publisher = MqttClient(logger, "127.0.0.1", broker, [], loop_start=True, loopback="decode",
+                           rate_limit=1, rate_burst=1, rate_policy="drop")
+    echoes = loopback_bus.echoes
+    try:
+        for value in range(3):
+            publisher.publish_json_mqtt({"value": value}, "limited/in")
+        assert wait_until(lambda: loopback_bus.echoes == echoes + 1)
+        assert wait_until(lambda: outside.received)
+        assert local.received == [("limited/in", {"value": 0})]
+        assert [parsed_json["value"] for topic, parsed_json in outside.received] == [0]
+    finally:
+        publisher.disconnect_mqtt()
+        outside.disconnect_mqtt()
+        local.disconnect_mqtt()
+
+
+def test_coalesced_message_reaches_local_subscriber_through_broker(logger, broker):
+    local = Receiver(logger, broker, ["coalesced/in"], loopback="decode")
+    publisher = MqttClient(logger, "127.0.0.1", broker, [], loop_start=True, loopback="decode",
+                           rate_limit=10, rate_burst=1, rate_policy="coalesce")
+    try:
+        for value in range(3):
+            publisher.publish_json_mqtt({"value": value}, "coalesced/in")
+        assert wait_until(lambda: len(local.received) == 2)
+        assert [parsed_json for topic, parsed_json in local.received] == [{"value": 0}, {"value": 2}]
+    finally:
+        publisher.disconnect_mqtt()
+        local.disconnect_mqtt()
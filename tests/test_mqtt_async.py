@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+
+from benchmarks.stub_broker import StubBroker
+from broker.mqtt_async import AsyncMqttClient
+from broker.rate_limit import TokenBucket, configure_service, parse_rate_options, set_global_budget
+
+
+async def wait_disconnected(client, timeout=5):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while client.watched_fd is not None:
+        assert asyncio.get_running_loop().time() < deadline
+        await asyncio.sleep(0.01)
+
+
+def test_publish_fails_instead_of_hanging_while_disconnected(logger):
+    async def scenario():
+        broker = StubBroker()
+        client = AsyncMqttClient(logger, "127.0.0.1", broker.start(), [])
+        await client.connect_mqtt()
+        assert await asyncio.wait_for(client.publish_json_mqtt({"value": 1}, "async/out"), 5)
+        broker.stop()
+        await wait_disconnected(client)
+        with pytest.raises(ConnectionError):
+            await asyncio.wait_for(client.publish_json_mqtt({"value": 2}, "async/out"), 5)
+        # Kept by paho until the reconnection, failed when the client is closed
+        pending = client.publish("async/out", b"3", qos=1)
+        client.close()
+        with pytest.raises(ConnectionError):
+            await asyncio.wait_for(pending, 5)
+
+    asyncio.run(scenario())
+
+
+def test_qos1_publish_completes_after_reconnection(logger):
+    async def scenario():
+        broker = StubBroker()
+        port = broker.start()
+        client = AsyncMqttClient(logger, "127.0.0.1", port, [])
+        await client.connect_mqtt()
+        broker.stop()
+        await wait_disconnected(client)
+        pending = client.publish("async/out", b"1", qos=1)
+        broker = StubBroker(port)
+        broker.start()
+        try:
+            assert await asyncio.wait_for(pending, 10)
+        finally:
+            client.close()
+            broker.stop()
+
+    asyncio.run(scenario())
+
+
+class LimitedClient(AsyncMqttClient):
+    pass
+
+
+def test_publishes_follow_rate_limits(logger, broker):
+    async def scenario():
+        client = AsyncMqttClient(logger, "127.0.0.1", broker, [], rate_limit=20, rate_burst=1, rate_policy="drop",
+                                 topic_rate_limits={"blocked/#": (20, 1, "block")})
+        await client.connect_mqtt()
+        try:
+            results = [await client.publish_json_mqtt({"value": value}, "dropped/out") for value in range(3)]
+            assert results[0] is not None and results[1:] == [None, None]
+            start = asyncio.get_running_loop().time()
+            results = await asyncio.gather(*[client.publish_json_mqtt({"value": value}, "blocked/out")
+                                             for value in range(3)])
+            assert None not in results
+            assert asyncio.get_running_loop().time() - start >= 0.09
+            assert client.rate_stats()["service"]["dropped"] == 2
+        finally:
+            client.close()
+
+    asyncio.run(scenario())
+
+
+def test_services_conf_limits_and_global_budget_apply(logger, broker):
+    configure_service("LimitedClient", parse_rate_options({"rate": "1", "rate_policy": "drop"}))
+    set_global_budget(TokenBucket(1000))
+    try:
+        client = LimitedClient(logger, "127.0.0.1", broker, [], rate_limit=0)
+        assert set(client.rate_stats()) == {"pending", "service", "global"}
+        assert client.rate_stats()["service"]["policy"] == "drop"
+    finally:
+        configure_service("LimitedClient", None)
+        set_global_budget(None)
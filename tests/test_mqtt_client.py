@@ -0,0 +1,40 @@
+from broker.mqtt import MqttClient
+from conftest import Receiver, counter, wait_until
+
+
+class FailingReceiver(Receiver):
+
+    def parse_mqtt(self, parsed_json, topic):
+        Receiver.parse_mqtt(self, parsed_json, topic)
+        if parsed_json.get("fail"):
+            raise ValueError("parse_mqtt failure")
+
+
+def test_undecodable_payload_is_rejected_and_network_thread_goes_on(logger, broker):
+    receiver = Receiver(logger, broker, ["garbage/in"])
+    sender = MqttClient(logger, "127.0.0.1", broker, [], loop_start=True)
+    try:
+        sender.clientMqtt.publish("garbage/in", b"not json")
+        sender.publish_json_mqtt({"after": 1}, "garbage/in")
+        assert receiver.received_event.wait(5)
+        assert receiver.received == [("garbage/in", {"after": 1})]
+        assert counter(receiver.metric_keys["rejected"]) == 1
+        assert any(level == "w" and "garbage/in" in message for level, message in logger.messages)
+    finally:
+        sender.disconnect_mqtt()
+        receiver.disconnect_mqtt()
+
+
+def test_parse_mqtt_exception_is_logged_and_network_thread_goes_on(logger, broker):
+    receiver = FailingReceiver(logger, broker, ["failing/in"])
+    sender = MqttClient(logger, "127.0.0.1", broker, [], loop_start=True)
+    try:
+        sender.publish_json_mqtt({"fail": True}, "failing/in")
+        sender.publish_json_mqtt({"fail": False}, "failing/in")
+        assert wait_until(lambda: len(receiver.received) == 2)
+        assert [parsed_json["fail"] for topic, parsed_json in receiver.received] == [True, False]
+        assert counter(receiver.metric_keys["errors"]) == 1
+        assert any(level == "e" and "parse_mqtt failure" in message for level, message in logger.messages)
+    finally:
+        sender.disconnect_mqtt()
+        receiver.disconnect_mqtt()
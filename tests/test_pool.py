@@ -0,0 +1,61 @@
+import pytest
+
+from benchmarks.stub_broker import StubBroker
+from broker.mqtt import MqttClient
+from broker.pool import MqttConnectionPool
+from conftest import Receiver, free_port, wait_until
+
+
+def values(receiver):
+    return [parsed_json["value"] for topic, parsed_json in receiver.received]
+
+
+def test_clients_share_one_connection(logger):
+    stub = StubBroker()
+    port = stub.start()
+    pool = MqttConnectionPool("127.0.0.1", port, 1)
+    pool.logger = logger
+    first = Receiver(logger, port, ["pool/#"], pool=pool)
+    # Overlapping filters, messages are received once
+    second = Receiver(logger, port, ["pool/a", "pool/#"], pool=pool)
+    sender = MqttClient(logger, "127.0.0.1", port, [], loop_start=True)
+    try:
+        assert stub.stats()["clients"] == 2
+        sender.publish_json_mqtt({"value": 1}, "pool/a")
+        sender.publish_json_mqtt({"value": 2}, "pool/b")
+        assert wait_until(lambda: len(first.received) == 2 and len(second.received) == 2)
+        assert values(first) == values(second) == [1, 2]
+
+        second.disconnect_mqtt()
+        sender.publish_json_mqtt({"value": 3}, "pool/a")
+        assert wait_until(lambda: len(first.received) == 3)
+        assert values(second) == [1, 2]
+    finally:
+        sender.disconnect_mqtt()
+        first.disconnect_mqtt()
+        pool.close()
+        stub.stop()
+
+
+def test_pool_with_spool_starts_without_broker(logger, tmpdir):
+    port = free_port()
+    pool = MqttConnectionPool("127.0.0.1", port, 1)
+    pool.logger = logger
+    client = MqttClient(logger, "127.0.0.1", port, [], loop_start=True, pool=pool, spool_dir=str(tmpdir))
+    stub = StubBroker(port)
+    try:
+        client.publish_json_mqtt({"value": 1}, "pool/spooled")
+        assert len(client.spool) == 1
+        stub.start()
+        assert wait_until(lambda: stub.stats()["received"] == 1, 10)
+        assert len(client.spool) == 0
+    finally:
+        client.disconnect_mqtt()
+        pool.close()
+        stub.stop()
+
+
+def test_pool_and_failover_are_exclusive(logger, broker):
+    pool = MqttConnectionPool("127.0.0.1", broker, 1)
+    with pytest.raises(ValueError):
+        MqttClient(logger, "127.0.0.1", broker, [], pool=pool, brokers="127.0.0.1:%d" % broker)
@@ -0,0 +1,101 @@
+import threading
+import time
+
+import pytest
+
+from broker.rate_limit import (TokenBucket, RateLimiter, parse_rate_options, RATE_DROP, RATE_COALESCE,
+                               RATE_BLOCK)
+
+
+def test_bucket_allows_burst_then_rate():
+    bucket = TokenBucket(10, burst=3, state=[3.0, 100.0])
+    assert [bucket.take(100.0) for _ in range(3)] == [0, 0, 0]
+    assert bucket.take(100.0) == pytest.approx(0.1)
+    # One token every 0.1 s
+    assert bucket.take(100.125) == 0
+    assert bucket.take(100.125) > 0
+
+
+def test_bucket_is_capped_at_burst():
+    bucket = TokenBucket(10, burst=2, state=[0.0, 0.0])
+    assert bucket.take(1000.0) == 0
+    assert bucket.take(1000.0) == 0
+    assert bucket.take(1000.0) > 0
+
+
+def test_refund():
+    bucket = TokenBucket(1, burst=1, state=[1.0, 10.0])
+    assert bucket.take(10.0) == 0
+    bucket.refund()
+    assert bucket.take(10.0) == 0
+
+
+def test_invalid_rate():
+    with pytest.raises(ValueError):
+        TokenBucket(0)
+
+
+def test_parse_rate_options():
+    limits = parse_rate_options({"rate": "50", "burst": "5", "rate_policy": "drop",
+                                 "topic_rate": "telemetry/#:10:coalesce|logs/#:2"})
+    assert limits == {"rate_limit": 50.0, "rate_burst": 5.0, "rate_policy": "drop",
+                      "topic_rate_limits": {"telemetry/#": (10.0, None, "coalesce"), "logs/#": (2.0, None, None)}}
+    with pytest.raises(ValueError):
+        parse_rate_options({"rate_policy": "queue"})
+    with pytest.raises(ValueError):
+        parse_rate_options({"topic_rate": "telemetry/#"})
+
+
+def test_drop_policy(logger):
+    limiter = RateLimiter(logger, None, "test", rate=1, burst=2, policy=RATE_DROP)
+    assert [limiter.acquire("a", b"") for _ in range(4)] == [True, True, False, False]
+    assert limiter.stats()["service"]["dropped"] == 2
+    limiter.stop()
+
+
+def test_topic_limits_only_apply_to_matching_topics(logger):
+    limiter = RateLimiter(logger, None, "test", topic_limits={"logs/#": (1, 1, RATE_DROP)})
+    assert limiter.acquire("logs/a", b"")
+    assert not limiter.acquire("logs/b", b"")
+    assert all(limiter.acquire("other", b"") for _ in range(10))
+    limiter.stop()
+
+
+def test_refused_publish_doesnt_take_other_tokens(logger):
+    limiter = RateLimiter(logger, None, "test", rate=1, burst=1, policy=RATE_DROP,
+                          topic_limits={"a": (1, 5, RATE_DROP)})
+    assert limiter.acquire("a", b"")
+    assert not limiter.acquire("a", b"")
+    # The token of "a" taken by the refused publish was given back
+    assert limiter.limits_of("a")[0][1].state[0] == pytest.approx(4, abs=0.01)
+    limiter.stop()
+
+
+def test_block_policy_waits_for_tokens(logger):
+    limiter = RateLimiter(logger, None, "test", rate=50, burst=5, policy=RATE_BLOCK)
+    start = time.time()
+    for _ in range(15):
+        assert limiter.acquire("a", b"")
+    assert time.time() - start >= 0.15
+    assert limiter.stats()["service"]["limited"] > 0
+    limiter.stop()
+
+
+def test_coalesce_policy_sends_latest_message_in_order(logger):
+    sent = []
+    done = threading.Event()
+
+    def send(topic, payload, qos, retain):
+        sent.append((topic, payload))
+        if payload == b"last":
+            done.set()
+
+    limiter = RateLimiter(logger, send, "test", rate=20, burst=1, policy=RATE_COALESCE)
+    assert limiter.acquire("a", b"first")
+    assert not limiter.acquire("a", b"second")
+    assert not limiter.acquire("a", b"third")
+    assert not limiter.acquire("a", b"last")
+    assert done.wait(2)
+    assert sent == [("a", b"last")]
+    assert limiter.stats()["service"]["coalesced"] == 2
+    limiter.stop()
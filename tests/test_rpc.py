@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+
+from broker.mqtt import MqttClient
+from broker.mqtt_async import AsyncMqttClient
+from broker.rpc import rpc_handler, RpcError, RpcTimeout
+
+
+class Calculator(MqttClient):
+
+    def __init__(self, logger, port):
+        MqttClient.__init__(self, logger, "127.0.0.1", port, [], loop_start=True)
+        assert self.subscribed_event.wait(5)
+
+    @rpc_handler("calculator/add")
+    def add(self, payload, topic):
+        return payload["a"] + payload["b"]
+
+    @rpc_handler("calculator/divide")
+    def divide(self, payload, topic):
+        return payload["a"] / payload["b"]
+
+
+@pytest.fixture
+def calculator(logger, broker):
+    calculator = Calculator(logger, broker)
+    yield calculator
+    calculator.disconnect_mqtt()
+
+
+def test_call_returns_reply_or_raises_remote_error(logger, broker, calculator):
+    client = MqttClient(logger, "127.0.0.1", broker, [], loop_start=True)
+    try:
+        assert client.call("calculator/add", {"a": 1, "b": 2}, timeout=5) == 3
+        futures = [client.call_async("calculator/add", {"a": value, "b": 1}, timeout=5) for value in range(5)]
+        assert [future.result() for future in futures] == [1, 2, 3, 4, 5]
+        with pytest.raises(RpcError, match="division by zero"):
+            client.call("calculator/divide", {"a": 1, "b": 0}, timeout=5)
+    finally:
+        client.disconnect_mqtt()
+
+
+def test_call_without_answer_times_out(logger, broker):
+    client = MqttClient(logger, "127.0.0.1", broker, [], loop_start=True)
+    try:
+        with pytest.raises(RpcTimeout):
+            client.call("calculator/nobody", {}, timeout=0.2)
+        assert client.rpc_calls.calls == {}
+    finally:
+        client.disconnect_mqtt()
+
+
+def test_async_call(logger, broker, calculator):
+    async def scenario():
+        client = AsyncMqttClient(logger, "127.0.0.1", broker, [])
+        await client.connect_mqtt()
+        try:
+            assert await client.call("calculator/add", {"a": 2, "b": 3}, timeout=5) == 5
+            with pytest.raises(RpcTimeout):
+                await client.call("calculator/nobody", {}, timeout=0.2)
+        finally:
+            client.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,85 @@
+import pytest
+
+from broker.schema import Schema, Field, SchemaError, Command
+from broker.dispatch import TopicDispatcher
+
+Sensor = Schema("Sensor", {"id": int, "kind": Field(str, required=False, default="temperature")})
+Reading = Schema("Reading", {
+    "sensor": Sensor,
+    "value": float,
+    "unit": Field(str, nullable=True),
+    "tags": Field(list, items=str, required=False, default=()),
+    "history": Field(list, items=Sensor, required=False),
+    "raw_key": Field(object, required=False, key="raw-key"),
+})
+
+
+def test_load_builds_message():
+    message = Reading.load({"sensor": {"id": 3}, "value": 21, "unit": None, "tags": ["a"], "raw-key": [1]})
+    assert message.sensor.id == 3
+    assert message.sensor.kind == "temperature"
+    # JSON integers are accepted as floats
+    assert message.value == 21
+    assert message.unit is None
+    assert message.tags == ["a"]
+    assert message.history is None
+    assert message.raw_key == [1]
+
+
+def test_dump_is_the_inverse_of_load():
+    payload = {"sensor": {"id": 3, "kind": "humidity"}, "value": 0.5, "unit": "%", "tags": [],
+               "history": [{"id": 1, "kind": "humidity"}], "raw-key": None}
+    assert Reading.load(payload).as_dict() == payload
+
+
+@pytest.mark.parametrize("payload, error", [
+    ([], "Reading : expected an object, got list"),
+    ({"value": 1.0, "unit": "C"}, "Reading.sensor : missing"),
+    ({"sensor": {"id": "3"}, "value": 1.0, "unit": "C"}, "Sensor.id : expected int, got str"),
+    ({"sensor": {"id": 3}, "value": "1", "unit": "C"}, "Reading.value : expected float/int, got str"),
+    ({"sensor": {"id": 3}, "value": 1.0, "unit": 2}, "Reading.unit : expected str, got int"),
+    ({"sensor": {"id": 3}, "value": 1.0, "unit": "C", "tags": [1]}, "Reading.tags : expected items of str, got int"),
+])
+def test_load_rejects_malformed_payloads(payload, error):
+    with pytest.raises(SchemaError) as info:
+        Reading.load(payload)
+    assert str(info.value) == error
+
+
+def test_strict_schema_rejects_unknown_keys():
+    Strict = Schema("Strict", {"a": int}, strict=True)
+    assert Strict.load({"a": 1}).a == 1
+    with pytest.raises(SchemaError):
+        Strict.load({"a": 1, "b": 2})
+
+
+def test_invalid_field_name():
+    with pytest.raises(ValueError):
+        Schema("Invalid", {"class": int})
+
+
+def test_call_builds_checked_message():
+    assert Sensor(id=1) == Sensor.load({"id": 1})
+    with pytest.raises(SchemaError):
+        Sensor(id=1.5)
+
+
+def test_command_schema_of_legacy_messages():
+    message = Command.load({"command": "start"})
+    assert message.command == "start"
+    assert message.data is None
+
+
+def test_dispatcher_rejects_before_handlers_and_loads_once():
+    calls = []
+    rejected = []
+    dispatcher = TopicDispatcher()
+    dispatcher.on_rejected = lambda topic, error: rejected.append(topic)
+    dispatcher.add("sensors/#", lambda message, topic: calls.append(message), Sensor)
+    dispatcher.add("sensors/+", lambda message, topic: calls.append(message), Sensor)
+    dispatcher.dispatch({"id": 4}, "sensors/a")
+    assert len(calls) == 2 and calls[0] is calls[1]
+    dispatcher.dispatch({"id": "4"}, "sensors/a")
+    assert len(calls) == 2
+    assert rejected == ["sensors/a"]
+    assert dispatcher.rejected == 1
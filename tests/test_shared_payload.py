@@ -0,0 +1,144 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from broker.shared_payload import (SharedSegment, SharedBlock, SharedPayloadStore, StalePayload, shared_reader,
+                                   local_segments, is_shared, BLOCK_ALIGN, SHARED_KEY, HOST)
+
+
+@pytest.fixture
+def segment():
+    segment = SharedSegment(None, "test_%d_%d" % (os.getpid(), time.time() * 1e6), 1000)
+    yield segment
+    segment.close()
+
+
+def push(segment, offset, size, consumers=1, deadline=float("inf")):
+    segment.blocks.append(SharedBlock(offset, offset + size, len(segment.blocks), deadline, consumers))
+    segment.head = offset + size
+
+
+def test_ring_allocates_after_newest_block(segment):
+    assert segment.allocate(1000) == 0
+    assert segment.allocate(1001) is None
+    push(segment, 0, 400)
+    assert segment.allocate(600) == 400
+    assert segment.allocate(601) is None
+
+
+def test_ring_wraps_around_before_oldest_block(segment):
+    push(segment, 0, 400)
+    push(segment, 400, 500)
+    segment.blocks[0].consumers = 0
+    assert segment.reclaim(time.time()) == 0
+    # 100 bytes left at the end, 400 at the start
+    assert segment.allocate(200) == 0
+    push(segment, 0, 200)
+    # Between the newest block and the oldest one
+    assert segment.allocate(200) == 200
+    assert segment.allocate(201) is None
+
+
+def test_reclaim_frees_oldest_released_or_expired_blocks(segment):
+    now = time.time()
+    push(segment, 0, 100, consumers=None, deadline=now - 1)
+    push(segment, 100, 100, consumers=0)
+    push(segment, 200, 100, consumers=1, deadline=now + 60)
+    push(segment, 300, 100, consumers=0)
+    assert segment.reclaim(now) == 1
+    # The released block after a block in use stays until it is the oldest
+    assert [block.offset for block in segment.blocks] == [200, 300]
+    assert segment.used() == 200
+    segment.blocks[0].consumers = 0
+    segment.reclaim(now)
+    assert not segment.blocks
+    assert segment.head == 0
+
+
+@pytest.fixture
+def store(logger):
+    store = SharedPayloadStore(logger, segment_size=4096, max_segments=2, lease=60)
+    yield store
+    store.close()
+
+
+def test_payload_is_read_without_copy_and_released(store):
+    data = os.urandom(1000)
+    handle = store.write(data, consumers=1)
+    released = []
+    message = {SHARED_KEY: handle, "meta": {"i": 1}}
+    assert is_shared(message)
+    with shared_reader.open(message, released.append) as payload:
+        assert payload.data.readonly
+        assert payload.data == data
+        assert payload.meta == {"i": 1}
+        assert payload.valid()
+    assert released == [handle]
+    assert store.release(handle["name"], handle["offset"], handle["generation"])
+    assert store.stats()["released"] == 1
+
+
+def test_blocks_are_aligned(store):
+    first = store.write(b"x")
+    second = store.write(b"y")
+    assert second["offset"] - first["offset"] == BLOCK_ALIGN
+
+
+def test_full_store_refuses_payloads(store):
+    # Payloads larger than a segment get a segment of their own
+    assert store.write(b"x" * 5000, consumers=1) is not None
+    assert store.write(b"x" * 4000, consumers=1) is not None
+    assert store.write(b"x" * 100, consumers=1) is None
+    assert store.stats()["full"] == 1
+
+
+def test_reused_block_is_stale(store):
+    handle = store.write(b"first", lease=0)
+    # Lease expired : the block is reused by the next payload
+    store.write(b"second", lease=0)
+    with pytest.raises(StalePayload):
+        shared_reader.open({SHARED_KEY: handle}, lambda handle: None)
+    assert store.stats()["expired"] == 1
+
+
+def test_payload_of_other_host_is_stale(store):
+    handle = dict(store.write(b"data"), host=HOST + ".other")
+    with pytest.raises(StalePayload):
+        shared_reader.open({SHARED_KEY: handle}, lambda handle: None)
+
+
+def test_close_unlinks_segments(store):
+    handle = store.write(b"data")
+    assert handle["name"] in local_segments
+    store.close()
+    assert handle["name"] not in local_segments
+    with pytest.raises(StalePayload):
+        shared_reader.map(handle["name"])
+
+
+def run_python(code):
+    """
+    Run code in a new interpreter from the repository root, returns its output
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return subprocess.check_output([sys.executable, "-c", code], cwd=root).decode().strip()
+
+
+def test_multiprocessing_is_loaded_by_first_segment_only():
+    assert run_python("import sys, broker.mqtt; print('multiprocessing' in sys.modules)") == "False"
+
+
+def test_payload_of_other_process_is_stale_without_posix_shared_memory():
+    assert run_python(
+        "import sys\n"
+        "sys.modules['_posixshmem'] = None\n"
+        "from broker.shared_payload import shared_reader, StalePayload, SHARED_KEY, HOST\n"
+        "handle = {'host': HOST, 'name': 'other', 'offset': 0, 'generation': 1, 'length': 1}\n"
+        "try:\n"
+        "    shared_reader.open({SHARED_KEY: handle}, None)\n"
+        "except StalePayload as e:\n"
+        "    print('stale')\n"
+    ) == "stale"
@@ -0,0 +1,73 @@
+from broker.spool import DiskSpool, SPOOL_DROP_NEWEST, RECORD_HEADER
+
+
+def drain(spool):
+    records = []
+    record = spool.peek()
+    while record is not None:
+        records.append((record[0], bytes(record[1]), record[2], record[3]))
+        spool.commit()
+        record = spool.peek()
+    return records
+
+
+def test_records_are_read_in_order(tmpdir):
+    spool = DiskSpool(str(tmpdir), segment_size=64)
+    for index in range(10):
+        assert spool.append("a/%d" % index, b"payload %d" % index, qos=index % 2, retain=index == 3)
+    assert len(spool) == 10
+    records = drain(spool)
+    assert [topic for topic, payload, qos, retain in records] == ["a/%d" % index for index in range(10)]
+    assert records[3] == ("a/3", b"payload 3", 1, True)
+    assert len(spool) == 0
+    assert spool.stats()["drained"] == 10
+    spool.close()
+
+
+def test_unread_records_are_replayed_after_restart(tmpdir):
+    spool = DiskSpool(str(tmpdir), segment_size=64)
+    for index in range(6):
+        spool.append("a", b"%d" % index)
+    # Read but not committed : published again after the restart
+    spool.peek()
+    spool.commit()
+    spool.peek()
+    spool.close()
+
+    spool = DiskSpool(str(tmpdir), segment_size=64)
+    assert len(spool) == 5
+    assert [payload for topic, payload, qos, retain in drain(spool)] == [b"%d" % index for index in range(1, 6)]
+    spool.close()
+
+    spool = DiskSpool(str(tmpdir), segment_size=64)
+    assert len(spool) == 0
+    assert spool.peek() is None
+    spool.close()
+
+
+def test_drop_oldest_evicts_whole_segments(tmpdir):
+    record_size = RECORD_HEADER.size + len("a") + 10
+    spool = DiskSpool(str(tmpdir), segment_size=2 * record_size, max_bytes=4 * record_size)
+    for index in range(8):
+        assert spool.append("a", b"%010d" % index)
+    assert spool.stats()["dropped"] == 4
+    assert [int(payload) for topic, payload, qos, retain in drain(spool)] == list(range(4, 8))
+    spool.close()
+
+
+def test_drop_newest_refuses_records(tmpdir):
+    record_size = RECORD_HEADER.size + len("a") + 10
+    spool = DiskSpool(str(tmpdir), segment_size=2 * record_size, max_bytes=4 * record_size,
+                      policy=SPOOL_DROP_NEWEST)
+    accepted = [spool.append("a", b"%010d" % index) for index in range(6)]
+    assert accepted == [True] * 4 + [False] * 2
+    assert [int(payload) for topic, payload, qos, retain in drain(spool)] == list(range(4))
+    spool.close()
+
+
+def test_large_record_gets_its_own_segment(tmpdir):
+    spool = DiskSpool(str(tmpdir), segment_size=64)
+    spool.append("a", b"x" * 1000)
+    spool.append("b", b"y")
+    assert [topic for topic, payload, qos, retain in drain(spool)] == ["a", "b"]
+    spool.close()
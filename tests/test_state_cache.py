@@ -0,0 +1,110 @@
+import copy
+
+import pytest
+
+from broker.state_cache import StateCache, StateView, diff, apply_patch, equal
+
+STATES = [
+    {"on": True, "level": 3, "zones": {"a/b": 1, "c~d": 2}, "tags": ["x"]},
+    {"on": False, "level": 3, "zones": {"a/b": 1}, "tags": ["x", "y"], "mode": "eco"},
+    {"on": False, "level": 3.0, "zones": {}, "tags": [], "mode": None},
+    [1, 2],
+    {"nested": {"deep": {"value": 1}}},
+]
+
+
+@pytest.mark.parametrize("old, new", [(a, b) for a in STATES for b in STATES])
+def test_patch_turns_old_into_new(old, new):
+    patched = apply_patch(copy.deepcopy(old), diff(old, new))
+    assert equal(patched, new)
+
+
+def test_equal_is_json_equality():
+    assert equal({"a": [1]}, {"a": [1]})
+    assert not equal(1, 1.0)
+    assert not equal(1, True)
+
+
+def test_apply_patch_rejects_unknown_operation():
+    with pytest.raises(ValueError):
+        apply_patch({}, [{"op": "move", "path": "/a", "from": "/b"}])
+
+
+class Publisher(object):
+    """
+    Stands for the client : encodes as a dict and keeps what is published
+    """
+
+    def __init__(self):
+        self.published = []
+
+    def encode(self, topic, obj):
+        return obj, repr(obj).encode("utf-8")
+
+    def publish(self, topic, obj, payload, qos, retain):
+        self.published.append((obj, retain))
+
+
+def test_unchanged_state_is_suppressed(logger):
+    publisher = Publisher()
+    cache = StateCache(logger, publisher.encode, publisher.publish)
+    assert cache.update("dev", {"on": True})
+    assert not cache.update("dev", {"on": True})
+    assert cache.update("dev", {"on": False})
+    assert [obj["seq"] for obj, retain in publisher.published] == [1, 2]
+    assert all(retain for obj, retain in publisher.published)
+    assert cache.stats()["suppressed"] == 1
+    cache.stop()
+
+
+def test_deltas_are_applied_by_view(logger):
+    publisher = Publisher()
+    cache = StateCache(logger, publisher.encode, publisher.publish, deltas=True, snapshot_period=3600)
+    view = StateView(logger)
+    state = {"on": True, "level": 1, "zones": {"a": 1, "b": 2, "c": 3, "d": 4}}
+    cache.update("dev", state)
+    for level in range(2, 5):
+        state = dict(state, level=level)
+        cache.update("dev", state)
+    assert "patch" in publisher.published[-1][0]
+    assert not publisher.published[-1][1]
+    for obj, retain in publisher.published:
+        view.apply("dev", obj)
+    assert view.get("dev") == state
+    assert view.stats()["patches"] == 3
+    cache.stop()
+
+
+def test_view_waits_for_full_state_after_missed_delta(logger):
+    view = StateView(logger)
+    view.apply("dev", {"state": {"a": 1}, "seq": 1, "epoch": "e"})
+    assert view.apply("dev", {"patch": [{"op": "replace", "path": "/a", "value": 3}], "seq": 3, "epoch": "e"}) is None
+    assert view.get("dev") == {"a": 1}
+    assert view.stats()["gaps"] == 1
+    assert view.apply("dev", {"state": {"a": 3}, "seq": 3, "epoch": "e"}) == {"a": 3}
+
+
+def test_view_ignores_replayed_older_full_state(logger):
+    view = StateView(logger)
+    view.apply("dev", {"state": {"a": 1}, "seq": 1, "epoch": "e"})
+    view.apply("dev", {"patch": [{"op": "replace", "path": "/a", "value": 2}], "seq": 2, "epoch": "e"})
+    assert view.apply("dev", {"state": {"a": 1}, "seq": 1, "epoch": "e"}) is None
+    assert view.get("dev") == {"a": 2}
+    # Restarted publisher
+    assert view.apply("dev", {"state": {"a": 0}, "seq": 1, "epoch": "f"}) == {"a": 0}
+
+
+def test_view_ignores_patch_of_other_epoch(logger):
+    view = StateView(logger)
+    view.apply("dev", {"state": {"a": 1}, "seq": 1, "epoch": "e"})
+    assert view.apply("dev", {"patch": [{"op": "replace", "path": "/a", "value": 2}], "seq": 2,
+                              "epoch": "f"}) is None
+    assert view.get("dev") == {"a": 1}
+
+
+def test_view_doesnt_modify_shared_full_state(logger):
+    view = StateView(logger)
+    shared = {"a": {"b": 1}}
+    view.apply("dev", {"state": shared, "seq": 1, "epoch": "e"})
+    view.apply("dev", {"patch": [{"op": "replace", "path": "/a/b", "value": 2}], "seq": 2, "epoch": "e"})
+    assert shared == {"a": {"b": 1}}
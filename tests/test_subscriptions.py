@@ -0,0 +1,61 @@
+import threading
+
+from broker.dispatch import topic_handler
+from broker.mqtt import MqttClient
+from broker.subscriptions import SubscriptionSet, SubackWaiter, batches
+from conftest import Receiver, wait_until
+
+
+def test_diff_only_sends_changes():
+    subscriptions = SubscriptionSet(["a", ("b", 1), "c"])
+    assert subscriptions.update({"b": 1, "d": 2}) == [("d", 2)]
+    assert subscriptions.replace([("b", 2), "c", "e"]) == ([("b", 2), ("e", 0)], ["a", "d"])
+    assert subscriptions.items() == [("b", 2), ("c", 0), ("e", 0)]
+    assert subscriptions.remove("c") and not subscriptions.remove("c")
+
+
+def test_batches_split_in_packets():
+    assert batches(list(range(5)), 2) == [[0, 1], [2, 3], [4]]
+    assert batches([], 2) == []
+
+
+def test_suback_received_before_waiting():
+    waiter = SubackWaiter()
+    waiter.acknowledge(1, (0, 0x80))
+    assert waiter.expect(1).is_set()
+    assert waiter.result(1) == (0, 0x80)
+    event = waiter.expect(2)
+    threading.Timer(0.01, waiter.acknowledge, (2, (1,))).start()
+    assert event.wait(5) and waiter.result(2) == (1,)
+
+
+class Subscriber(Receiver):
+
+    @topic_handler("subs/handled")
+    def on_handled(self, parsed_json, topic):
+        self.received.append((topic, parsed_json))
+
+
+def test_runtime_subscription_changes(logger, broker):
+    receiver = Subscriber(logger, broker, ["subs/a"])
+    sender = MqttClient(logger, "127.0.0.1", broker, [], loop_start=True)
+
+    def publish_all():
+        del receiver.received[:]
+        for topic in ("subs/a", "subs/b", "subs/c", "subs/handled"):
+            sender.publish_json_mqtt({}, topic)
+        # Barrier : handler topics stay subscribed
+        assert wait_until(lambda: receiver.received and receiver.received[-1][0] == "subs/handled")
+        return [topic for topic, parsed_json in receiver.received]
+
+    try:
+        assert receiver.add_subscriptions(["subs/b", "subs/c"], timeout=5) is True
+        assert publish_all() == ["subs/a", "subs/b", "subs/c", "subs/handled"]
+        assert receiver.replace_subscriptions(["subs/c"], timeout=5) is True
+        assert publish_all() == ["subs/c", "subs/handled"]
+        receiver.remove_subscriptions(["subs/c"])
+        assert publish_all() == ["subs/handled"]
+        assert set(receiver.topic_list) == {"subs/handled"}
+    finally:
+        sender.disconnect_mqtt()
+        receiver.disconnect_mqtt()
@@ -0,0 +1,79 @@
+import time
+
+import pytest
+
+from services.core import core
+from services.core.core import Core
+
+
+def service(name="Example", mandatory="False"):
+    return {"name": "services/example/example.py", "service_name": name, "mandatory": mandatory,
+            "mode": "thread", "rate_limits": None}
+
+
+@pytest.fixture
+def supervisor(logger):
+    """
+    Core with only the supervision state : no broker connection nor services.conf
+    """
+    supervisor = Core.__new__(Core)
+    supervisor.logger = logger
+    supervisor.relaunchCnt = {"Example": 0}
+    supervisor.launchTime = {}
+    supervisor.pendingRestarts = {}
+    supervisor.launched = []
+    supervisor.launch_service = supervisor.launched.append
+    return supervisor
+
+
+def test_restart_delay_grows_exponentially_up_to_maximum(supervisor):
+    delays = []
+    for count in range(12):
+        supervisor.relaunchCnt["Example"] = count
+        delays.append(supervisor.restart_delay("Example"))
+    assert delays[0] == 0
+    for count, delay in enumerate(delays[1:], 1):
+        expected = min(core.RESTART_BACKOFF_MAX, core.RESTART_BACKOFF_BASE * 2 ** (count - 1))
+        assert expected * (1 - core.RESTART_JITTER) <= delay <= expected * (1 + core.RESTART_JITTER)
+
+
+def test_stable_service_gets_a_fresh_restart_count(supervisor):
+    supervisor.relaunchCnt["Example"] = 2
+    supervisor.launchTime["Example"] = time.time() - core.RESTART_STABLE_TIME
+    supervisor.on_service_exit(service())
+    due, restarted = supervisor.pendingRestarts["Example"]
+    assert supervisor.relaunchCnt["Example"] == 0 and due <= time.time()
+
+    supervisor.relaunchCnt["Example"] = 2
+    supervisor.launchTime["Example"] = time.time()
+    supervisor.on_service_exit(service())
+    due, restarted = supervisor.pendingRestarts["Example"]
+    assert supervisor.relaunchCnt["Example"] == 2 and due > time.time()
+
+
+def test_failed_restart_is_retried_later(supervisor):
+    def init_service(name, mandatory, mode, rate_limits):
+        raise RuntimeError("constructor failure")
+
+    supervisor.init_service = init_service
+    supervisor.schedule_restart(service())
+    supervisor.restart_due_services()
+    assert supervisor.launched == []
+    assert supervisor.relaunchCnt["Example"] == 1
+    due, restarted = supervisor.pendingRestarts["Example"]
+    assert due > time.time()
+    assert any(level == "e" and "constructor failure" in message for level, message in supervisor.logger.messages)
+
+    supervisor.init_service = lambda name, mandatory, mode, rate_limits: None
+    supervisor.pendingRestarts["Example"] = (time.time(), restarted)
+    supervisor.restart_due_services()
+    assert supervisor.launched == [restarted["name"]]
+    assert supervisor.relaunchCnt["Example"] == 2 and supervisor.pendingRestarts == {}
+
+
+def test_mandatory_service_over_max_retry_stops_core(supervisor):
+    supervisor.relaunchCnt["Example"] = core.MAX_RESTART_RETRY
+    supervisor.schedule_restart(service(mandatory="False"))
+    assert "Example" in supervisor.pendingRestarts
+    with pytest.raises(SystemExit):
+        supervisor.schedule_restart(service(mandatory="True"))
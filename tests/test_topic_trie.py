@@ -0,0 +1,99 @@
+from broker.topic_trie import TopicTrie, topic_matches
+from broker.dispatch import TopicDispatcher, topic_handler
+
+FILTERS = ["a/b/c", "a/+/c", "a/#", "#", "+/b/+", "a/b", "$SYS/#", "+/+"]
+TOPICS = ["a/b/c", "a/x/c", "a", "a/b", "x/b/y", "$SYS/broker/load", "$SYS", "b", "a/b/c/d"]
+
+
+def test_match_same_as_linear_matching():
+    trie = TopicTrie()
+    for topic_filter in FILTERS:
+        trie.add(topic_filter, topic_filter)
+    for topic in TOPICS:
+        expected = sorted(f for f in FILTERS if topic_matches(f, topic))
+        assert sorted(trie.match(topic)) == expected, topic
+
+
+def test_multi_level_wildcard_matches_parent_level():
+    trie = TopicTrie()
+    trie.add("a/#", 1)
+    assert trie.match("a") == [1]
+    assert trie.match("a/b/c") == [1]
+    assert trie.match("b") == []
+
+
+def test_wildcards_at_first_level_dont_match_system_topics():
+    trie = TopicTrie()
+    trie.add("#", 1)
+    trie.add("+/broker", 2)
+    trie.add("$SYS/+", 3)
+    assert trie.match("$SYS/broker") == [3]
+
+
+def test_several_values_on_a_filter():
+    trie = TopicTrie()
+    trie.add("a/+", 1)
+    trie.add("a/+", 2)
+    assert trie.match("a/b") == [1, 2]
+    assert trie.get("a/+") == [1, 2]
+    assert len(trie) == 2
+
+
+def test_remove_prunes_empty_branches():
+    trie = TopicTrie()
+    trie.add("a/b/c", 1)
+    trie.add("a/b", 2)
+    assert trie.remove("a/b/c", 1)
+    assert not trie.remove("a/b/c", 1)
+    assert "c" not in trie.root.children["a"].children["b"].children
+    assert trie.remove("a/b", 2)
+    assert trie.root.children == {}
+    assert len(trie) == 0
+
+
+def test_dispatcher_calls_each_handler_once():
+    calls = []
+
+    def handler(parsed_json, topic):
+        calls.append((parsed_json, topic))
+
+    dispatcher = TopicDispatcher()
+    dispatcher.add("a/#", handler)
+    dispatcher.add("a/+", handler)
+    assert dispatcher.dispatch("payload", "a/b")
+    assert calls == [("payload", "a/b")]
+    assert not dispatcher.dispatch("payload", "b")
+
+
+def test_dispatcher_logs_handler_errors_and_goes_on(logger):
+    calls = []
+
+    def failing(parsed_json, topic):
+        raise RuntimeError("handler failure")
+
+    errors = []
+    dispatcher = TopicDispatcher(logger)
+    dispatcher.on_error = lambda topic, error: errors.append((topic, str(error)))
+    dispatcher.add("a/#", failing)
+    dispatcher.add("a/b", lambda parsed_json, topic: calls.append(topic))
+    assert dispatcher.dispatch({}, "a/b")
+    assert calls == ["a/b"]
+    assert errors == [("a/b", "handler failure")]
+    assert dispatcher.errors == 1
+    assert "handler failure" in logger.messages[0][1]
+
+
+def test_from_instance_collects_decorated_methods():
+    class Service(object):
+        def __init__(self):
+            self.calls = []
+
+        @topic_handler("sensors/+/temperature", "alarms/#")
+        def on_message(self, parsed_json, topic):
+            self.calls.append(topic)
+
+    service = Service()
+    dispatcher = TopicDispatcher.from_instance(service)
+    assert dispatcher.topic_filters == ["sensors/+/temperature", "alarms/#"]
+    dispatcher.dispatch({}, "alarms/zone/1")
+    assert service.calls == ["alarms/zone/1"]
@@ -0,0 +1,26 @@
+from tracing import Tracer, InMemorySpanExporter
+
+PARENT = {"trace_id": "%032x" % 1, "span_id": "%016x" % 2}
+
+
+def test_spans_continue_the_trace_of_their_parent():
+    exporter = InMemorySpanExporter()
+    tracer = Tracer(sample_rate=0.5, exporter=exporter)
+    span = tracer.start_span("mqtt.message", PARENT)
+    child = tracer.start_span("mqtt.handler", span)
+    tracer.finish(child)
+    tracer.finish(span)
+    tracer.flush()
+    assert [(span.name, span.trace_id) for span in exporter.spans] == [("mqtt.handler", PARENT["trace_id"]),
+                                                                       ("mqtt.message", PARENT["trace_id"])]
+    assert exporter.spans[1].parent_id == PARENT["span_id"]
+    assert exporter.spans[0].parent_id == exporter.spans[1].span_id
+
+
+def test_sample_rate_zero_disables_tracing():
+    exporter = InMemorySpanExporter()
+    tracer = Tracer(sample_rate=0, exporter=exporter)
+    assert tracer.start_span("mqtt.publish") is None
+    assert tracer.start_span("mqtt.message", PARENT) is None
+    tracer.flush()
+    assert exporter.spans == []
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+from time import time
+from collections import deque
+from contextvars import ContextVar
+from random import random, getrandbits
+from config import TRACE_SAMPLE_RATE, TRACE_FILE, TRACE_OTLP_ENDPOINT, SERVICE_NAME
+import atexit
+import json
+import sys
+import threading
+
+"""
+    Tracing module : spans around message handling and publishing.
+
+    A fraction TRACE_SAMPLE_RATE of the received messages is traced. The context of a
+    traced message is carried in the "trace" key of the publish_mqtt envelope, next to
+    "id", so that the spans of a request and of its responses share the same trace in
+    every service. Finished spans are exported in batches from a background thread.
+"""
+
+TRACE_KEY = "trace"
+
+# Spans waiting for the exporter thread, newer spans are dropped beyond
+MAX_QUEUED_SPANS = 10000
+EXPORT_BATCH_SIZE = 512
+EXPORT_INTERVAL = 2.0
+
+current_span = ContextVar("current_span", default=None)
+
+
+class Span(object):
+    """
+        A timed operation. Times are in seconds since epoch.
+    """
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "start", "end", "attributes")
+
+    def __init__(self, name, trace_id, parent_id=None, start=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = "%016x" % getrandbits(64)
+        self.parent_id = parent_id
+        self.start = time() if start is None else start
+        self.end = None
+        self.attributes = attributes or {}
+
+    def context(self):
+        """
+            Returns the context carried in message envelopes
+        """
+        return {"trace_id": self.trace_id, "span_id": self.span_id}
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "end": self.end,
+            "attributes": self.attributes,
+        }
+
+
+class SpanExporter(object):
+    """
+        Receives finished spans from the exporter thread. Replace it with Tracer.set_exporter.
+    """
+
+    def export(self, spans):
+        pass
+
+    def shutdown(self):
+        pass
+
+
+class FileSpanExporter(SpanExporter):
+    """
+        Appends spans to a file, one json object per line
+    """
+
+    def __init__(self, path=TRACE_FILE):
+        self.path = path
+
+    def export(self, spans):
+        with open(self.path, "a", encoding="utf-8") as trace_file:
+            trace_file.write("".join(json.dumps(span.as_dict()) + "\n" for span in spans))
+
+
+class OtlpHttpSpanExporter(SpanExporter):
+    """
+        Posts spans to an OpenTelemetry collector, with the OTLP/HTTP json encoding
+    """
+
+    def __init__(self, endpoint=TRACE_OTLP_ENDPOINT, service_name=SERVICE_NAME, timeout=5):
+        """
+            :param endpoint: Traces URL of the collector, ex : http://127.0.0.1:4318/v1/traces
+        """
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.timeout = timeout
+
+    def otlp_span(self, span):
+        otlp_span = {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": 1,
+            "startTimeUnixNano": str(int(span.start * 1e9)),
+            "endTimeUnixNano": str(int(span.end * 1e9)),
+            "attributes": [{"key": key, "value": {"stringValue": str(value)}}
+                           for key, value in span.attributes.items()],
+        }
+        if span.parent_id:
+            otlp_span["parentSpanId"] = span.parent_id
+        return otlp_span
+
+    def export(self, spans):
+        import urllib.request
+        body = {
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]},
+                "scopeSpans": [{"scope": {"name": "microservices"}, "spans": [self.otlp_span(span) for span in spans]}],
+            }]
+        }
+        request = urllib.request.Request(self.endpoint, json.dumps(body).encode("utf-8"),
+                                         {"Content-Type": "application/json"})
+        urllib.request.urlopen(request, timeout=self.timeout).close()
+
+
+class InMemorySpanExporter(SpanExporter):
+    """
+        Keeps exported spans in a list, to look at them from a test or a shell
+    """
+
+    def __init__(self):
+        self.spans = []
+
+    def export(self, spans):
+        self.spans.extend(spans)
+
+
+class Tracer(object):
+    """
+        Creates spans and hands the finished ones to its exporter
+    """
+
+    def __init__(self, sample_rate=TRACE_SAMPLE_RATE, exporter=None):
+        """
+            :param sample_rate: Fraction of new traces which are recorded
+            :param exporter: SpanExporter, by default an OTLP exporter if TRACE_OTLP_ENDPOINT is set,
+                             a file exporter otherwise
+        """
+        self.sample_rate = sample_rate
+        self.exporter = exporter
+        self.spans = deque()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.thread = None
+        self.dropped = 0
+        self.exported = 0
+
+    def set_exporter(self, exporter):
+        with self.lock:
+            self.exporter = exporter
+
+    def sampled(self):
+        return self.sample_rate > 0 and random() < self.sample_rate
+
+    def start_span(self, name, parent=None, start=None, attributes=None):
+        """
+            Start a span, child of parent or of the current span. Without any of them a new
+            trace is started if it is sampled. A sample rate of 0 disables tracing, even for
+            messages carrying the trace of another service.
+            :param parent: Span, or context dict received in an envelope
+            :return: Span, None if the operation isn't traced
+        """
+        if self.sample_rate <= 0:
+            return None
+        if parent is None:
+            parent = current_span.get()
+        if parent is None:
+            if not self.sampled():
+                return None
+            return Span(name, "%032x" % getrandbits(128), None, start, attributes)
+        if isinstance(parent, Span):
+            return Span(name, parent.trace_id, parent.span_id, start, attributes)
+        return Span(name, parent["trace_id"], parent["span_id"], start, attributes)
+
+    def activate(self, span):
+        """
+            Make span the current span, parent of the spans started in this thread or task
+            :return: token to give to finish
+        """
+        return current_span.set(span)
+
+    def finish(self, span, token=None, end=None):
+        """
+            End span, restore the previous current span and queue span for export
+        """
+        if token is not None:
+            current_span.reset(token)
+        span.end = time() if end is None else end
+        with self.lock:
+            if len(self.spans) >= MAX_QUEUED_SPANS:
+                self.dropped += 1
+                return
+            self.spans.append(span)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="trace_exporter", daemon=True)
+                self.thread.start()
+                atexit.register(self.flush)
+            if len(self.spans) >= EXPORT_BATCH_SIZE:
+                self.wakeup.notify()
+
+    def record_span(self, name, parent, start, end, attributes=None):
+        """
+            Record an operation already done, child of parent
+        """
+        self.finish(Span(name, parent.trace_id, parent.span_id, start, attributes), end=end)
+
+    def inject(self, envelope):
+        """
+            Add the context of the current span to an envelope about to be published
+        """
+        span = current_span.get()
+        if span is not None:
+            envelope[TRACE_KEY] = span.context()
+        return envelope
+
+    def extract(self, parsed_json):
+        """
+            Returns the context carried by a received envelope, None if there isn't any
+        """
+        if type(parsed_json) is dict:
+            context = parsed_json.get(TRACE_KEY)
+            if type(context) is dict and "trace_id" in context and "span_id" in context:
+                return context
+        return None
+
+    def run(self):
+        while True:
+            with self.lock:
+                if len(self.spans) < EXPORT_BATCH_SIZE:
+                    self.wakeup.wait(EXPORT_INTERVAL)
+            self.flush()
+
+    def flush(self):
+        """
+            Export every finished span now
+        """
+        with self.lock:
+            spans = list(self.spans)
+            self.spans.clear()
+            if self.exporter is None:
+                if TRACE_OTLP_ENDPOINT:
+                    self.exporter = OtlpHttpSpanExporter()
+                else:
+                    self.exporter = FileSpanExporter()
+            exporter = self.exporter
+        if not spans:
+            return
+        try:
+            exporter.export(spans)
+            self.exported += len(spans)
+        except Exception as e:
+            sys.stderr.write("Trace exporter error : " + str(e) + "\n")
+
+    def stats(self):
+        with self.lock:
+            return {"queued": len(self.spans), "exported": self.exported, "dropped": self.dropped}
+
+
+tracer = Tracer()
+
+__all__ = ["tracer", "Tracer", "Span", "SpanExporter", "FileSpanExporter", "OtlpHttpSpanExporter",
+           "InMemorySpanExporter", "TRACE_KEY"]